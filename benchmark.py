@@ -0,0 +1,1048 @@
+import argparse
+import asyncio
+import concurrent.futures
+import gc
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import unicodedata
+import zlib
+from collections import defaultdict
+
+from main import (BENCHMARK_RESULTS, ETHIOPIC_HOMOPHONES, METRICS, Book, BookStore, BST, CatalogSnapshot,
+                  FullTextIndex, FuzzyIndex, HashTable, LibrarySystem, QueryCache, RadixTrie, SearchCancelled,
+                  SearchLog, SearchServer, SearchService, ShardedLibrary, WriteAheadLog, book_record,
+                  normalize_key, prometheus_text)
+
+
+def make_books(n, order="random", seed=42):
+    isbns = list(range(9780000000000, 9780000000000 + n))
+    if order == "reverse":
+        isbns.reverse()
+    elif order == "random":
+        random.Random(seed).shuffle(isbns)
+    for isbn in isbns:
+        yield Book(f"Book {isbn}", f"Author {isbn % 5000}", str(isbn), f"books/{isbn}.pdf")
+
+
+def bench_bst(n, lookups=10000, seed=42):
+    print(f"BST (AVL) benchmark, n={n:,}")
+    print(f"{'load':<10}{'insert s':>10}{'height':>8}{'1.44*log2(n)':>14}{'lookup us':>11}")
+    for order in ("sorted", "reverse", "random"):
+        tree = BST(key_func=lambda b: b.isbn)
+        start = time.perf_counter()
+        for book in make_books(n, order, seed):
+            tree.insert(book)
+        insert_time = time.perf_counter() - start
+
+        rng = random.Random(seed)
+        keys = [str(9780000000000 + rng.randrange(n)) for _ in range(lookups)]
+        start = time.perf_counter()
+        for key in keys:
+            tree.search(key)
+        lookup_us = (time.perf_counter() - start) / lookups * 1e6
+
+        bound = 1.44 * math.log2(n + 2)
+        print(f"{order:<10}{insert_time:>10.2f}{tree.height():>8}{bound:>14.1f}{lookup_us:>11.2f}")
+
+
+def bench_hash(n, lookups=10000, seed=42):
+    table = HashTable(key_func=lambda b: b.isbn)
+    start = time.perf_counter()
+    for book in make_books(n, "random", seed):
+        table.insert(book)
+    insert_time = time.perf_counter() - start
+
+    rng = random.Random(seed)
+    hits = [str(9780000000000 + rng.randrange(n)) for _ in range(lookups)]
+    misses = [str(9770000000000 + rng.randrange(n)) for _ in range(lookups)]
+    timings = {}
+    for label, keys in (("hit", hits), ("miss", misses)):
+        start = time.perf_counter()
+        for key in keys:
+            table.search(key)
+        timings[label] = (time.perf_counter() - start) / lookups * 1e6
+
+    stats = table.stats()
+    print(f"HashTable benchmark, n={n:,}")
+    print(f"  insert {insert_time:.2f} s, capacity {stats['capacity']:,}, "
+          f"load factor {stats['load_factor']:.2f}, resizes {stats['resizes']}")
+    print(f"  probe length avg {stats['avg_probe']:.2f}, max {stats['max_probe']}")
+    print(f"  lookup hit {timings['hit']:.2f} us, miss {timings['miss']:.2f} us")
+
+
+def make_vocabulary(size=20000, seed=7):
+    # Pseudo-words built from Ethiopic syllables, plus some Latin filler
+    rng = random.Random(seed)
+    syllables = [chr(cp) for cp in range(0x1200, 0x1350)]
+    words = ["".join(rng.choice(syllables) for _ in range(rng.randint(2, 5))) for _ in range(size)]
+    return words + ["history", "of", "the", "river", "ethiopia", "new", "era"]
+
+
+TITLE_WORDS = make_vocabulary()
+
+
+def random_title(rng, words=TITLE_WORDS):
+    return " ".join(rng.choice(words) for _ in range(rng.randint(2, 4)))
+
+
+def bench_trie(n, lookups=10000, seed=42):
+    rng = random.Random(seed)
+    trie = RadixTrie()
+    start = time.perf_counter()
+    for i in range(n):
+        title = f"{random_title(rng)} {i}"
+        trie.insert(normalize_key(title), title)
+    insert_time = time.perf_counter() - start
+
+    prefixes = [rng.choice(TITLE_WORDS)[:rng.randint(1, 3)] for _ in range(lookups)]
+    start = time.perf_counter()
+    for prefix in prefixes:
+        trie.complete(prefix, 8)
+    lookup_us = (time.perf_counter() - start) / lookups * 1e6
+    print(f"RadixTrie benchmark, n={n:,}")
+    print(f"  insert {insert_time:.2f} s, top-8 completion {lookup_us:.2f} us")
+
+
+def add_typo(rng, text):
+    i = rng.randrange(len(text))
+    if text[i] == " ":
+        return text
+    return text[:i] + chr(ord(text[i]) + 1) + text[i + 1:]
+
+
+def bench_fuzzy(n, lookups=1000, seed=42):
+    rng = random.Random(seed)
+    index = FuzzyIndex()
+    titles = []
+    start = time.perf_counter()
+    for i in range(n):
+        title = random_title(rng)
+        titles.append(title)
+        index.insert(normalize_key(title), i)
+    build_time = time.perf_counter() - start
+
+    queries = [(i, add_typo(rng, normalize_key(titles[i]))) for i in (rng.randrange(n) for _ in range(lookups))]
+    found = 0
+    start = time.perf_counter()
+    for i, query in queries:
+        if i in index.search(query, 10):
+            found += 1
+    lookup_ms = (time.perf_counter() - start) / lookups * 1e3
+    print(f"FuzzyIndex benchmark, n={n:,}")
+    print(f"  build {build_time:.2f} s, {len(index.postings):,} grams, "
+          f"query {lookup_ms:.2f} ms, recall@10 {found / lookups:.1%}")
+
+
+def bench_bulk_load(n, seed=42):
+    rng = random.Random(seed)
+    fd, path = tempfile.mkstemp(suffix=".jsonl")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for book in make_books(n, "random", seed):
+                f.write(json.dumps({"title": random_title(rng), "author": book.author,
+                                    "isbn": book.isbn, "pdf_path": book.pdf_path},
+                                   ensure_ascii=False) + "\n")
+        library = LibrarySystem()
+        library.build_indexes()
+        report = library.bulk_load(path)
+    finally:
+        os.remove(path)
+    print(f"Bulk load benchmark, n={n:,}")
+    print(f"  {report['seconds']:.2f} s, {report['rows_per_sec']:,.0f} rows/s, "
+          f"title tree height {library.view.title_bst.height()}, isbn tree height {library.view.isbn_bst.height()}")
+
+
+def bench_snapshot(n, lookups=10000, seed=42):
+    fd, path = tempfile.mkstemp(suffix=".snap")
+    os.close(fd)
+    try:
+        start = time.perf_counter()
+        CatalogSnapshot.write(path, make_books(n, "random", seed))
+        write_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        library = LibrarySystem(snapshot_path=path)
+        open_ms = (time.perf_counter() - start) * 1e3
+
+        rng = random.Random(seed)
+        keys = [str(9780000000000 + rng.randrange(n)) for _ in range(lookups)]
+        start = time.perf_counter()
+        for key in keys:
+            library.snapshot_find('isbn', key)
+        lookup_us = (time.perf_counter() - start) / lookups * 1e6
+        size_mb = os.path.getsize(path) / 1e6
+        library.view.snapshot.close()
+    finally:
+        os.remove(path)
+    print(f"Snapshot benchmark, n={n:,}")
+    print(f"  write {write_time:.2f} s ({size_mb:.1f} MB), startup {open_ms:.2f} ms, "
+          f"mapped ISBN lookup {lookup_us:.2f} us")
+
+
+def bench_wal(events=5000, group_sizes=(1, 64, 1024)):
+    print(f"Write-ahead log benchmark, {events:,} search events")
+    for group_size in group_sizes:
+        fd, path = tempfile.mkstemp(suffix=".log")
+        os.close(fd)
+        wal = WriteAheadLog(path, group_size=group_size, flush_interval=3600)
+        latencies = []
+        try:
+            start = time.perf_counter()
+            for i in range(events):
+                began = time.perf_counter()
+                wal.append({"op": "search", "user": {"id": str(i % 500), "name": "bench"},
+                            "query": f"query {i}", "type": "title", "timestamp": "2024-01-01 00:00:00"})
+                latencies.append(time.perf_counter() - began)
+            wal.flush()
+            elapsed = time.perf_counter() - start
+            commits = wal.commits
+        finally:
+            wal.close()
+            os.remove(path)
+        latencies.sort()
+        print(f"  group {group_size:>5}: {events / elapsed:>10,.0f} events/s, {commits:,} fsyncs, "
+              f"append p99 {latencies[int(len(latencies) * 0.99)] * 1e6:,.0f} us")
+    bench_wal_durable()
+
+
+def bench_wal_durable(writers=8, changes=200, group_sizes=(1, 64, 1024)):
+    # Catalog changes wait for their fsync; concurrent writers share them
+    print(f"  {writers} threads x {changes} catalog changes, each waiting for its fsync")
+    for group_size in group_sizes:
+        fd, path = tempfile.mkstemp(suffix=".log")
+        os.close(fd)
+        wal = WriteAheadLog(path, group_size=group_size, flush_interval=3600)
+
+        def write(w):
+            for i in range(changes):
+                wal.wait(wal.append({"op": "remove_book", "isbn": f"{w}-{i}"}))
+
+        threads = [threading.Thread(target=write, args=(w,)) for w in range(writers)]
+        try:
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            commits = wal.commits
+        finally:
+            wal.close()
+            os.remove(path)
+        print(f"  group {group_size:>5}: {writers * changes / elapsed:>10,.0f} changes/s, {commits:,} fsyncs")
+
+
+class DictBook:
+    # The original record layout: a plain object with a __dict__
+    def __init__(self, title, author, isbn, pdf_path):
+        self.title = title
+        self.author = author
+        self.isbn = isbn
+        self.pdf_path = pdf_path
+
+
+def catalog_rows(n, seed=42):
+    rng = random.Random(seed)
+    for book in make_books(n, "random", seed):
+        # Fresh strings per row, as a CSV reader would produce them
+        yield random_title(rng), f"{book.author}", book.isbn, book.pdf_path
+
+
+def traced_bytes(build):
+    tracemalloc.start()
+    try:
+        result = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return size, result
+
+
+def bench_memory(n, seed=42):
+    before, _ = traced_bytes(lambda: [DictBook(*row) for row in catalog_rows(n, seed)])
+
+    def build_store():
+        store = BookStore()
+        for row in catalog_rows(n, seed):
+            store.append(Book(*row))
+        return store
+    after, _ = traced_bytes(build_store)
+    print(f"Record memory benchmark, n={n:,}")
+    print(f"  __dict__ objects {before / n:.0f} B/book, columnar store {after / n:.0f} B/book "
+          f"({before / after:.1f}x smaller)")
+
+
+def bench_search_log(events=1000000, capacity=10000, users=2000):
+    print(f"Search log benchmark, capacity {capacity:,}, {users:,} users")
+    tracemalloc.start()
+    log = SearchLog(capacity)
+    checkpoints = {events // 10, events}
+    for i in range(1, events + 1):
+        log.append({"user": {"id": str(i % users), "name": "bench"}, "query": f"query {i}",
+                    "type": "title", "timestamp": "2024-01-01 00:00:00"}, i)
+        if i in checkpoints:
+            print(f"  after {i:>9,} searches: {tracemalloc.get_traced_memory()[0] / 1e6:.1f} MB")
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for user in range(100):
+        list(log.for_user(str(user)))
+    history_us = (time.perf_counter() - start) / 100 * 1e6
+    print(f"  per-user history {history_us:.1f} us for {len(list(log.for_user('0')))} entries")
+
+
+DISTRIBUTIONS = ("sequential", "random", "skewed")
+
+# (search type, method) -> lookup over a LibrarySystem, mirroring perform_search
+SEARCH_METHODS = {
+    ("title", "bst"): lambda library: lambda key: library.find("title", key, "bst"),
+    ("title", "hash"): lambda library: lambda key: library.find("title", key, "hash"),
+    ("isbn", "bst"): lambda library: lambda key: library.find("isbn", key, "bst"),
+    ("isbn", "hash"): lambda library: lambda key: library.find("isbn", key, "hash"),
+    ("author", "hash"): lambda library: library.author_search,
+    ("author", "linear"): lambda library: library.linear_author_search,
+    ("fuzzy", "ngram"): lambda library: library.fuzzy_search,
+}
+
+
+def catalog(n, distribution, seed=42):
+    # sequential: ISBNs in registrar export order; random: shuffled;
+    # skewed: shuffled, with Zipf-like authors (a few very prolific ones)
+    rng = random.Random(seed)
+    authors = max(1, n // 5)
+    isbns = list(range(9780000000000, 9780000000000 + n))
+    if distribution != "sequential":
+        rng.shuffle(isbns)
+    for isbn in isbns:
+        if distribution == "skewed":
+            author = int(rng.paretovariate(1.1)) % authors
+        else:
+            author = rng.randrange(authors)
+        yield Book(f"{random_title(rng)} {isbn % 100000}", f"Author {author}", str(isbn), f"books/{isbn}.pdf")
+
+
+def build_library(n, distribution, seed=42):
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        library = LibrarySystem()
+        library.load_books(catalog(n, distribution, seed))
+        library.build_indexes()
+        build_time = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return library, build_time, memory
+
+
+def make_queries(library, count, seed=42):
+    rng = random.Random(seed)
+    rows = [rng.randrange(len(library.view.books)) for _ in range(count)]
+    books = library.view.books
+    return {
+        "title": ([books.title(row) for row in rows], [f"missing title {i}" for i in range(count)]),
+        "isbn": ([books.isbn(row) for row in rows], [str(9770000000000 + i) for i in range(count)]),
+        "author": ([books.author(row) for row in rows], [f"Nobody {i}" for i in range(count)]),
+        "fuzzy": ([add_typo(rng, books.title(row)) for row in rows], ["qqqq zzzz" for _ in range(count)]),
+    }
+
+
+def timer_overhead(samples=10000):
+    readings = []
+    for _ in range(samples):
+        t0 = time.perf_counter_ns()
+        readings.append(time.perf_counter_ns() - t0)
+    return sorted(readings)[len(readings) // 2]
+
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of an already sorted list
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def time_lookups(lookup, queries, warmup, repeats, overhead):
+    for _ in range(warmup):
+        for query in queries:
+            lookup(query)
+    samples = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            for query in queries:
+                t0 = time.perf_counter_ns()
+                lookup(query)
+                samples.append(time.perf_counter_ns() - t0)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    samples = sorted(max(0, sample - overhead) / 1000 for sample in samples)
+    return {
+        "samples": len(samples),
+        "mean_us": sum(samples) / len(samples),
+        "p50_us": percentile(samples, 50),
+        "p95_us": percentile(samples, 95),
+        "p99_us": percentile(samples, 99),
+    }
+
+
+def run_search_benchmark(sizes, distributions, queries=200, warmup=1, repeats=5,
+                         linear_budget=2000000, seed=42):
+    overhead = timer_overhead()
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "queries": queries, "warmup": warmup, "repeats": repeats,
+            "timer_overhead_ns": overhead,
+        },
+        "builds": [],
+        "results": [],
+    }
+    for size in sizes:
+        for distribution in distributions:
+            library, build_time, memory = build_library(size, distribution, seed)
+            report["builds"].append({
+                "size": size, "distribution": distribution, "build_s": build_time,
+                "memory_bytes": memory, "bytes_per_book": memory / size,
+            })
+            print(f"n={size:,} {distribution}: built in {build_time:.2f} s, {memory / size:.0f} B/book")
+            query_sets = make_queries(library, queries, seed)
+            for (search_type, method), bind in SEARCH_METHODS.items():
+                for case, case_queries in zip(("hit", "miss"), query_sets[search_type]):
+                    if method == "linear":
+                        # Keep the O(n) baseline to a bounded number of row visits
+                        case_queries = case_queries[:max(3, linear_budget // size)]
+                    stats = time_lookups(bind(library), case_queries, warmup, repeats, overhead)
+                    report["results"].append(dict(stats, size=size, distribution=distribution,
+                                                  search_type=search_type, method=method, case=case))
+                    print(f"  {search_type:<7}{method:<8}{case:<5}"
+                          f"p50 {stats['p50_us']:>10.2f} us  p95 {stats['p95_us']:>10.2f} us  "
+                          f"p99 {stats['p99_us']:>10.2f} us")
+            del library
+    return report
+
+
+def run_server(n, ready):
+    library = LibrarySystem()
+    library.load_books(catalog(n, "random"))
+    library.build_indexes()
+    server = SearchServer(SearchService(library), port=0)
+
+    async def main():
+        async with await server.start():
+            ready.put(server.port)
+            await asyncio.Event().wait()
+    asyncio.run(main())
+
+
+async def http_client(port, paths, body=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    method = "POST" if body else "GET"
+    payload = body.encode("utf-8") if body else b""
+    for path in paths:
+        writer.write(f"{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Length: {len(payload)}\r\n\r\n"
+                     .encode("latin-1") + payload)
+        await writer.drain()
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line == b"\r\n":
+                break
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        await reader.readexactly(length)
+    writer.close()
+
+
+def bench_http(n=100000, client_counts=(1, 8, 64), requests_per_client=300, batch=32):
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_server, args=(n, ready), daemon=True)
+    server.start()
+    try:
+        port = ready.get(timeout=600)
+        isbns = [str(9780000000000 + i) for i in random.Random(1).sample(range(n), 1000)]
+        body = json.dumps([["isbn", isbn] for isbn in isbns[:batch]])
+        print(f"HTTP search API benchmark, n={n:,} (server in a separate process)")
+        for clients in client_counts:
+            paths = [f"/search?type=isbn&q={isbns[i % len(isbns)]}" for i in range(requests_per_client)]
+
+            async def single():
+                await asyncio.gather(*(http_client(port, paths) for _ in range(clients)))
+
+            async def batched():
+                batch_paths = ["/search_many"] * max(1, requests_per_client // batch)
+                await asyncio.gather(*(http_client(port, batch_paths, body) for _ in range(clients)))
+
+            start = time.perf_counter()
+            asyncio.run(single())
+            single_rate = clients * requests_per_client / (time.perf_counter() - start)
+            start = time.perf_counter()
+            asyncio.run(batched())
+            batch_rate = clients * max(1, requests_per_client // batch) * batch / (time.perf_counter() - start)
+            print(f"  {clients:>3} clients: {single_rate:>9,.0f} req/s single, "
+                  f"{batch_rate:>9,.0f} queries/s via search_many({batch})")
+    finally:
+        server.terminate()
+
+
+def bench_concurrent_reads(n=100000, base=50000, readers=8, seconds=2.0, seed=42):
+    # Reader threads search while one writer bulk-imports n more books; every
+    # reader also checks that a book it finds by ISBN is in the tree as well
+    books = list(catalog(base + n, "random", seed))
+    existing, incoming = books[:base], books[base:]
+    library = LibrarySystem()
+    library.load_books(existing)
+    library.build_indexes()
+    known = [book.isbn for book in existing[::max(1, base // 1000)]]
+    fresh = [book.isbn for book in incoming[::max(1, n // 1000)]]
+    counts = [0] * readers
+    torn = [0] * readers
+    stop = threading.Event()
+
+    def reader(i):
+        rng = random.Random(i)
+        while not stop.is_set():
+            view = library.view
+            isbn = rng.choice(fresh if i % 2 else known)
+            found = view.isbn_hash.search(isbn, view.visible)
+            if (found is None) != (view.isbn_bst.search(isbn, view.visible) is None):
+                torn[i] += 1
+            library.suggest(isbn[:9], "isbn")
+            counts[i] += 1
+
+    def run(duration=None, work=None):
+        counts[:] = [0] * readers
+        stop.clear()
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        if work is None:
+            time.sleep(duration)
+        else:
+            work()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return sum(counts) / elapsed, elapsed
+
+    alone = LibrarySystem()
+    alone.load_books(existing)
+    alone.build_indexes()
+    alone_time = alone.load_books(incoming)['seconds']
+    del alone
+    idle_rate, _ = run(duration=seconds)
+    busy_rate, import_time = run(work=lambda: library.load_books(incoming))
+    print(f"Concurrent reads, {readers} reader threads, {base:,} books + import of {n:,}")
+    print(f"  idle:          {idle_rate:>9,.0f} lookups/s")
+    print(f"  during import: {busy_rate:>9,.0f} lookups/s")
+    print(f"  import: {alone_time:.2f} s alone, {import_time:.2f} s alongside the readers")
+    print(f"  inconsistent reads: {sum(torn)}, visible rows now {library.view.rows:,}")
+
+
+def bench_shards(n=100000, shard_counts=(1, 2, 4, 8), clients=16, seconds=2.0, seed=42):
+    # Index build time and query throughput for the catalog split across
+    # worker processes, next to one in-process LibrarySystem. Client threads
+    # issue exact lookups (ISBN, title, author) or typo'd fuzzy queries.
+    books = list(catalog(n, "random", seed))
+    rng = random.Random(seed)
+    sample = rng.sample(books, 1000)
+    lookups = [(kind, getattr(book, kind)) for book in sample for kind in ("isbn", "title", "author")]
+    typos = [add_typo(rng, book.title) for book in sample]
+
+    def throughput(library, work):
+        counts = [0] * clients
+        stop = threading.Event()
+
+        def client(i):
+            rng = random.Random(i)
+            while not stop.is_set():
+                work(library, rng)
+                counts[i] += 1
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return sum(counts) / seconds
+
+    def lookup(library, rng):
+        kind, key = rng.choice(lookups)
+        if kind == "author":
+            library.author_search(key)
+        else:
+            library.find(kind, key)
+
+    def fuzzy(library, rng):
+        library.fuzzy_search(rng.choice(typos))
+
+    print(f"Sharded catalog, {n:,} books, {clients} client threads, {os.cpu_count()} CPUs")
+    print(f"{'shards':>10}{'build s':>10}{'lookups/s':>12}{'fuzzy/s':>10}")
+    for count in (0,) + tuple(shard_counts):
+        start = time.perf_counter()
+        if count:
+            library = ShardedLibrary(count)
+            library.load_books(books)
+        else:
+            library = LibrarySystem(samples=False)
+            library.load_books(books)
+            library.build_indexes()
+        build_time = time.perf_counter() - start
+        rates = throughput(library, lookup), throughput(library, fuzzy)
+        if count:
+            library.close()
+        label = count or "in-process"
+        print(f"{label:>10}{build_time:>10.2f}{rates[0]:>12,.0f}{rates[1]:>10,.0f}")
+        del library
+
+
+def write_pdf(path, pages, compress=True):
+    # Minimal PDF: one Helvetica page per list of lines, each page's
+    # content stream Flate-compressed unless compress is False. Words are
+    # spaced with TJ kerning and odd pages give their /Length indirectly,
+    # as typeset PDFs do.
+    def escape(text):
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)").encode("latin-1")
+
+    def shown(line):
+        return b"[" + b" -250 ".join(b"(" + escape(word) + b")" for word in line.split()) + b"] TJ T*"
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page, lines in enumerate(pages):
+        content = b"BT /F1 11 Tf 14 TL 72 740 Td " + b" ".join(map(shown, lines)) + b" ET"
+        if compress:
+            content = zlib.compress(content)
+        length = b"%d" % len(content)
+        if page % 2:
+            objects.append(length)
+            length = b"%d 0 R" % len(objects)
+        header = b"<< /Length " + length + (b" /Filter /FlateDecode >>" if compress else b" >>")
+        objects.append(header + b"\nstream\n" + content + b"\nendstream")
+        kids.append(len(objects) + 1)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % kid for kid in kids) + b"] /Count %d >>" % len(kids)
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        f.write(b"".join(b"%010d 00000 n \n" % offset for offset in offsets))
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+
+def bench_fulltext(docs=2000, words=3000, added=100, queries=200, singles=50, seed=42):
+    # Synthetic corpus: Zipf-distributed words, plus one marker word per
+    # PDF so the top hit of a marker query can be checked
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    vocabulary = ["".join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(30000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    directory = tempfile.mkdtemp()
+    books = []
+    text_bytes = 0
+    for i in range(docs + added + singles):
+        text = rng.choices(vocabulary, weights, k=words) + [f"marker{i}"]
+        rng.shuffle(text)
+        lines = [" ".join(text[j:j + 12]) for j in range(0, len(text), 12)]
+        text_bytes += sum(len(line) + 1 for line in lines)
+        path = os.path.join(directory, f"{i}.pdf")
+        write_pdf(path, [lines[j:j + 50] for j in range(0, len(lines), 50)])
+        books.append(Book(f"Book {i}", f"Author {i % 100}", str(9780000000000 + i), path))
+    try:
+        index = FullTextIndex(os.path.join(directory, "index"))
+        start = time.perf_counter()
+        index.update(books[:docs])
+        build_time = time.perf_counter() - start
+        start = time.perf_counter()
+        index.update(books[:docs])
+        recheck_time = time.perf_counter() - start
+        start = time.perf_counter()
+        index.update(books[:docs + added])
+        incremental_time = time.perf_counter() - start
+        # One book at a time, as add_book queues them
+        single_times = []
+        for book in books[docs + added:]:
+            start = time.perf_counter()
+            index.update([book])
+            single_times.append(time.perf_counter() - start)
+        single_times.sort()
+
+        samples = {
+            "1 word": [rng.choices(vocabulary[:2000], k=1) for _ in range(queries)],
+            "3 words": [rng.choices(vocabulary[:2000], k=3) for _ in range(queries)],
+            "marker": [[f"marker{rng.randrange(docs + added + singles)}"] for _ in range(queries)],
+        }
+        latencies = {}
+        for label, terms in samples.items():
+            times = []
+            for query in terms:
+                t0 = time.perf_counter()
+                found = index.search(" ".join(query), 10)
+                times.append(time.perf_counter() - t0)
+            times.sort()
+            latencies[label] = (percentile(times, 50) * 1e3, percentile(times, 95) * 1e3)
+        top_hits = sum(index.search(query[0], 1)[0][1] == str(9780000000000 + int(query[0][6:]))
+                       for query in samples["marker"])
+        stats = index.stats()
+        opened, _ = traced_bytes(lambda: FullTextIndex(os.path.join(directory, "index")))
+    finally:
+        shutil.rmtree(directory)
+    print(f"Full-text benchmark, {docs:,} PDFs of {words:,} words, {os.cpu_count()} CPUs")
+    print(f"  index {build_time:.1f} s ({docs / build_time:,.0f} PDFs/s); unchanged re-check {recheck_time * 1e3:.0f} ms; "
+          f"{added} new PDFs {incremental_time:.2f} s")
+    print(f"  {singles} single-PDF updates: p50 {percentile(single_times, 50) * 1e3:.1f} ms, "
+          f"max {single_times[-1] * 1e3:.0f} ms")
+    print(f"  {stats['terms']:,} terms in {stats['segments']} segments, {stats['bytes'] / 1e6:.1f} MB "
+          f"for {text_bytes / 1e6:.1f} MB of text; {opened / 1e6:.1f} MB in memory once opened")
+    print("  query p50 / p95: " + ", ".join(f"{label} {p50:.2f} / {p95:.2f} ms"
+                                            for label, (p50, p95) in latencies.items()))
+    print(f"  marker word ranked first: {top_hits / queries:.0%}")
+
+
+def bench_responsiveness(n=300000, frame_ms=10, seed=42):
+    # Stands in for the Tk event loop: the main thread wakes every frame_ms
+    # while a worker runs a slow linear author search, the way search_book
+    # hands it to the pool, and records how late each frame is
+    library = LibrarySystem()
+    library.load_books(catalog(n, "random", seed))
+    library.build_indexes()
+    service = SearchService(library)
+    pool = concurrent.futures.ThreadPoolExecutor(1)
+
+    def frames_while(future):
+        frames = []
+        while not future.done():
+            start = time.perf_counter()
+            time.sleep(frame_ms / 1000)
+            frames.append((time.perf_counter() - start) * 1e3)
+        return sorted(frames)
+
+    start = time.perf_counter()
+    future = pool.submit(service.compare, "Author 1", "author")
+    frames = frames_while(future)
+    search_time = time.perf_counter() - start
+
+    cancel = threading.Event()
+    future = pool.submit(service.compare, "Author 2", "author", None, cancel)
+    time.sleep(search_time / 4)
+    start = time.perf_counter()
+    cancel.set()
+    try:
+        future.result()
+        outcome = "finished"
+    except SearchCancelled:
+        outcome = "cancelled"
+    cancel_ms = (time.perf_counter() - start) * 1e3
+    pool.shutdown()
+
+    print(f"UI responsiveness, n={n:,}, {frame_ms} ms frames, linear author search on a worker")
+    print(f"  search {search_time:.2f} s, {len(frames)} frames: p50 {percentile(frames, 50):.1f} ms, "
+          f"p99 {percentile(frames, 99):.1f} ms, max {frames[-1]:.1f} ms")
+    print(f"  newer query: previous search {outcome} {cancel_ms:.1f} ms after cancel")
+
+
+def bench_startup(sizes=(1000, 100000, 1000000), logged=1000, seed=42):
+    # Cold import of main in a fresh interpreter, then opening a catalog of
+    # each size (snapshot plus a log of unsnapshotted books) and the first
+    # query of each type, which builds its index on demand
+    here = os.path.dirname(os.path.abspath(__file__))
+    probe = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+    imports = min(float(subprocess.run([sys.executable, "-c", probe], cwd=here, check=True,
+                                       capture_output=True, text=True).stdout) for _ in range(5))
+    print(f"Startup benchmark: import main {imports * 1e3:.0f} ms")
+    for n in sizes:
+        directory = tempfile.mkdtemp()
+        snapshot = os.path.join(directory, "catalog.snap")
+        log = os.path.join(directory, "catalog.log")
+        try:
+            CatalogSnapshot.write(snapshot, make_books(n, "random", seed))
+            wal = WriteAheadLog(log)
+            for book in make_books(logged, "random", seed + 1):
+                wal.append(dict(book_record(book), isbn="97799" + book.isbn[5:]))
+            wal.close()
+            start = time.perf_counter()
+            library = LibrarySystem(snapshot_path=snapshot, log_path=log)
+            open_ms = (time.perf_counter() - start) * 1e3
+            firsts = []
+            for search_type, query in (("title", "missing"), ("isbn", "0"), ("author", "nobody"),
+                                       ("fuzzy", "missing")):
+                start = time.perf_counter()
+                SearchService(library).search(search_type, query)
+                firsts.append(f"{search_type} {(time.perf_counter() - start) * 1e3:.1f}")
+            library.close()
+            library.view.snapshot.close()
+        finally:
+            for path in os.listdir(directory):
+                os.remove(os.path.join(directory, path))
+            os.rmdir(directory)
+        print(f"  n={n:>9,}: open {open_ms:.1f} ms; first query (ms) " + ", ".join(firsts))
+
+
+def bench_query_cache(n, searches=5000, popular=200, write_every=50, seed=42):
+    # Zipf-distributed patron queries through SearchService.compare, with a
+    # new book added every write_every searches
+    library = LibrarySystem()
+    library.load_books(catalog(n, "skewed", seed))
+    library.build_indexes()
+    service = SearchService(library)
+    rng = random.Random(seed)
+    books = library.view.books
+    queries = [("author", books.author(row)) if i % 3 == 0 else ("title", books.title(row))
+               for i, row in enumerate(rng.sample(range(len(books)), popular))]
+    weights = [1 / (rank + 1) for rank in range(popular)]
+    workload = rng.choices(queries, weights, k=searches)
+    timings = {}
+    for label, cache_size in (("no cache", 0), ("LRU cache", 1024)):
+        library.cache = QueryCache(cache_size)
+        start = time.perf_counter()
+        for i, (search_type, query) in enumerate(workload):
+            service.compare(query, search_type)
+            if i % write_every == 0:
+                library.add_book(Book(f"{random_title(rng)} {i}", rng.choice(queries)[1], str(9790000000000 + i), ""))
+        timings[label] = (time.perf_counter() - start) / searches * 1e6
+    stats = library.cache.stats()
+    print(f"Query cache benchmark, n={n:,}, {popular} popular queries, a write every {write_every} searches")
+    print(f"  {timings['no cache']:.0f} us/search uncached, {timings['LRU cache']:.0f} us/search cached; "
+          f"hit rate {stats['hit_rate']:.0%}, {stats['invalidations']} invalidated, {stats['evictions']} evicted")
+
+
+def bench_mixed_workload(n, ops=20000, seed=42):
+    # Random lookups, inserts, removes and title updates, each result checked
+    # against a plain dict of what the catalog should hold
+    library = LibrarySystem()
+    library.load_books(catalog(n, "random", seed))
+    library.build_indexes()
+    rng = random.Random(seed)
+    books = library.view.books
+    expected = {books.isbn(row): books.title(row) for row in range(len(books))}
+    isbns = list(expected)
+    samples = library.total_books() - len(expected)
+    mix = rng.choices(("lookup", "insert", "remove", "update"), (60, 15, 15, 10), k=ops)
+    times = defaultdict(float)
+    counts = defaultdict(int)
+    wrong = 0
+    for i, op in enumerate(mix):
+        isbn = rng.choice(isbns)
+        start = time.perf_counter()
+        if op == "lookup":
+            method = "hash" if i % 2 else "bst"
+            found = library.find("isbn", isbn, method)
+            wrong += (found.title if found else None) != expected.get(isbn)
+            if found and library.find("title", found.title, method) is None:
+                wrong += 1
+        elif op == "insert":
+            isbn = str(9790000000000 + i)
+            library.add_book(Book(f"{random_title(rng)} {i}", "Author new", isbn, ""))
+            isbns.append(isbn)
+            expected[isbn] = library.find("isbn", isbn).title
+        elif op == "remove":
+            removed = library.remove_book(isbn)
+            wrong += (removed is None) != (isbn not in expected)
+            expected.pop(isbn, None)
+        else:
+            title = f"{random_title(rng)} v{i}"
+            updated = library.update_book(isbn, title=title)
+            wrong += (updated is None) != (isbn not in expected)
+            if updated is not None:
+                expected[isbn] = title
+        times[op] += time.perf_counter() - start
+        counts[op] += 1
+    wrong += library.total_books() - samples != len(expected)
+    view = library.view
+    stats = view.isbn_hash.stats()
+    print(f"Mixed workload benchmark, n={n:,}, {ops:,} operations")
+    print("  " + ", ".join(f"{op} {counts[op] / times[op]:,.0f} ops/s" for op in ("lookup", "insert", "remove", "update")))
+    print(f"  isbn hash: {stats['entries']:,} live, {stats['tombstones']} tombstones, "
+          f"{stats['compactions']} compactions; isbn BST height {view.isbn_bst.height()} "
+          f"for {len(view.isbn_bst):,} books; wrong answers: {wrong}")
+
+
+def bench_normalization(n, lookups=10000, scans=20, seed=42):
+    # Exact title and author lookups typed the way patrons spell them: any
+    # letter of a homophone group, other capitals, decomposed accents
+    rng = random.Random(seed)
+    spellings = defaultdict(list)
+    for source, target in ETHIOPIC_HOMOPHONES.items():
+        spellings[target].append(chr(source))
+    for target in spellings:
+        spellings[target].append(chr(target))
+
+    def respell(text):
+        chars = (rng.choice(spellings[ETHIOPIC_HOMOPHONES.get(ord(ch), ord(ch))])
+                 if ETHIOPIC_HOMOPHONES.get(ord(ch), ord(ch)) in spellings else ch for ch in text)
+        text = "".join(chars)
+        return unicodedata.normalize("NFD", text.upper() if rng.random() < 0.5 else text)
+
+    surnames = ["Müller", "Zoë", "Héctor", "Ağaoğlu", "Straße"]
+    books = [Book(f"{random_title(rng)} {i}", f"{rng.choice(TITLE_WORDS)} {rng.choice(surnames)}",
+                  str(9780000000000 + i), "") for i in range(n)]
+    start = time.perf_counter()
+    for book in books:
+        normalize_key(book.title)
+    normalize_us = (time.perf_counter() - start) / n * 1e6
+    library = LibrarySystem(samples=False)
+    library.load_books(books)
+    library.build_indexes()
+    sample = [rng.choice(books) for _ in range(lookups)]
+    titles = [(book, respell(book.title)) for book in sample]
+    authors = [(book.author, respell(book.author)) for book in sample]
+
+    def run(label, queries, search, check):
+        start = time.perf_counter()
+        found = sum(1 for expected, query in queries if check(expected, search(query)))
+        elapsed = (time.perf_counter() - start) / len(queries) * 1e6
+        print(f"  {label}: {found / len(queries):.1%} found, {elapsed:,.1f} us/query")
+
+    print(f"Normalization benchmark, n={n:,}, queries respelled with homophones, case and NFD")
+    print(f"  normalize_key {normalize_us:.2f} us/title")
+    run("title hash", titles, lambda q: library.find("title", q, "hash"), lambda b, found: found is not None and found.isbn == b.isbn)
+    run("title BST", titles, lambda q: library.find("title", q, "bst"), lambda b, found: found is not None and found.isbn == b.isbn)
+    run("author index", authors, library.author_search, lambda a, found: any(b.author == a for b in found))
+    run("linear author scan", authors[:scans], library.linear_author_search,
+        lambda a, found: any(b.author == a for b in found))
+
+
+def bench_instrumentation(n, lookups=10000, repeats=5, seed=42):
+    # The same lookups with the hot-path counters off and on; best of repeats
+    library = LibrarySystem(samples=False)
+    library.load_books(catalog(n, "random", seed))
+    library.build_indexes()
+    view = library.view
+    rng = random.Random(seed)
+    rows = [rng.randrange(n) for _ in range(lookups)]
+    titles = [view.books.title(row) for row in rows]
+    isbns = [view.books.isbn(row) for row in rows]
+    authors = [view.books.author(row) for row in rows]
+    workloads = {
+        "BST search": lambda: [view.title_bst.search(title, view.visible) for title in titles],
+        "hash search": lambda: [view.isbn_hash.search(isbn, view.visible) for isbn in isbns],
+        "author search": lambda: [library.author_search(author) for author in authors],
+    }
+    print(f"Instrumentation overhead, n={n:,}, {lookups:,} lookups each")
+    enabled = METRICS.enabled
+    try:
+        for label, run in workloads.items():
+            timings = {}
+            for state in (False, True):
+                METRICS.enabled = state
+                best = float("inf")
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    run()
+                    best = min(best, time.perf_counter() - start)
+                timings[state] = best / lookups * 1e6
+            print(f"  {label}: {timings[False]:.2f} us off, {timings[True]:.2f} us on "
+                  f"(+{(timings[True] / timings[False] - 1):.0%})")
+        report = library.metrics()
+        start = time.perf_counter()
+        text = prometheus_text(report)
+        print(f"  report of {len(report['histograms'])} histograms and {len(report['gauges'])} gauges: "
+              f"{len(text):,} bytes of Prometheus text in {(time.perf_counter() - start) * 1e3:.2f} ms")
+    finally:
+        METRICS.enabled = enabled
+        METRICS.reset()
+
+
+def run_index_benchmarks(sizes, lookups):
+    bench_wal()
+    bench_search_log()
+    print()
+    for size in sizes:
+        bench_bst(size, lookups)
+        bench_hash(size, lookups)
+        bench_trie(size, lookups)
+        bench_fuzzy(size, min(lookups, 1000))
+        bench_bulk_load(size)
+        bench_snapshot(size, lookups)
+        bench_memory(size)
+        bench_query_cache(size)
+        bench_mixed_workload(size)
+        bench_normalization(size, lookups)
+        bench_instrumentation(size, lookups)
+        print()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless library benchmarks")
+    commands = parser.add_subparsers(dest="command")
+
+    search = commands.add_parser("search", help="end-to-end search latency per index (default)")
+    search.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    search.add_argument("--distributions", nargs="+", choices=DISTRIBUTIONS, default=list(DISTRIBUTIONS))
+    search.add_argument("--queries", type=int, default=200)
+    search.add_argument("--warmup", type=int, default=1)
+    search.add_argument("--repeats", type=int, default=5)
+    search.add_argument("--json", default=BENCHMARK_RESULTS, help="where to write the JSON report")
+
+    http = commands.add_parser("http", help="throughput of the HTTP search API under local load")
+    http.add_argument("--size", type=int, default=100000)
+    http.add_argument("--clients", type=int, nargs="+", default=[1, 8, 64])
+    http.add_argument("--requests", type=int, default=300, help="requests per client")
+
+    concurrency = commands.add_parser("concurrency", help="reader throughput during a bulk import")
+    concurrency.add_argument("--size", type=int, default=100000, help="books imported while reading")
+    concurrency.add_argument("--readers", type=int, default=8)
+
+    fulltext = commands.add_parser("fulltext", help="PDF full-text indexing and query latency")
+    fulltext.add_argument("--docs", type=int, default=2000)
+    fulltext.add_argument("--words", type=int, default=3000, help="words per PDF")
+
+    shards = commands.add_parser("shards", help="build time and query throughput across shard processes")
+    shards.add_argument("--size", type=int, default=100000)
+    shards.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+
+    responsiveness = commands.add_parser("responsiveness", help="frame times while a slow search runs")
+    responsiveness.add_argument("--size", type=int, default=300000)
+
+    startup = commands.add_parser("startup", help="import, catalog open and first-query times")
+    startup.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+
+    indexes = commands.add_parser("indexes", help="micro-benchmarks of the individual structures")
+    indexes.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    indexes.add_argument("--lookups", type=int, default=10000)
+
+    args = parser.parse_args()
+    if args.command == "indexes":
+        run_index_benchmarks(args.sizes, args.lookups)
+    elif args.command == "concurrency":
+        bench_concurrent_reads(args.size, readers=args.readers)
+    elif args.command == "fulltext":
+        bench_fulltext(args.docs, args.words)
+    elif args.command == "shards":
+        bench_shards(args.size, args.shards)
+    elif args.command == "responsiveness":
+        bench_responsiveness(args.size)
+    elif args.command == "startup":
+        bench_startup(args.sizes)
+    elif args.command == "http":
+        bench_http(args.size, args.clients, args.requests)
+    else:
+        if args.command is None:
+            args = search.parse_args([])
+        report = run_search_benchmark(args.sizes, args.distributions, args.queries,
+                                      args.warmup, args.repeats)
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.json}")
@@ -1,8 +1,30 @@
-import tkinter as tk
-from tkinter import ttk, messagebox
-from PIL import Image, ImageTk
-from collections import defaultdict
 import time
+STARTUP_BEGAN = time.perf_counter()  # For the startup timing report
+
+import tkinter as tk
+import tkinter.font as tkfont
+from tkinter import ttk, messagebox, filedialog
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from array import array
+from hashlib import blake2b
+from operator import attrgetter, itemgetter
+import argparse
+import bisect
+import heapq
+import itertools
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import unicodedata
+import zlib
+# asyncio, csv, concurrent.futures, multiprocessing and urllib.parse are
+# imported where they are used; asyncio alone costs more to import than the rest of this module
+
+IMPORTS_DONE = time.perf_counter()
 
 # Bright Color Palette
 BG_COLOR = "#f0f4f7"        # Light blue-gray
@@ -12,7 +34,19 @@ ACCENT_COLOR = "#ff9f1c"    # Orange
 TEXT_COLOR = "#1c2541"      # Dark blue
 ENTRY_COLOR = "#ffffff"     # White
 
+SUGGEST_DELAY_MS = 120      # Debounce for search-box autocomplete
+SEARCH_POLL_MS = 30         # How often the UI checks on a running search
+SEARCH_WORKERS = 2
+CATALOG_SNAPSHOT = "catalog.snap"
+CATALOG_LOG = "catalog.log"
+BENCHMARK_RESULTS = "benchmark.json"  # Written by `python benchmark.py search`
+COMPACT_AFTER = 10000       # Logged catalog changes before a background compaction
+SEARCH_LOG_SIZE = 10000     # Searches kept in the in-memory log
+QUERY_CACHE_SIZE = 1024     # Cached search results
+
 class Book:
+    __slots__ = ('title', 'author', 'isbn', 'pdf_path')
+
     def __init__(self, title, author, isbn, pdf_path):
         self.title = title
         self.author = author
@@ -20,85 +54,2170 @@ class Book:
         self.pdf_path = pdf_path
 
 class BSTNode:
-    def __init__(self, book, key_func):
-        self.book = book
-        self.key = key_func(book)
+    __slots__ = ('value', 'key', 'left', 'right', 'height')
+
+    def __init__(self, value, key):
+        self.value = value
+        self.key = key
         self.left = None
         self.right = None
+        self.height = 1
+
+    def copy(self):
+        node = BSTNode(self.value, self.key)
+        node.left, node.right, node.height = self.left, self.right, self.height
+        return node
 
+# Self-balancing (AVL) tree with iterative insert, delete and search
+# Values may be Books or catalog row ids; resolve maps a stored value to
+# what searches return. Keys are stored normalized (keys passed to insert
+# and build already are), so lookups compare them as they are. Inserts and deletes copy the nodes on their path
+# (and any node a rotation moves) instead of modifying them, so a reader
+# that started on the old root keeps a consistent tree while a writer
+# publishes the new one.
 class BST:
-    def __init__(self, key_func):
+    def __init__(self, key_func, resolve=None, name='bst'):
         self.root = None
         self.key_func = key_func
+        self.resolve = resolve
+        self.name = name
+        self.count = 0
 
-    def insert(self, book):
-        key = self.key_func(book)
+    def __len__(self):
+        return self.count
+
+    def height(self):
+        return self.root.height if self.root else 0
+
+    def insert(self, value, key=None):
+        new_node = BSTNode(value, index_key(self.key_func(value)) if key is None else key)
+        self.count += 1
         if not self.root:
-            self.root = BSTNode(book, self.key_func)
+            self.root = new_node
+            return
+
+        path = []
+        node = self.root
+        while node:
+            copy = node.copy()
+            if path:
+                if path[-1].left is node:
+                    path[-1].left = copy
+                else:
+                    path[-1].right = copy
+            path.append(copy)
+            node = node.left if new_node.key < node.key else node.right
+
+        parent = path[-1]
+        if new_node.key < parent.key:
+            parent.left = new_node
         else:
-            self._insert(book, self.root, key)
+            parent.right = new_node
+        self.root = self._rebalance_path(path)
 
-    def _insert(self, book, node, key):
-        if key < node.key:
-            if node.left:
-                self._insert(book, node.left, key)
+    def search(self, search_key, accept=None):
+        # accept filters stored values, e.g. rows not yet visible to a reader
+        search_key = index_key(search_key)
+        found = None
+        visited = 0
+        node = self.root
+        while node:
+            visited += 1
+            if search_key == node.key:
+                if accept is None or accept(node.value):
+                    found = node
+                    break
+                # Deletes and rotations can leave other copies of the key on
+                # either side, so check them all
+                for match in self._iter_nodes(search_key, search_key):
+                    visited += 1
+                    if accept(match.value):
+                        found = match
+                        break
+                break
+            elif search_key < node.key:
+                node = node.left
             else:
-                node.left = BSTNode(book, self.key_func)
+                node = node.right
+        if METRICS.enabled:
+            METRICS.observe('bst_nodes_visited', visited, index=self.name)
+        if found is None:
+            return None
+        return self.resolve(found.value) if self.resolve else found.value
+
+    def delete(self, key, value):
+        # Removes the node holding exactly (key, value); False if there is none
+        path = self._path_to(index_key(key), value)
+        if path is None:
+            return False
+        copies = []
+        for node in path:
+            copy = node.copy()
+            if copies:
+                if copies[-1].left is node:
+                    copies[-1].left = copy
+                else:
+                    copies[-1].right = copy
+            copies.append(copy)
+
+        target = copies[-1]
+        if target.left and target.right:
+            # Two children: take over the in-order successor and unlink that instead
+            node = target.right
+            while node:
+                copy = node.copy()
+                if copies[-1] is target:
+                    copies[-1].right = copy
+                else:
+                    copies[-1].left = copy
+                copies.append(copy)
+                node = node.left
+            successor = copies[-1]
+            target.value, target.key = successor.value, successor.key
+            target = successor
+
+        child = target.left or target.right
+        self.count -= 1
+        if len(copies) == 1:
+            self.root = child
+            return True
+        parent = copies[-2]
+        if parent.left is target:
+            parent.left = child
         else:
-            if node.right:
-                self._insert(book, node.right, key)
-            else:
-                node.right = BSTNode(book, self.key_func)
+            parent.right = child
+        self.root = self._rebalance_path(copies[:-1], copy=True)
+        return True
+
+    def _path_to(self, key, value):
+        # Root-to-node path of (key, value); equal keys may sit on both sides
+        stack = [(self.root, [])]
+        while stack:
+            node, path = stack.pop()
+            while node:
+                path = path + [node]
+                if key < node.key:
+                    node = node.left
+                elif node.key < key:
+                    node = node.right
+                elif node.value == value:
+                    return path
+                else:
+                    stack.append((node.right, path))
+                    node = node.left
+        return None
+
+    def __iter__(self):
+        return self.iter_range()
+
+    def iter_range(self, low=None, high=None, accept=None):
+        # Lazy in-order scan of books with low <= key <= high (None = unbounded)
+        for node in self._iter_nodes(index_key(low), index_key(high)):
+            if accept is None or accept(node.value):
+                yield self.resolve(node.value) if self.resolve else node.value
+
+    def prefix(self, key, limit=None, accept=None):
+        key = normalize_key(key)
+        found = 0
+        for node in self._iter_nodes(key, None):
+            if limit is not None and found >= limit:
+                return
+            if not node.key.startswith(key):
+                return
+            if accept is not None and not accept(node.value):
+                continue
+            found += 1
+            yield self.resolve(node.value) if self.resolve else node.value
 
-    def search(self, search_key):
-        search_key = search_key.lower() if isinstance(search_key, str) else search_key
-        return self._search(self.root, search_key)
+    def _iter_nodes(self, low, high):
+        # Bounds are normalized keys
+        stack = []
+        node = self.root
+        while stack or node:
+            while node:
+                if low is not None and node.key < low:
+                    node = node.right
+                else:
+                    stack.append(node)
+                    node = node.left
+            if not stack:
+                return
+            node = stack.pop()
+            if high is not None and node.key > high:
+                return
+            yield node
+            node = node.right
 
-    def _search(self, node, search_key):
-        if not node:
+    def build(self, values, keys=None):
+        # Bulk load: merge the sorted new keys with copies of the existing
+        # in-order nodes and build a perfectly balanced tree bottom-up in O(n)
+        key_of = attrgetter('key')
+        if keys is None:
+            keys = (index_key(self.key_func(value)) for value in values)
+        new_nodes = sorted(map(BSTNode, values, keys), key=key_of)
+        old_nodes = (BSTNode(node.value, node.key) for node in self._iter_nodes(None, None))
+        nodes = list(heapq.merge(old_nodes, new_nodes, key=key_of))
+        self.root = self._build_balanced(nodes, 0, len(nodes) - 1)
+        self.count = len(nodes)
+
+    def _build_balanced(self, nodes, lo, hi):
+        if lo > hi:
             return None
-        node_key = node.key.lower() if isinstance(node.key, str) else node.key
-        if search_key == node_key:
-            return node.book
-        elif search_key < node_key:
-            return self._search(node.left, search_key)
-        else:
-            return self._search(node.right, search_key)
+        mid = (lo + hi) // 2
+        node = nodes[mid]
+        node.left = self._build_balanced(nodes, lo, mid - 1)
+        node.right = self._build_balanced(nodes, mid + 1, hi)
+        self._update_height(node)
+        return node
+
+    def _rebalance_path(self, path, copy=False):
+        # Walk back up from the changed leaf, fixing heights and rotating
+        # where needed; returns the new root. After an insert every node
+        # touched by a rotation lies on the (already copied) path; after a
+        # delete the rotations pull up the other side, so copy says to copy
+        # those nodes first.
+        root = path[0]
+        for i in range(len(path) - 1, -1, -1):
+            node = path[i]
+            old_height = node.height
+            subtree = self._rebalance(node, copy)
+            if i == 0:
+                root = subtree
+            elif path[i - 1].left is node:
+                path[i - 1].left = subtree
+            else:
+                path[i - 1].right = subtree
+            if subtree is node and node.height == old_height:
+                break
+        return root
+
+    @staticmethod
+    def _height(node):
+        return node.height if node else 0
+
+    def _update_height(self, node):
+        node.height = 1 + max(self._height(node.left), self._height(node.right))
+
+    def _rotate_left(self, node):
+        pivot = node.right
+        node.right = pivot.left
+        pivot.left = node
+        self._update_height(node)
+        self._update_height(pivot)
+        return pivot
+
+    def _rotate_right(self, node):
+        pivot = node.left
+        node.left = pivot.right
+        pivot.right = node
+        self._update_height(node)
+        self._update_height(pivot)
+        return pivot
+
+    def _rebalance(self, node, copy=False):
+        self._update_height(node)
+        balance = self._height(node.left) - self._height(node.right)
+        if balance > 1:
+            if copy:
+                node.left = node.left.copy()
+            if self._height(node.left.left) < self._height(node.left.right):
+                if copy:
+                    node.left.right = node.left.right.copy()
+                node.left = self._rotate_left(node.left)
+            return self._rotate_right(node)
+        if balance < -1:
+            if copy:
+                node.right = node.right.copy()
+            if self._height(node.right.right) < self._height(node.right.left):
+                if copy:
+                    node.right.left = node.right.left.copy()
+                node.right = self._rotate_right(node.right)
+            return self._rotate_left(node)
+        return node
+
+# Open-addressing hash table: a compact slot array of entry numbers that
+# points into dense arrays of cached hashes, normalized keys and values.
+# Keys passed to insert must already be normalized; the others are
+# normalized here, once per call.
+# A single writer may run alongside readers: entries are appended before
+# their slot is set, and a resize or compaction publishes all four arrays
+# as one tuple. Deletes leave a tombstone in the value array; once they
+# make up a quarter of the entries the table is rebuilt without them.
+EMPTY_SLOT = -1
+DELETED = object()
 
 class HashTable:
-    def __init__(self, key_func, size=100):
-        self.size = size
-        self.table = [[] for _ in range(size)]
+    def __init__(self, key_func, size=100, max_load=0.66, resolve=None, name='hash'):
         self.key_func = key_func
+        self.resolve = resolve
+        self.name = name
+        self.max_load = max_load
+        self.size = self._capacity_for(size)
+        self.count = 0
+        self.tombstones = 0
+        self.resizes = 0
+        self.compactions = 0
+        # (slots, hashes, keys, values)
+        self._arrays = (array('q', [EMPTY_SLOT]) * self.size, array('q'), [], [])
+
+    def __len__(self):
+        return self.count
+
+    @staticmethod
+    def _capacity_for(size):
+        capacity = 8
+        while capacity < size:
+            capacity *= 2
+        return capacity
+
+    def load_factor(self):
+        return self.count / self.size
+
+    def reserve(self, entries):
+        needed = self._capacity_for(int((entries + self.tombstones) / self.max_load) + 1)
+        if needed > self.size:
+            self._resize(needed)
+
+    def _resize(self, new_size):
+        self.resizes += 1
+        self._rebuild(new_size)
+
+    def compact(self):
+        self.compactions += 1
+        self._rebuild(self.size)
+
+    def _rebuild(self, new_size):
+        # Re-slots the live entries into fresh arrays, dropping tombstones
+        _, old_hashes, old_keys, old_values = self._arrays
+        mask = new_size - 1
+        slots = array('q', [EMPTY_SLOT]) * new_size
+        hashes, keys, values = array('q'), [], []
+        for h, key, value in zip(old_hashes, old_keys, old_values):
+            if value is DELETED:
+                continue
+            i = h & mask
+            perturb = h & 0xFFFFFFFFFFFFFFFF
+            while slots[i] != EMPTY_SLOT:
+                perturb >>= 5
+                i = (i * 5 + perturb + 1) & mask
+            slots[i] = len(values)
+            hashes.append(h)
+            keys.append(key)
+            values.append(value)
+        self.size = new_size
+        self.tombstones = 0
+        self._arrays = (slots, hashes, keys, values)
+
+    def insert(self, value, key=None):
+        if self.count + self.tombstones + 1 > self.size * self.max_load:
+            if self.tombstones > self.count // 2:
+                self.compact()
+            else:
+                self._resize(self.size * 2)
+        if key is None:
+            key = index_key(self.key_func(value))
+        h = hash(key)
+        slots, hashes, keys, values = self._arrays
+        mask = len(slots) - 1
+        i = h & mask
+        perturb = h & 0xFFFFFFFFFFFFFFFF
+        while slots[i] != EMPTY_SLOT:
+            perturb >>= 5
+            i = (i * 5 + perturb + 1) & mask
+        hashes.append(h)
+        keys.append(key)
+        values.append(value)
+        slots[i] = len(values) - 1
+        self.count += 1
+
+    def _entry_of(self, key, accept=None):
+        h = hash(key)
+        slots, hashes, keys, values = self._arrays
+        mask = len(slots) - 1
+        i = h & mask
+        perturb = h & 0xFFFFFFFFFFFFFFFF
+        probes = 1
+        while True:
+            entry = slots[i]
+            if entry == EMPTY_SLOT:
+                return None, values, probes
+            if hashes[entry] == h and keys[entry] == key:
+                value = values[entry]
+                if value is not DELETED and (accept is None or accept(value)):
+                    return entry, values, probes
+            perturb >>= 5
+            i = (i * 5 + perturb + 1) & mask
+            probes += 1
+
+    def find_value(self, search_key, accept=None):
+        # The stored value itself, without resolve
+        entry, values, probes = self._entry_of(index_key(search_key), accept)
+        if METRICS.enabled:
+            METRICS.observe('hash_probes', probes, index=self.name)
+        return None if entry is None else values[entry]
+
+    def search(self, search_key, accept=None):
+        value = self.find_value(search_key, accept)
+        if value is None or not self.resolve:
+            return value
+        return self.resolve(value)
+
+    def delete(self, key, value):
+        entry, values, _ = self._entry_of(index_key(key), lambda v: v == value)
+        if entry is None:
+            return False
+        values[entry] = DELETED
+        self.count -= 1
+        self.tombstones += 1
+        if self.tombstones * 4 > self.count + self.tombstones:
+            self.compact()
+        return True
+
+    def _probe_length(self, entry):
+        slots, hashes, _, _ = self._arrays
+        h = hashes[entry]
+        mask = len(slots) - 1
+        i = h & mask
+        perturb = h & 0xFFFFFFFFFFFFFFFF
+        probes = 1
+        while slots[i] != entry:
+            perturb >>= 5
+            i = (i * 5 + perturb + 1) & mask
+            probes += 1
+        return probes
+
+    def stats(self):
+        values = self._arrays[3]
+        probes = [self._probe_length(entry) for entry in range(len(values)) if values[entry] is not DELETED]
+        return {
+            'entries': self.count,
+            'capacity': self.size,
+            'load_factor': self.load_factor(),
+            'resizes': self.resizes,
+            'tombstones': self.tombstones,
+            'compactions': self.compactions,
+            'avg_probe': sum(probes) / len(probes) if probes else 0.0,
+            'max_probe': max(probes, default=0),
+        }
+
+# Compressed trie (radix tree) for autocomplete. Every node caches the
+# top-k completions of its subtree, so a lookup only walks the prefix.
+# Edge splits and top-k updates build new nodes and lists and then link
+# them in, so concurrent readers never see a half-changed node. A key's
+# value is one of the rows holding it; weight counts them all.
+class RadixNode:
+    __slots__ = ('label', 'children', 'weight', 'value', 'top')
+
+    def __init__(self, label=''):
+        self.label = label
+        self.children = {}
+        self.weight = 0
+        self.value = None
+        self.top = []
+
+class RadixTrie:
+    def __init__(self, top_k=10, resolve=None):
+        self.root = RadixNode()
+        self.top_k = top_k
+        self.resolve = resolve
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, key, value, update_top=True):
+        if not key:
+            return
+        node = self.root
+        path = [node]
+        rest = key
+        while rest:
+            child = node.children.get(rest[0])
+            if child is None:
+                child = RadixNode(rest)
+                node.children[rest[0]] = child
+                path.append(child)
+                node = child
+                break
+            label = child.label
+            common = 0
+            limit = min(len(label), len(rest))
+            while common < limit and label[common] == rest[common]:
+                common += 1
+            if common < len(label):
+                # Split the edge so the shared part gets its own node
+                middle = RadixNode(label[:common])
+                middle.top = child.top
+                tail = RadixNode(label[common:])
+                tail.children, tail.weight = child.children, child.weight
+                tail.value, tail.top = child.value, child.top
+                middle.children[tail.label[0]] = tail
+                node.children[rest[0]] = middle
+                child = middle
+            path.append(child)
+            node = child
+            rest = rest[common:]
+
+        if node.weight == 0:
+            self.count += 1
+        if node.value is None:
+            node.value = value
+        node.weight += 1
+        if update_top:
+            entry = (-node.weight, key, node.value)
+            for n in path:
+                self._offer(n, key, entry)
+
+    def insert_many(self, items):
+        # Insert (key, value) pairs, then recompute every top-k list in one pass
+        for key, value in items:
+            self.insert(key, value, update_top=False)
+        self._rebuild_top()
+
+    def _rebuild_top(self):
+        stack = [(self.root, '', False)]
+        while stack:
+            node, key, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, key, True))
+                for child in node.children.values():
+                    stack.append((child, key + child.label, False))
+                continue
+            candidates = [entry for child in node.children.values() for entry in child.top]
+            if node.weight:
+                candidates.append((-node.weight, key, node.value))
+            node.top = heapq.nsmallest(self.top_k, candidates)
+
+    def remove(self, key, value, replacement=None):
+        # Drops one row holding key; replacement is another row with the same
+        # key, used if value was the one shown
+        node = self.root
+        path = [(node, '')]
+        rest = key
+        while rest:
+            child = node.children.get(rest[0])
+            if child is None or not rest.startswith(child.label):
+                return False
+            rest = rest[len(child.label):]
+            node = child
+            path.append((node, path[-1][1] + node.label))
+        if node.weight == 0:
+            return False
+        node.weight -= 1
+        if node.weight == 0:
+            self.count -= 1
+            node.value = None
+        elif node.value == value:
+            node.value = replacement
+        for n, n_key in reversed(path):
+            # A key outside this node's top-k is outside every ancestor's too
+            if n is not node and all(item[1] != key for item in n.top):
+                break
+            candidates = [entry for child in n.children.values() for entry in child.top]
+            if n.weight and n.value is not None:
+                candidates.append((-n.weight, n_key, n.value))
+            n.top = heapq.nsmallest(self.top_k, candidates)
+        return True
+
+    def _offer(self, node, key, entry):
+        top = [item for item in node.top if item[1] != key]
+        bisect.insort(top, entry)
+        node.top = top[:self.top_k]
+
+    def complete(self, prefix, k=None, accept=None):
+        node = self.root
+        rest = prefix
+        while rest:
+            child = node.children.get(rest[0])
+            if child is None:
+                return []
+            label = child.label
+            if len(rest) <= len(label):
+                if not label.startswith(rest):
+                    return []
+                node = child
+                break
+            if not rest.startswith(label):
+                return []
+            rest = rest[len(label):]
+            node = child
+        values = [value for _, _, value in node.top
+                  if value is not None and (accept is None or accept(value))][:k]
+        if self.resolve:
+            return [self.resolve(value) for value in values]
+        return values
+
+# Ethiopic syllables come in rows of eight vowel orders of one consonant
+ETHIOPIC_START, ETHIOPIC_END = 0x1200, 0x135A
+
+def ethiopic_family(ch):
+    cp = ord(ch)
+    if ETHIOPIC_START <= cp <= ETHIOPIC_END:
+        return ETHIOPIC_START + (cp - ETHIOPIC_START) // 8 * 8
+    return cp
+
+ETHIOPIC_FOLD = {cp: ETHIOPIC_START + (cp - ETHIOPIC_START) // 8 * 8
+                 for cp in range(ETHIOPIC_START, ETHIOPIC_END + 1)}
+
+def fold_ethiopic(text):
+    return text.translate(ETHIOPIC_FOLD)
+
+# Consonant rows that modern Amharic spells interchangeably, mapped order by
+# order onto one row: ሐ and ኀ to ሀ, ሠ to ሰ, ዐ to አ and ፀ to ጸ
+ETHIOPIC_HOMOPHONES = {source + order: target + order
+                       for source, target in ((0x1210, 0x1200), (0x1280, 0x1200), (0x1220, 0x1230),
+                                              (0x12D0, 0x12A0), (0x1340, 0x1338))
+                       for order in range(8)}
+
+def normalize_key(text):
+    # The canonical form every index stores and every query is compared in:
+    # case-folded, NFC, Ethiopic homophones folded. Books are normalized once
+    # when indexed and queries once per search, never per comparison.
+    # Folding before composing makes normalize_key(normalize_key(s)) equal
+    # normalize_key(s).
+    if text.isascii():
+        return text.lower()
+    return unicodedata.normalize('NFC', text.casefold()).translate(ETHIOPIC_HOMOPHONES)
+
+def index_key(key):
+    return normalize_key(key) if isinstance(key, str) else key
+
+def edit_distance(a, b):
+    # Levenshtein distance; swapping vowel orders of the same consonant costs half
+    previous = [float(j) for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, 1):
+        current = [float(i)]
+        for j, cb in enumerate(b, 1):
+            if ca == cb:
+                cost = 0.0
+            elif ETHIOPIC_START <= ord(ca) <= ETHIOPIC_END and ethiopic_family(ca) == ethiopic_family(cb):
+                cost = 0.5
+            else:
+                cost = 1.0
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost))
+        previous = current
+    return previous[-1]
+
+def ngrams(key, n=3):
+    padded = f" {fold_ethiopic(key)} "
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+# Character n-gram inverted index for typo-tolerant search. Posting lists
+# are sorted arrays of key ids; candidates come from the rarest grams only
+# and just the best-scoring few are checked with edit_distance. Values are
+# integer ids (catalog rows). Keys and values are stored before a key id is
+# added to any posting list, so readers can search during inserts; a remove
+# swaps in a new value array and leaves the key's postings in place.
+class FuzzyIndex:
+    def __init__(self, n=3, max_edits=2, candidates=50, resolve=None):
+        self.resolve = resolve
+        self.n = n
+        self.max_edits = max_edits
+        self.candidates = candidates
+        self.postings = {}
+        self.key_ids = {}
+        self.keys = []
+        self.values = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _grams(self, key):
+        return ngrams(key, self.n)
+
+    def insert(self, key, value):
+        if not key:
+            return
+        key_id = self.key_ids.get(key)
+        if key_id is not None:
+            self.values[key_id].append(value)
+            return
+        key_id = len(self.keys)
+        self.key_ids[key] = key_id
+        self.keys.append(key)
+        self.values.append(array('i', [value]))
+        for gram in self._grams(key):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array('i')
+            posting.append(key_id)
+
+    def remove(self, key, value):
+        key_id = self.key_ids.get(key)
+        if key_id is None or value not in self.values[key_id]:
+            return False
+        self.values[key_id] = array('i', (v for v in self.values[key_id] if v != value))
+        return True
+
+    def search(self, query, limit=10, accept=None, scored=False):
+        # scored=True returns (edit distance, value) pairs
+        if not query:
+            return []
+        grams = sorted(self._grams(query), key=lambda g: len(self.postings.get(g, ())))
+        # A key within max_edits edits shares all but max_edits * n grams with
+        # the query, so it must appear in one of the rarest max_edits * n + 1
+        scores = defaultdict(int)
+        for gram in grams[:self.max_edits * self.n + 1]:
+            for key_id in self.postings.get(gram, ()):
+                scores[key_id] += 1
+        for gram in grams[self.max_edits * self.n + 1:]:
+            posting = self.postings.get(gram)
+            if not posting:
+                continue
+            if len(posting) <= len(scores) * 8:
+                for key_id in posting:
+                    if key_id in scores:
+                        scores[key_id] += 1
+            else:
+                for key_id in scores:
+                    i = bisect.bisect_left(posting, key_id)
+                    if i < len(posting) and posting[i] == key_id:
+                        scores[key_id] += 1
+
+        shortlist = heapq.nlargest(self.candidates, scores.items(), key=lambda item: item[1])
+        ranked = sorted((edit_distance(query, self.keys[key_id]), -shared, key_id)
+                        for key_id, shared in shortlist)
+        results = []
+        seen = set()
+        for distance, _, key_id in ranked:
+            for value in self.values[key_id]:
+                if value not in seen and (accept is None or accept(value)):
+                    seen.add(value)
+                    found = self.resolve(value) if self.resolve else value
+                    results.append((distance, found) if scored else found)
+                if len(results) >= limit:
+                    return results
+        return results
+
+# UTF-8 strings packed back to back in one bytearray, with an offset array
+class StringColumn:
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('Q', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, text):
+        self.append_encoded(text.encode('utf-8'))
+
+    def append_encoded(self, data):
+        self.data += data
+        self.offsets.append(len(self.data))
+
+    def truncate(self, count):
+        del self.data[self.offsets[count]:]
+        del self.offsets[count + 1:]
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+# Columnar catalog storage. Books live here as integer row ids; titles,
+# ISBNs and PDF paths are packed string columns and authors are
+# dictionary-encoded, so each distinct author string is stored once, and
+# normalized once, when it is first seen.
+class BookStore:
+    def __init__(self):
+        self.titles = StringColumn()
+        self.isbns = StringColumn()
+        self.pdf_paths = StringColumn()
+        self.author_codes = array('I')
+        self.authors = []
+        self.author_keys = []
+        self._author_ids = {}
+
+    def __len__(self):
+        return len(self.author_codes)
+
+    def __iter__(self):
+        return self.iter_books()
+
+    def append(self, book):
+        # Every field is checked and encoded before any column grows, so a
+        # bad book raises with the columns still aligned
+        fields = (book.title, book.author, book.isbn, book.pdf_path)
+        if not all(isinstance(field, str) for field in fields):
+            raise TypeError(f"book fields must be strings, got {fields!r}")
+        title, _, isbn, pdf_path = (field.encode('utf-8') for field in fields)
+        code = self._author_ids.get(book.author)
+        if code is None:
+            key = normalize_key(book.author)
+            code = self._author_ids[book.author] = len(self.authors)
+            self.authors.append(book.author)
+            self.author_keys.append(key)
+        self.titles.append_encoded(title)
+        self.isbns.append_encoded(isbn)
+        self.pdf_paths.append_encoded(pdf_path)
+        self.author_codes.append(code)
+        return len(self.author_codes) - 1
+
+    def truncate(self, count):
+        # Drops rows from count on; only for rows no view has published
+        for column in (self.titles, self.isbns, self.pdf_paths):
+            column.truncate(count)
+        del self.author_codes[count:]
+
+    def title(self, row):
+        return self.titles[row]
+
+    def author(self, row):
+        return self.authors[self.author_codes[row]]
+
+    def author_key(self, row):
+        return self.author_keys[self.author_codes[row]]
+
+    def isbn(self, row):
+        return self.isbns[row]
+
+    def book(self, row):
+        return Book(self.titles[row], self.authors[self.author_codes[row]],
+                    self.isbns[row], self.pdf_paths[row])
+
+    def iter_books(self, stop=None):
+        for row in range(len(self) if stop is None else stop):
+            yield self.book(row)
+
+def read_catalog(path):
+    # Streams Book records from a CSV (title,author,isbn,pdf_path header) or
+    # JSONL file. Every record is checked before it is yielded, so a bad line
+    # raises ValueError naming it before anything reaches the log or the store.
+    # utf-8-sig drops the byte-order mark Excel and registrar exports start with
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if path.lower().endswith(('.jsonl', '.ndjson')):
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                    except ValueError as e:
+                        raise ValueError(f"{path}, line {number}: {e}") from None
+                    yield catalog_book(record, f"{path}, line {number}")
+        else:
+            import csv
+            reader = csv.DictReader(f)
+            for row in reader:
+                yield catalog_book(row, f"{path}, line {reader.line_num}")
+
+def catalog_book(record, where):
+    # title, author and isbn are required; pdf_path may be left out
+    if not isinstance(record, dict):
+        raise ValueError(f"{where}: expected a record, got {type(record).__name__}")
+    fields = []
+    for name in ('title', 'author', 'isbn', 'pdf_path'):
+        value = record.get(name, '' if name == 'pdf_path' else None)
+        if value is None:
+            raise ValueError(f"{where}: missing {name}")
+        if isinstance(value, (dict, list)):
+            raise ValueError(f"{where}: {name} must be a string or number")
+        fields.append(str(value))
+    return Book(*fields)
+
+def book_dict(book):
+    return {'title': book.title, 'author': book.author, 'isbn': book.isbn, 'pdf_path': book.pdf_path}
+
+def book_record(book):
+    return dict(book_dict(book), op='add_book')
+
+# Append-only JSON-lines log of catalog mutations and search events.
+# Records are buffered and written in groups of at most group_size that
+# share one fsync, by a background thread every flush_interval seconds or
+# as soon as a group fills. Appenders only hold _lock to number and buffer
+# a record; the write, the fsync and compaction's rewrite run under
+# _io_lock, so a search being logged never waits on the disk. Catalog
+# changes wait(seq) for theirs: a waiter commits the groups up to its
+# record itself, and writers queued behind it find theirs already written.
+class WriteAheadLog:
+    def __init__(self, path, group_size=64, flush_interval=0.05, start_seq=0):
+        self.path = path
+        self.group_size = group_size
+        self.flush_interval = flush_interval
+        self.seq = start_seq
+        self.durable = start_seq      # Last sequence number fsynced
+        self.commits = 0
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._file = open(path, 'ab')
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    @staticmethod
+    def read(path):
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            for line in f:
+                # A torn final record from a crash ends the replay
+                if not line.endswith(b'\n'):
+                    return
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    return
+
+    def append(self, record):
+        return self.append_many([record])
+
+    def append_many(self, records):
+        with self._lock:
+            for record in records:
+                self.seq += 1
+                record['seq'] = self.seq
+                self._pending.append(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+            if len(self._pending) >= self.group_size:
+                self._wake.set()
+            return self.seq
+
+    def wait(self, seq):
+        # Returns once record seq is on disk
+        if self.durable >= seq:
+            return
+        with self._io_lock:
+            while self.durable < seq and self._commit_group():
+                pass
+
+    def flush(self):
+        with self._io_lock:
+            self._commit()
+
+    def _commit(self):
+        while self._commit_group():
+            pass
+
+    def _commit_group(self):
+        # Caller holds _io_lock, so groups reach the file in sequence order
+        with self._lock:
+            pending = self._pending
+            group = [pending.popleft() for _ in range(min(self.group_size, len(pending)))]
+            last = self.seq - len(pending)
+        if not group:
+            return False
+        self._file.write(b''.join(group))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.commits += 1
+        self.durable = last
+        return True
 
-    def _hash(self, key):
-        return hash(key) % self.size
-
-    def insert(self, book):
-        key = self.key_func(book)
-        index = self._hash(key)
-        self.table[index].append(book)
-
-    def search(self, search_key):
-        search_key = search_key.lower() if isinstance(search_key, str) else search_key
-        index = self._hash(search_key)
-        for book in self.table[index]:
-            key = self.key_func(book)
-            key = key.lower() if isinstance(key, str) else key
-            if key == search_key:
-                return book
+    def _flush_loop(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def rewrite(self, keep, first=()):
+        # Compaction: atomically replace the log with the records first
+        # (already numbered) and then those that pass keep(). Appends go on
+        # meanwhile; they are buffered and written to the new file afterwards.
+        with self._io_lock:
+            self._commit()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for record in first:
+                    f.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+                for record in self.read(self.path):
+                    if keep(record):
+                        f.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = open(self.path, 'ab')
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+        self._flusher.join()
+        with self._io_lock:
+            self._commit()
+            self._file.close()
+
+# Binary catalog snapshot, read through mmap. Layout: header (with the last
+# log sequence number it covers), one record per book, a table of record
+# offsets, and for each index a blob of UTF-8 keys followed by fixed-width
+# (key offset, key length, row) entries sorted by key, so lookups
+# binary-search the mapped bytes.
+SNAPSHOT_MAGIC = b'EDLCAT01'
+SNAPSHOT_VERSION = 3          # 3: keys are normalize_key forms; 2 (lowercase keys) is still readable
+SNAPSHOT_HEADER = struct.Struct('<8sIQQQQQQ')
+SNAPSHOT_RECORD = struct.Struct('<IIII')
+SNAPSHOT_ENTRY = struct.Struct('<QII')
+SNAPSHOT_OFFSET = struct.Struct('<Q')
+SNAPSHOT_INDEXES = ('isbn', 'title', 'author')
+
+class CatalogSnapshot:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.count, self.last_seq,
+         self._rows_off, *index_offsets) = SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC or version not in (2, SNAPSHOT_VERSION):
+            self.close()
+            raise ValueError(f"{path} is not a catalog snapshot")
+        self.version = version
+        self._index_off = dict(zip(SNAPSHOT_INDEXES, index_offsets))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for row in range(self.count):
+            yield self.book(row)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    @staticmethod
+    def write(path, books, last_seq=0):
+        keys = {kind: [] for kind in SNAPSHOT_INDEXES}
+        row_offsets = []
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes(SNAPSHOT_HEADER.size))
+            for row, book in enumerate(books):
+                row_offsets.append(f.tell())
+                fields = [value.encode('utf-8') for value in
+                          (book.title, book.author, book.isbn, book.pdf_path)]
+                f.write(SNAPSHOT_RECORD.pack(*map(len, fields)))
+                f.write(b''.join(fields))
+                keys['isbn'].append((normalize_key(book.isbn).encode('utf-8'), row))
+                keys['title'].append((normalize_key(book.title).encode('utf-8'), row))
+                keys['author'].append((normalize_key(book.author).encode('utf-8'), row))
+
+            rows_off = f.tell()
+            f.write(b''.join(SNAPSHOT_OFFSET.pack(offset) for offset in row_offsets))
+
+            index_offsets = []
+            for kind in SNAPSHOT_INDEXES:
+                entries = sorted(keys.pop(kind))
+                packed = []
+                for key, row in entries:
+                    packed.append(SNAPSHOT_ENTRY.pack(f.tell(), len(key), row))
+                    f.write(key)
+                index_offsets.append(f.tell())
+                f.write(b''.join(packed))
+
+            f.seek(0)
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(row_offsets),
+                                         last_seq, rows_off, *index_offsets))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def book(self, row):
+        offset, = SNAPSHOT_OFFSET.unpack_from(self._mm, self._rows_off + row * SNAPSHOT_OFFSET.size)
+        lengths = SNAPSHOT_RECORD.unpack_from(self._mm, offset)
+        offset += SNAPSHOT_RECORD.size
+        fields = []
+        for length in lengths:
+            fields.append(self._mm[offset:offset + length].decode('utf-8'))
+            offset += length
+        return Book(*fields)
+
+    def _entry(self, kind, i):
+        key_off, key_len, row = SNAPSHOT_ENTRY.unpack_from(
+            self._mm, self._index_off[kind] + i * SNAPSHOT_ENTRY.size)
+        return self._mm[key_off:key_off + key_len], row
+
+    def _lower_bound(self, kind, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(kind, mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _rows(self, kind, query, accept=None):
+        # Rows whose key equals query; accept filters rows, e.g. removed ones
+        key = normalize_key(query).encode('utf-8')
+        i = self._lower_bound(kind, key)
+        while i < self.count:
+            entry_key, row = self._entry(kind, i)
+            if entry_key != key:
+                return
+            if accept is None or accept(row):
+                yield row
+            i += 1
+
+    def find_row(self, kind, query, accept=None):
+        return next(self._rows(kind, query, accept), None)
+
+    def find(self, kind, query, accept=None):
+        if kind == 'author':
+            return [self.book(row) for row in self._rows(kind, query, accept)]
+        row = self.find_row(kind, query, accept)
+        return None if row is None else self.book(row)
+
+    def scan(self, kind, low=None, high=None, accept=None):
+        # Lazy in-order scan of books with low <= key <= high
+        i = self._lower_bound(kind, normalize_key(low).encode('utf-8')) if low is not None else 0
+        high = normalize_key(high).encode('utf-8') if high is not None else None
+        while i < self.count:
+            entry_key, row = self._entry(kind, i)
+            if high is not None and entry_key > high:
+                return
+            if accept is None or accept(row):
+                yield self.book(row)
+            i += 1
+
+    def prefix(self, kind, prefix, limit=None, accept=None):
+        key = normalize_key(prefix).encode('utf-8')
+        i = self._lower_bound(kind, key)
+        found = 0
+        while i < self.count and (limit is None or found < limit):
+            entry_key, row = self._entry(kind, i)
+            if not entry_key.startswith(key):
+                return
+            if accept is None or accept(row):
+                yield self.book(row)
+                found += 1
+            i += 1
+
+# Text extraction from PDF files with the standard library alone. Streams
+# are found by their stream/endstream keywords, Flate-compressed ones are
+# inflated with zlib, and the strings shown between BT and ET become the
+# text. Streams with other filters (images) are skipped. Text set in CID
+# fonts needs the font's ToUnicode map and comes out as glyph codes.
+PDF_STREAM = re.compile(rb'(?<!end)stream\r?\n')
+# An indirect length (/Length 15 0 R) does not match; those streams run to endstream
+PDF_LENGTH = re.compile(rb'/Length\s+(\d+)\b(?!\s+\d+\s+R)')
+PDF_TEXT_BLOCK = re.compile(rb'\bBT\b(.*?)\bET\b', re.S)
+PDF_TEXT_OP = re.compile(rb'\[((?:[^\]\\]|\\.)*)\]\s*TJ'
+                         rb'|(\((?:[^()\\]|\\.)*\)|<[0-9A-Fa-f\s]*>)\s*(?:Tj|\'|")', re.S)
+# A TJ array holds strings and kerning numbers in thousandths of an em;
+# typesetters put the gap between words there as a large negative number
+PDF_TJ_ITEM = re.compile(rb'(\((?:[^()\\]|\\.)*\)|<[0-9A-Fa-f\s]*>)|([-+]?(?:\d+\.?\d*|\.\d+))', re.S)
+PDF_WORD_GAP = -200
+PDF_ESCAPE = re.compile(rb'\\([nrtbf()\\]|[0-7]{1,3}|\r?\n)')
+PDF_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f',
+               b'(': b'(', b')': b')', b'\\': b'\\'}
+TERM = re.compile(r'\w{1,64}')
+
+def pdf_string(token):
+    if token[:1] == b'<':
+        digits = re.sub(rb'\s', b'', token[1:-1]).decode('ascii')
+        raw = bytes.fromhex(digits + '0' * (len(digits) % 2))
+    else:
+        def unescape(m):
+            code = m.group(1)
+            if code in PDF_ESCAPES:
+                return PDF_ESCAPES[code]
+            return b'' if code[:1] in b'\r\n' else bytes([int(code, 8) & 0xFF])
+        raw = PDF_ESCAPE.sub(unescape, token[1:-1])
+    if raw.startswith(b'\xfe\xff'):
+        return raw[2:].decode('utf-16-be', 'replace')
+    return raw.decode('latin-1')
+
+def pdf_text(path):
+    # Yields the text of each BT ... ET block, one stream at a time
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        for match in PDF_STREAM.finditer(data):
+            start = match.end()
+            header = data[max(0, match.start() - 1024):match.start()]
+            header = header[header.rfind(b'obj') + 1:]
+            length = PDF_LENGTH.search(header)
+            end = start + int(length.group(1)) if length else data.find(b'endstream', start)
+            if end < start:
+                continue
+            raw = data[start:end]
+            if b'/FlateDecode' in header:
+                try:
+                    raw = zlib.decompressobj().decompress(raw)
+                except zlib.error:
+                    continue
+            elif b'/Filter' in header:
+                continue
+            for block in PDF_TEXT_BLOCK.finditer(raw):
+                parts = []
+                for op in PDF_TEXT_OP.finditer(block.group(1)):
+                    if op.group(1) is not None:
+                        shown = []
+                        for string, number in PDF_TJ_ITEM.findall(op.group(1)):
+                            if string:
+                                shown.append(pdf_string(string))
+                            elif float(number) < PDF_WORD_GAP:
+                                shown.append(' ')
+                        parts.append(''.join(shown))
+                    else:
+                        parts.append(pdf_string(op.group(2)))
+                yield ' '.join(parts)
+
+def pdf_terms(path):
+    # Term frequencies of one PDF (None if it cannot be read); runs in the
+    # indexing processes, so only this small dict crosses back
+    counts = Counter()
+    try:
+        for text in pdf_text(path):
+            counts.update(TERM.findall(normalize_key(text)))
+    except (OSError, ValueError):
         return None
+    return counts
 
-class LibrarySystem:
+def encode_varints(values):
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append(value & 0x7F | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+def decode_varints(data):
+    values = []
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+# One immutable file of the full-text index, read through mmap. Layout:
+# header, document records (term count, PDF mtime and size, ISBN), a blob
+# of postings, then the UTF-8 terms and fixed-width (term offset, term
+# length, postings offset, postings length, document count) entries sorted
+# by term. A posting list is varint-encoded (document id gap, term count)
+# pairs, so common terms cost about two bytes per document.
+FULLTEXT_MAGIC = b'EDLFTS02'  # 02: terms are normalize_key forms
+FULLTEXT_HEADER = struct.Struct('<8sIIQ')
+FULLTEXT_DOC = struct.Struct('<IqQI')
+FULLTEXT_TERM = struct.Struct('<QIQII')
+
+class FullTextSegment:
+    def __init__(self, path):
+        self.path = path
+        self.number = int(os.path.basename(path)[4:-4])
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, doc_count, self.term_count, self._terms_off = FULLTEXT_HEADER.unpack_from(self._mm, 0)
+        if magic != FULLTEXT_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a full-text segment")
+        # (isbn, term count, (mtime, size)) per document id
+        self.docs = []
+        offset = FULLTEXT_HEADER.size
+        for _ in range(doc_count):
+            length, mtime, size, isbn_len = FULLTEXT_DOC.unpack_from(self._mm, offset)
+            offset += FULLTEXT_DOC.size
+            self.docs.append((self._mm[offset:offset + isbn_len].decode('utf-8'), length, (mtime, size)))
+            offset += isbn_len
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    @staticmethod
+    def write(path, docs, postings):
+        # docs: (isbn, term count, (mtime, size)); postings: term -> [(doc, count)]
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(bytes(FULLTEXT_HEADER.size))
+            for isbn, length, (mtime, size) in docs:
+                key = isbn.encode('utf-8')
+                f.write(FULLTEXT_DOC.pack(length, mtime, size, len(key)) + key)
+            entries = []
+            for term in sorted(postings):
+                hits = postings[term]
+                if not hits:
+                    continue
+                pairs = []
+                previous = 0
+                for doc, count in hits:
+                    pairs += (doc - previous, count)
+                    previous = doc
+                offset = f.tell()
+                f.write(encode_varints(pairs))
+                entries.append((term.encode('utf-8'), offset, f.tell() - offset, len(hits)))
+            packed = []
+            for key, offset, length, doc_count in entries:
+                packed.append(FULLTEXT_TERM.pack(f.tell(), len(key), offset, length, doc_count))
+                f.write(key)
+            terms_off = f.tell()
+            f.write(b''.join(packed))
+            f.seek(0)
+            f.write(FULLTEXT_HEADER.pack(FULLTEXT_MAGIC, len(docs), len(entries), terms_off))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _entry(self, i):
+        key_off, key_len, offset, length, doc_count = FULLTEXT_TERM.unpack_from(
+            self._mm, self._terms_off + i * FULLTEXT_TERM.size)
+        return self._mm[key_off:key_off + key_len], offset, length, doc_count
+
+    def _decode(self, offset, length):
+        values = decode_varints(self._mm[offset:offset + length])
+        hits = []
+        doc = 0
+        for i in range(0, len(values), 2):
+            doc += values[i]
+            hits.append((doc, values[i + 1]))
+        return hits
+
+    def postings(self, term):
+        key = term.encode('utf-8')
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.term_count:
+            entry_key, offset, length, _ = self._entry(lo)
+            if entry_key == key:
+                return self._decode(offset, length)
+        return []
+
+    def iter_postings(self):
+        for i in range(self.term_count):
+            key, offset, length, _ = self._entry(i)
+            yield key.decode('utf-8'), self._decode(offset, length)
+
+# Full-text index over the PDFs of the catalog: a directory of segment
+# files, newest last. Indexing only reads PDFs that are new or changed
+# since their last indexing, extracts them in a process pool and writes
+# the results as a new segment; a book's newest document supersedes older
+# ones. Segments are tiered by size in powers of merge_factor, and a tier
+# holding merge_factor segments is merged into one of the next tier, so a
+# one-book segment costs a small merge now and then rather than a rewrite
+# of the whole index, and each document is rewritten about log(corpus)
+# times. Searches rank with BM25 and read just the posting lists of their terms.
+FULLTEXT_INDEX = "fulltext"
+FULLTEXT_SEGMENT_DOCS = 500   # Documents extracted before a segment is written
+FULLTEXT_MERGE_FACTOR = 8
+BM25_K1, BM25_B = 1.2, 0.75
+
+class FullTextIndex:
+    def __init__(self, directory, workers=None, segment_docs=FULLTEXT_SEGMENT_DOCS,
+                 merge_factor=FULLTEXT_MERGE_FACTOR):
+        self.directory = directory
+        self.workers = workers
+        self.segment_docs = segment_docs
+        self.merge_factor = merge_factor
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(directory)
+                       if name.startswith('seg-') and name.endswith('.fts'))
+        segments = []
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                segments.append(FullTextSegment(path))
+            except ValueError:
+                # Older terms would not match today's queries; the PDFs are read again
+                os.remove(path)
+        self._publish(segments)
+
+    def _publish(self, segments):
+        # live maps an ISBN to (segment number, document id) of its newest
+        # document; readers take the whole state tuple at once. Empty
+        # documents only hide older ones and do not count as indexed.
+        live = {}
+        lengths = {}
+        for segment in segments:
+            for doc, (isbn, length, _) in enumerate(segment.docs):
+                live[isbn] = (segment.number, doc)
+                lengths[isbn] = length
+        indexed = sum(1 for length in lengths.values() if length)
+        average = sum(lengths.values()) / indexed if indexed else 0.0
+        self.state = (segments, live, average, indexed)
+
+    def __len__(self):
+        return self.state[3]
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return (0, 0)
+        return (st.st_mtime_ns, st.st_size)
+
+    def update(self, books):
+        # Indexes the books whose PDF is new or changed; returns how many
+        with self._lock:
+            segments, live, _, _ = self.state
+            known = {}
+            for segment in segments:
+                for doc, (isbn, _, stamp) in enumerate(segment.docs):
+                    if live[isbn] == (segment.number, doc):
+                        known[isbn] = stamp
+            todo = []
+            for book in books:
+                if not book.pdf_path:
+                    continue
+                stamp = self._stamp(book.pdf_path)
+                # A vanished PDF is indexed as an empty document, hiding the old one
+                if known.get(book.isbn, (0, 0)) != stamp:
+                    todo.append((book.isbn, book.pdf_path, stamp))
+                    known[book.isbn] = stamp
+            if not todo:
+                return 0
+            paths = [path for _, path, _ in todo]
+            if len(todo) < 4 or self.workers == 1:
+                extracted = map(pdf_terms, paths)
+                pool = None
+            else:
+                from concurrent.futures import ProcessPoolExecutor
+                pool = ProcessPoolExecutor(self.workers)
+                extracted = pool.map(pdf_terms, paths, chunksize=8)
+            try:
+                batch = []
+                for (isbn, _, stamp), counts in zip(todo, extracted):
+                    batch.append((isbn, stamp, counts or {}))
+                    if len(batch) >= self.segment_docs:
+                        segments = self._flush(segments, batch)
+                        batch = []
+                if batch:
+                    segments = self._flush(segments, batch)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+            self._merge_tiers(segments)
+            return len(todo)
+
+    def _path(self, number):
+        return os.path.join(self.directory, f"seg-{number:06d}.fts")
+
+    def _flush(self, segments, batch):
+        docs = []
+        postings = defaultdict(list)
+        for doc, (isbn, stamp, counts) in enumerate(batch):
+            docs.append((isbn, sum(counts.values()), stamp))
+            for term, count in counts.items():
+                postings[term].append((doc, count))
+        path = self._path(segments[-1].number + 1 if segments else 1)
+        FullTextSegment.write(path, docs, postings)
+        segments = segments + [FullTextSegment(path)]
+        self._publish(segments)
+        return segments
+
+    def _tier(self, docs):
+        tier = 0
+        while docs >= self.merge_factor:
+            docs //= self.merge_factor
+            tier += 1
+        return tier
+
+    def _merge_tiers(self, segments):
+        while True:
+            tiers = defaultdict(list)
+            for segment in segments:
+                tiers[self._tier(len(segment.docs))].append(segment)
+            full = [tier for _, tier in sorted(tiers.items()) if len(tier) >= self.merge_factor]
+            if not full:
+                return segments
+            segments = self._merge(segments, full[0])
+
+    def _merge(self, segments, chosen):
+        # Rewrites the live documents of the chosen segments as one newest
+        # segment. Empty documents still hide older ones in other segments,
+        # so they are only dropped when every segment is chosen. The old
+        # files stay mapped for searches that still hold them.
+        _, live, _, _ = self.state
+        keep_empty = len(chosen) < len(segments)
+        docs = []
+        postings = defaultdict(list)
+        for segment in chosen:
+            new_ids = {}
+            for doc, (isbn, length, stamp) in enumerate(segment.docs):
+                if (length or keep_empty) and live[isbn] == (segment.number, doc):
+                    new_ids[doc] = len(docs)
+                    docs.append((isbn, length, stamp))
+            for term, hits in segment.iter_postings():
+                merged = postings[term]
+                for doc, count in hits:
+                    if doc in new_ids:
+                        merged.append((new_ids[doc], count))
+        path = self._path(segments[-1].number + 1)
+        FullTextSegment.write(path, docs, postings)
+        segments = [segment for segment in segments if segment not in chosen] + [FullTextSegment(path)]
+        self._publish(segments)
+        for segment in chosen:
+            try:
+                os.remove(segment.path)
+            except OSError:
+                pass
+        return segments
+
+    def search(self, query, limit=10):
+        # (BM25 score, isbn) of the best matches for any of the query's terms
+        segments, live, average, total = self.state
+        scores = defaultdict(float)
+        for term in set(TERM.findall(normalize_key(query))):
+            hits = [(segment, segment.postings(term)) for segment in segments]
+            df = sum(len(postings) for _, postings in hits)
+            if not df:
+                continue
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for segment, postings in hits:
+                docs, number = segment.docs, segment.number
+                for doc, count in postings:
+                    isbn, length, _ = docs[doc]
+                    if live[isbn] == (number, doc):
+                        norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average)
+                        scores[isbn] += idf * count * (BM25_K1 + 1) / (count + norm)
+        return heapq.nlargest(limit, ((score, isbn) for isbn, score in scores.items()))
+
+    def books(self, query, find, limit=10):
+        # Ranked Books for query; find maps an ISBN to its Book, or None for
+        # books removed from the catalog since their PDF was indexed
+        found = []
+        for _, isbn in self.search(query, limit * 2):
+            book = find(isbn)
+            if book is not None:
+                found.append(book)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def stats(self):
+        segments, _, _, indexed = self.state
+        return {
+            'documents': indexed,
+            'segments': len(segments),
+            'terms': sum(segment.term_count for segment in segments),
+            'bytes': sum(os.path.getsize(segment.path) for segment in segments),
+        }
+
+# Bounded search log: a ring buffer of parallel field columns plus an index
+# from user id to that user's positions, so history lookups are O(results)
+# and memory stays flat however many searches are logged.
+class SearchLog:
+    FIELDS = ('user_id', 'user_name', 'query', 'type', 'timestamp', 'seq')
+
+    def __init__(self, capacity=SEARCH_LOG_SIZE):
+        self.capacity = capacity
+        self.total = 0
+        self.columns = {field: [None] * capacity for field in self.FIELDS}
+        self._by_user = defaultdict(deque)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def __iter__(self):
+        with self._lock:
+            positions = range(self.total - len(self), self.total)
+        for position in positions:
+            entry = self._entry(position)
+            if entry is not None:
+                yield entry
+
+    def __getitem__(self, i):
+        # i-th oldest retained entry, for views that page through the log
+        with self._lock:
+            first = self.total - len(self)
+            if not 0 <= i < len(self):
+                raise IndexError(i)
+        entry = self._entry(first + i)
+        if entry is None:
+            raise IndexError(i)
+        return entry
+
+    def append(self, entry, seq=0):
+        user_id = entry['user']['id']
+        with self._lock:
+            slot = self.total % self.capacity
+            if self.total >= self.capacity:
+                # The evicted entry is the oldest one of its user as well
+                evicted = self.columns['user_id'][slot]
+                positions = self._by_user[evicted]
+                positions.popleft()
+                if not positions:
+                    del self._by_user[evicted]
+            values = (user_id, entry['user']['name'], entry['query'], entry['type'],
+                      entry['timestamp'], seq)
+            for field, value in zip(self.FIELDS, values):
+                self.columns[field][slot] = value
+            self._by_user[user_id].append(self.total)
+            self.total += 1
+
+    def _entry(self, position):
+        slot = position % self.capacity
+        with self._lock:
+            if position < self.total - self.capacity:
+                return None
+            c = self.columns
+            return {
+                'user': {'id': c['user_id'][slot], 'name': c['user_name'][slot]},
+                'query': c['query'][slot],
+                'type': c['type'][slot],
+                'timestamp': c['timestamp'][slot],
+            }
+
+    def for_user(self, user_id):
+        with self._lock:
+            positions = list(self._by_user.get(user_id, ()))
+        for position in positions:
+            entry = self._entry(position)
+            if entry is not None:
+                yield entry
+
+    def oldest_seq(self):
+        with self._lock:
+            if not self.total:
+                return 0
+            return self.columns['seq'][(self.total - len(self)) % self.capacity]
+
+# HyperLogLog distinct counter: 2**p one-byte registers, ~1.6% error at p=12
+class HyperLogLog:
+    def __init__(self, p=12, registers=None):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m) if registers is None else bytearray(registers)
+
+    def add(self, item):
+        # A hash that is the same in every process, so saved registers stay valid
+        h = int.from_bytes(blake2b(str(item).encode('utf-8'), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.p)
+        rest = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        m = self.m
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small-range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+# Space-Saving heavy hitters: tracks at most `capacity` items, and any item
+# seen more than total/capacity times is guaranteed to be among them
+class HeavyHitters:
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, item):
+        counts = self.counts
+        if item in counts:
+            counts[item] += 1
+        elif len(counts) < self.capacity:
+            counts[item] = 1
+        else:
+            victim = min(counts, key=counts.get)
+            counts[item] = counts.pop(victim) + 1
+
+    def top(self, n=10):
+        return heapq.nlargest(n, self.counts.items(), key=lambda item: item[1])
+
+# Search aggregates updated in O(1) per logged search; the dashboard and
+# statistics page read these instead of scanning the search log. The log
+# only keeps the searches the bounded search log still holds, so each
+# compaction writes the aggregates as a search_stats record; last_seq is
+# the newest search they include, and replay counts only later ones.
+class SearchStats:
+    def __init__(self, keep_days=30):
+        self.keep_days = keep_days
+        self.total = 0
+        self.last_seq = 0
+        self.by_type = defaultdict(int)
+        self.daily = defaultdict(int)
+        self.hourly = defaultdict(int)
+        self.users = HyperLogLog()
+        self.daily_users = {}
+        self.top_queries = HeavyHitters()
+        self._lock = threading.Lock()
+
+    def record(self, entry, seq=0):
+        timestamp = entry['timestamp']
+        day, hour = timestamp[:10], timestamp[:13]
+        user_id = entry['user']['id']
+        with self._lock:
+            self.total += 1
+            self.last_seq = max(self.last_seq, seq)
+            self.by_type[entry['type']] += 1
+            if day not in self.daily:
+                self._start_day(day)
+            self.daily[day] += 1
+            self.hourly[hour] += 1
+            self.users.add(user_id)
+            self.daily_users[day].add(user_id)
+            self.top_queries.add((entry['type'], normalize_key(entry['query'].strip())))
+
+    def _start_day(self, day):
+        self.daily_users[day] = HyperLogLog(p=10)
+        # Days arrive in order, so old buckets can be dropped as a new one opens
+        for old in sorted(self.daily)[:max(0, len(self.daily) + 1 - self.keep_days)]:
+            del self.daily[old]
+            self.daily_users.pop(old, None)
+            for h in range(24):
+                self.hourly.pop(f"{old} {h:02d}", None)
+
+    def to_record(self):
+        with self._lock:
+            return {
+                'op': 'search_stats',
+                'seq': self.last_seq,
+                'total': self.total,
+                'by_type': dict(self.by_type),
+                'daily': dict(self.daily),
+                'hourly': dict(self.hourly),
+                'users': self.users.registers.hex(),
+                'daily_users': {day: users.registers.hex() for day, users in self.daily_users.items()},
+                'top_queries': [[search_type, query, count]
+                                for (search_type, query), count in self.top_queries.counts.items()],
+            }
+
+    def restore(self, record):
+        with self._lock:
+            self.total = record['total']
+            self.last_seq = record['seq']
+            self.by_type = defaultdict(int, record['by_type'])
+            self.daily = defaultdict(int, record['daily'])
+            self.hourly = defaultdict(int, record['hourly'])
+            self.users = HyperLogLog(registers=bytes.fromhex(record['users']))
+            self.daily_users = {day: HyperLogLog(p=10, registers=bytes.fromhex(registers))
+                                for day, registers in record['daily_users'].items()}
+            self.top_queries.counts = {(search_type, query): count
+                                       for search_type, query, count in record['top_queries']}
+
+    def searches_on(self, day):
+        return self.daily.get(day, 0)
+
+    def active_users_on(self, day):
+        users = self.daily_users.get(day)
+        return users.count() if users else 0
+
+    def hours_of(self, day):
+        return [self.hourly.get(f"{day} {h:02d}", 0) for h in range(24)]
+
+# Hot-path instrumentation, off unless switched on (--metrics, the
+# statistics page, LibrarySystem.instrument). Instrumented code checks
+# METRICS.enabled once per call and only counts in its own loop while it
+# is off; when on, each observation lands in a fixed-bucket histogram of
+# the observing thread, so searches never wait on one another to record.
+# Sizes that need no per-search work (tree heights, load factors) are read
+# from the indexes when a report is taken.
+METRIC_BUCKETS = {
+    'bst_nodes_visited': (1, 2, 4, 8, 12, 16, 20, 24, 32),
+    'hash_probes': (1, 2, 3, 4, 6, 8, 16, 32),
+    'author_rows': (0, 1, 2, 5, 10, 50, 100, 1000, 10000),
+    'search_seconds': (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+}
+METRIC_HELP = {
+    'bst_nodes_visited': "Nodes visited per BST search",
+    'hash_probes': "Slots probed per hash table lookup",
+    'author_rows': "Rows in the author index list per author lookup",
+    'search_seconds': "Search latency by search type",
+    'metrics_enabled': "Whether hot-path instrumentation is on",
+    'books': "Books in the catalog",
+    'bst_height': "Height of each BST index",
+    'index_entries': "Entries in each built index",
+    'hash_load_factor': "Load factor of each hash table, tombstones excluded",
+    'hash_tombstones': "Deleted entries awaiting compaction in each hash table",
+    'author_lists': "Distinct authors in the author index",
+    'author_list_rows_max': "Rows in the longest author index list",
+    'author_list_rows_mean': "Mean rows per author index list",
+}
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        # Counts are copied before they are added up, as the owning thread
+        # may still be observing
+        for i, count in enumerate(list(other.counts)):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def report(self):
+        # Cumulative counts per upper bound, as Prometheus buckets are
+        return {'buckets': [[bound, count] for bound, count in
+                            zip(self.bounds, itertools.accumulate(self.counts))],
+                'count': self.count, 'sum': self.sum}
+
+class Metrics:
     def __init__(self):
-        self.title_bst = BST(key_func=lambda b: b.title.lower())
-        self.isbn_bst = BST(key_func=lambda b: b.isbn)
-        self.title_hash = HashTable(key_func=lambda b: b.title.lower())
-        self.isbn_hash = HashTable(key_func=lambda b: b.isbn)
-        self.author_hash = defaultdict(list)
-        self.books = []
-        self.search_log = []
-        self._load_sample_books()
+        self.enabled = False
+        self._local = threading.local()
+        # Every thread's histograms, merged when a report is taken
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        try:
+            histograms = self._local.histograms
+        except AttributeError:
+            histograms = self._local.histograms = {}
+            with self._lock:
+                self._threads.append(histograms)
+        key = (name, *sorted(labels.items()))
+        try:
+            histograms[key].observe(value)
+        except KeyError:
+            histogram = histograms[key] = Histogram(METRIC_BUCKETS[name])
+            histogram.observe(value)
+
+    def reset(self):
+        with self._lock:
+            for histograms in self._threads:
+                histograms.clear()
+
+    def report(self, gauges=()):
+        # gauges: (name, labels, value) read by the caller
+        merged = {}
+        with self._lock:
+            for histograms in self._threads:
+                for key, histogram in list(histograms.items()):
+                    total = merged.get(key)
+                    if total is None:
+                        total = merged[key] = Histogram(histogram.bounds)
+                    total.merge(histogram)
+        histograms = [dict(histogram.report(), name=name, labels=dict(labels))
+                      for (name, *labels), histogram in sorted(merged.items())]
+        return {
+            'enabled': self.enabled,
+            'histograms': histograms,
+            'gauges': [{'name': 'metrics_enabled', 'labels': {}, 'value': int(self.enabled)}]
+                      + [{'name': name, 'labels': labels, 'value': value} for name, labels, value in gauges],
+        }
+
+METRICS = Metrics()
+
+def histogram_quantile(histogram, q):
+    # Upper bound of the bucket holding the q-th observation (None if empty
+    # or beyond the last bound) of a reported histogram
+    if not histogram['count']:
+        return None
+    for bound, count in histogram['buckets']:
+        if count >= q * histogram['count']:
+            return bound
+    return None
+
+def prometheus_text(report, prefix='library_'):
+    # A metrics report in the Prometheus text exposition format
+    def labels_of(labels, **extra):
+        labels = dict(labels, **extra)
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for value in labels.values())
+        return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+    lines = []
+    described = set()
+    for kind, entries in (('histogram', report['histograms']), ('gauge', report['gauges'])):
+        # Samples of one metric must be adjacent
+        for entry in sorted(entries, key=itemgetter('name')):
+            name = prefix + entry['name']
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {METRIC_HELP.get(entry['name'], entry['name'])}")
+                lines.append(f"# TYPE {name} {kind}")
+            if kind == 'gauge':
+                lines.append(f"{name}{labels_of(entry['labels'])} {entry['value']}")
+                continue
+            for bound, count in entry['buckets']:
+                lines.append(f"{name}_bucket{labels_of(entry['labels'], le=f'{bound:g}')} {count}")
+            lines.append(f"{name}_bucket{labels_of(entry['labels'], le='+Inf')} {entry['count']}")
+            lines.append(f"{name}_sum{labels_of(entry['labels'])} {entry['sum']}")
+            lines.append(f"{name}_count{labels_of(entry['labels'])} {entry['count']}")
+    return '\n'.join(lines) + '\n'
+
+# LRU cache of search results. Every entry is stored with tags naming what
+# it depends on, and a catalog change invalidates just the entries sharing
+# one of its tags. Results computed before an invalidation are not stored.
+class QueryCache:
+    def __init__(self, capacity=QUERY_CACHE_SIZE):
+        self.capacity = capacity
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._by_tag = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, tags, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (value, tags)
+            for tag in tags:
+                self._by_tag[tag].add(key)
+            while len(self._entries) > self.capacity:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self._by_tag[tag]
+
+    def invalidate(self, tags):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self._by_tag.get(tag, ())):
+                    self._drop(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._by_tag.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+def query_tags(search_type, key):
+    # A fuzzy query can only find keys sharing one of its n-grams
+    if search_type == "fuzzy":
+        return {('gram', gram) for gram in ngrams(key)}
+    if search_type == "fulltext":
+        # Answers change when PDFs are indexed, not when catalog records do
+        return {('fulltext',)}
+    return {(search_type, key)}
+
+# Full-text results carry the catalog record of each hit, so a removed or
+# edited book makes every cached full-text answer suspect
+CHANGED_BOOK_TAGS = {('fulltext',)}
+
+def book_tags(book):
+    title, author = normalize_key(book.title), normalize_key(book.author)
+    tags = {('title', title), ('author', author), ('isbn', normalize_key(book.isbn))}
+    tags.update(('gram', gram) for gram in ngrams(title) | ngrams(author))
+    return tags
+
+# In-memory indexes, in the order build_indexes creates them (the most used
+# first). Each one is None in a view until its first query builds it.
+INDEX_NAMES = ('title_hash', 'isbn_hash', 'author_hash', 'title_trie', 'author_trie',
+               'title_bst', 'isbn_bst', 'fuzzy_index')
+
+# What a reader sees: the snapshot, the in-memory indexes over it and the
+# number of rows fully added to every built index. Writers update the shared
+# structures and then publish a new view with one attribute assignment, so
+# a search that holds a view never sees a half-added book and never waits.
+# Removed rows go in `deleted` (shared by every view of one layer) with the
+# epoch that removed them; a view still sees rows removed after its epoch.
+CATALOG_FIELDS = ('snapshot', 'rows', 'books', 'epoch', 'deleted', 'removed')
+
+class CatalogView(namedtuple('CatalogView', CATALOG_FIELDS + INDEX_NAMES)):
+    __slots__ = ()
+
+    def visible(self, row):
+        # Negative ids are snapshot rows, which are always complete
+        if row >= self.rows:
+            return False
+        if not self.deleted:
+            return True
+        epoch = self.deleted.get(row)
+        return epoch is None or epoch > self.epoch
+
+    def snapshot_visible(self, row):
+        return self.visible(-row - 1)
+
+    def find(self, kind, key):
+        if self.snapshot is None:
+            return [] if kind == 'author' else None
+        return self.snapshot.find(kind, key, self.snapshot_visible)
+
+    def iter_books(self):
+        # Every book this view can see, snapshot rows first
+        if self.snapshot is not None:
+            if self.removed:
+                for row in range(len(self.snapshot)):
+                    if self.visible(-row - 1):
+                        yield self.snapshot.book(row)
+            else:
+                yield from self.snapshot
+        for row in range(self.rows):
+            if not self.removed or self.visible(row):
+                yield self.books.book(row)
+
+# Book fields update_book accepts
+BOOK_FIELDS = ('title', 'author', 'isbn', 'pdf_path')
+
+class LibrarySystem:
+    def __init__(self, snapshot_path=None, log_path=None, compact_after=COMPACT_AFTER,
+                 search_log_size=SEARCH_LOG_SIZE, samples=True, fulltext_path=None):
+        self.snapshot_path = snapshot_path
+        self.wal = None
+        self.fulltext = FullTextIndex(fulltext_path) if fulltext_path else None
+        self._pdf_lock = threading.Lock()
+        self._pdf_pending = []
+        self._pdf_indexer = None
+        self.search_log = SearchLog(search_log_size)
+        self.stats = SearchStats()
+        self.cache = QueryCache()
+        self.compact_after = compact_after
+        self._write_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._compactor = None
+        self._mutations = 0
+        if snapshot_path and os.path.exists(snapshot_path):
+            snapshot = CatalogSnapshot(snapshot_path)
+            if snapshot.version != SNAPSHOT_VERSION:
+                # Keys from an older normalization would not match today's queries
+                CatalogSnapshot.write(snapshot_path, snapshot, snapshot.last_seq)
+                snapshot.close()
+                snapshot = CatalogSnapshot(snapshot_path)
+            self.view = self._empty_view(snapshot)
+        else:
+            self.view = self._empty_view(None)
+            if samples:
+                self._load_sample_books()
+        if log_path:
+            self._open_log(log_path)
+
+    def _open_log(self, log_path):
+        # Replay everything the snapshot does not already cover, then keep appending
+        covered = self.view.snapshot.last_seq if self.view.snapshot else 0
+        last_seq = covered
+        for record in WriteAheadLog.read(log_path):
+            last_seq = max(last_seq, record['seq'])
+            if record['op'] == 'search_stats':
+                self.stats.restore(record)
+            elif record['op'] == 'search':
+                self.search_log.append(record, record['seq'])
+                if record['seq'] > self.stats.last_seq:
+                    self.stats.record(record, record['seq'])
+            elif record['seq'] <= covered:
+                continue
+            elif record['op'] == 'add_book':
+                self._insert_book(Book(record['title'], record['author'], record['isbn'], record['pdf_path']))
+                self._mutations += 1
+            elif record['op'] in ('remove_book', 'update_book'):
+                self.index('isbn_hash')
+                self._change_book(record['isbn'], record.get('fields'))
+                self._mutations += 1
+        self.wal = WriteAheadLog(log_path, start_seq=last_seq)
+
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.join()
+        indexer = self._pdf_indexer
+        if indexer is not None:
+            indexer.join()
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+
+    @staticmethod
+    def _empty_view(snapshot):
+        return CatalogView(snapshot, 0, BookStore(), 0, {}, 0, *(None for _ in INDEX_NAMES))
+
+    @staticmethod
+    def _new_index(name, view):
+        # Indexes hold row ids into books; negative ids are snapshot rows
+        books, snapshot = view.books, view.snapshot
+
+        def resolve(row):
+            return books.book(row) if row >= 0 else snapshot.book(-row - 1)
+
+        if name == 'title_bst':
+            return BST(key_func=books.title, resolve=resolve, name=name)
+        if name == 'isbn_bst':
+            return BST(key_func=books.isbn, resolve=resolve, name=name)
+        if name == 'title_hash':
+            return HashTable(key_func=books.title, resolve=resolve, name=name)
+        if name == 'isbn_hash':
+            return HashTable(key_func=books.isbn, resolve=resolve, name=name)
+        if name == 'author_hash':
+            return defaultdict(lambda: array('I'))
+        if name == 'title_trie':
+            return RadixTrie(resolve=books.title)
+        if name == 'author_trie':
+            return RadixTrie(resolve=books.author)
+        return FuzzyIndex(resolve=resolve)
+
+    def index(self, name):
+        # The current view with index `name` built, building it on first use.
+        # Only the first query of each type pays for this; build_indexes can
+        # do it in the background instead.
+        while True:
+            view = self.view
+            if getattr(view, name) is not None:
+                return view
+            with self._build_lock:
+                view = self.view
+                if getattr(view, name) is not None:
+                    return view
+                index = self._new_index(name, view)
+                if name == 'fuzzy_index' and view.snapshot is not None:
+                    # The snapshot never changes, so its rows go in without
+                    # holding up writers
+                    for row, book in enumerate(view.snapshot):
+                        if view.snapshot_visible(row):
+                            index.insert(normalize_key(book.title), -row - 1)
+                            index.insert(normalize_key(book.author), -row - 1)
+                with self._write_lock:
+                    # Unless save_snapshot started a new layer meanwhile,
+                    # add the rows written so far and publish
+                    if self.view.books is view.books:
+                        built, view = view, self.view
+                        if name == 'fuzzy_index':
+                            # Snapshot rows removed while the index was filling
+                            for row, epoch in view.deleted.items():
+                                if row < 0 and epoch > built.epoch:
+                                    book = view.snapshot.book(-row - 1)
+                                    index.remove(normalize_key(book.title), row)
+                                    index.remove(normalize_key(book.author), row)
+                        rows = range(view.rows)
+                        if view.removed:
+                            rows = [row for row in rows if view.visible(row)]
+                        self._add_rows(view, name, index, rows)
+                        self.view = view._replace(**{name: index})
+                        return self.view
+
+    def build_indexes(self, names=INDEX_NAMES):
+        for name in names:
+            self.index(name)
 
     def _load_sample_books(self):
         samples = [
@@ -110,15 +2229,1052 @@ class LibrarySystem:
             self.add_book(book)
 
     def add_book(self, book):
-        self.title_bst.insert(book)
-        self.isbn_bst.insert(book)
-        self.title_hash.insert(book)
-        self.isbn_hash.insert(book)
-        self.author_hash[book.author.lower()].append(book)
-        self.books.append(book)
+        with self._write_lock:
+            # Stored first, so a bad book fails before it is logged; the
+            # row stays invisible until _index_rows publishes it
+            view = self.view
+            row = view.books.append(book)
+            if self.wal is not None:
+                try:
+                    seq = self.wal.append(book_record(book))
+                except BaseException:
+                    view.books.truncate(row)
+                    raise
+            self._index_rows(view, range(row, row + 1))
+            self._mutations += 1
+        if self.wal is not None:
+            self.wal.wait(seq)
+        self.cache.invalidate(book_tags(book))
+        self._maybe_compact()
+        self.queue_pdfs([book])
+
+    def _insert_book(self, book):
+        view = self.view
+        row = view.books.append(book)
+        self._index_rows(view, range(row, row + 1))
+
+    def remove_book(self, isbn):
+        # The removed book, or None if no book has this ISBN
+        changed = self._apply_change(isbn, None, {'op': 'remove_book', 'isbn': isbn})
+        return changed and changed[0]
+
+    def update_book(self, isbn, /, **fields):
+        # The updated book, or None if no book has this ISBN
+        unknown = set(fields) - set(BOOK_FIELDS)
+        if unknown:
+            raise TypeError(f"update_book() got unexpected fields: {', '.join(sorted(unknown))}")
+        if not all(isinstance(value, str) for value in fields.values()):
+            raise TypeError("update_book() fields must be strings")
+        changed = self._apply_change(isbn, fields, {'op': 'update_book', 'isbn': isbn, 'fields': fields})
+        return changed and changed[1]
+
+    def _apply_change(self, isbn, fields, record):
+        while True:
+            self.index('isbn_hash')
+            with self._write_lock:
+                # save_snapshot may have started a new layer since
+                if self.view.isbn_hash is None:
+                    continue
+                changed = self._change_book(isbn, fields, record)
+                if changed is not None:
+                    self._mutations += 1
+                break
+        if changed is not None:
+            if self.wal is not None:
+                # The log numbered the record when _change_book appended it
+                self.wal.wait(record['seq'])
+            old, new = changed
+            self.cache.invalidate(book_tags(old) | (book_tags(new) if new else set()) | CHANGED_BOOK_TAGS)
+            self._maybe_compact()
+            if new is not None:
+                self.queue_pdfs([new])
+        return changed
+
+    def _change_book(self, isbn, fields=None, record=None):
+        # Removes the book with this ISBN (and adds its updated copy when
+        # fields is given) in one published view, then takes the old row
+        # out of the indexes. Needs isbn_hash built; returns (old, new).
+        view = self.view
+        row = self._isbn_row(view, isbn)
+        if row is None:
+            return None
+        old = view.books.book(row) if row >= 0 else view.snapshot.book(-row - 1)
+        new = None if fields is None else Book(**dict(book_dict(old), **fields))
+        # Replay (no record) applies what was checked when it was logged
+        if (record is not None and new is not None and normalize_key(new.isbn) != normalize_key(isbn)
+                and self._isbn_row(view, new.isbn) is not None):
+            raise ValueError(f"ISBN {new.isbn} is already taken")
+        if record is not None and self.wal is not None:
+            self.wal.append(record)
+
+        epoch = view.epoch + 1
+        view.deleted[row] = epoch
+        rows = view.rows
+        if new is not None:
+            new_row = view.books.append(new)
+            keys = {}
+            for name in INDEX_NAMES:
+                index = getattr(view, name)
+                if index is not None:
+                    self._add_rows(view, name, index, range(new_row, new_row + 1), keys)
+            rows = new_row + 1
+        self.view = view = view._replace(rows=rows, epoch=epoch, removed=view.removed + 1)
+        self._drop_row(view, row, old)
+        return old, new
+
+    @staticmethod
+    def _isbn_row(view, isbn):
+        # Row of the visible book with this ISBN (negative for snapshot
+        # rows), or None; needs isbn_hash built
+        row = view.isbn_hash.find_value(isbn, view.visible)
+        if row is None and view.snapshot is not None:
+            found = view.snapshot.find_row('isbn', isbn, view.snapshot_visible)
+            row = None if found is None else -found - 1
+        return row
+
+    @staticmethod
+    def _drop_row(view, row, book):
+        # Readers of view no longer see row; remove it from each built index.
+        # A search still holding an older view may find the row gone from
+        # some indexes, as if it ran just after the change.
+        title, author, isbn = normalize_key(book.title), normalize_key(book.author), normalize_key(book.isbn)
+        if view.fuzzy_index is not None:
+            view.fuzzy_index.remove(title, row)
+            view.fuzzy_index.remove(author, row)
+        if row < 0:
+            # The other indexes only hold in-memory rows
+            return
+        if view.title_hash is not None:
+            view.title_hash.delete(title, row)
+        if view.isbn_hash is not None:
+            view.isbn_hash.delete(isbn, row)
+        if view.title_bst is not None:
+            view.title_bst.delete(title, row)
+        if view.isbn_bst is not None:
+            view.isbn_bst.delete(isbn, row)
+        author_rows = view.author_hash.get(author) if view.author_hash is not None else None
+        if author_rows is not None:
+            view.author_hash[author] = array('I', (r for r in author_rows if r != row))
+        # A trie shows one row per key; another visible row with the key takes over
+        if view.title_trie is not None:
+            view.title_trie.remove(title, row, LibrarySystem._other_row(view, 'title', title))
+        if view.author_trie is not None:
+            view.author_trie.remove(author, row, LibrarySystem._other_row(view, 'author', author))
+
+    @staticmethod
+    def _other_row(view, field, key):
+        # A visible in-memory row whose title or author has key: from the
+        # hash index if it is built, else by scanning the store
+        if field == 'title' and view.title_hash is not None:
+            return view.title_hash.find_value(key, view.visible)
+        if field == 'author' and view.author_hash is not None:
+            return next((r for r in view.author_hash.get(key, ()) if view.visible(r)), None)
+        store = view.books
+        if field == 'author':
+            codes = {code for code, author_key in enumerate(store.author_keys) if author_key == key}
+            matches = (r for r in range(view.rows) if store.author_codes[r] in codes)
+        else:
+            matches = (r for r in range(view.rows) if normalize_key(store.title(r)) == key)
+        return next((r for r in matches if view.visible(r)), None)
+
+    def bulk_load(self, path):
+        return self.load_books(read_catalog(path))
+
+    def load_books(self, books):
+        # If books raises part-way (a bad record, say), the rows stored and
+        # logged before it are still indexed and published, then it re-raises
+        start = time.perf_counter()
+        error = None
+        seq = 0
+        with self._write_lock:
+            store = self.view.books
+            first_row = len(store)
+            try:
+                for book in books:
+                    row = store.append(book)
+                    if self.wal is not None:
+                        try:
+                            seq = self.wal.append(book_record(book))
+                        except BaseException:
+                            store.truncate(row)
+                            raise
+            except BaseException as e:
+                error = e
+            rows = range(first_row, len(store))
+            self._index_rows(self.view, rows)
+            self._mutations += len(rows)
+        if seq:
+            self.wal.wait(seq)
+        if len(rows) > self.cache.capacity:
+            self.cache.clear()
+        else:
+            self.cache.invalidate(set().union(*(book_tags(store.book(row)) for row in rows)))
+        self._maybe_compact()
+        self.queue_pdfs(store.book(row) for row in rows)
+        if error is not None:
+            raise error
+        elapsed = time.perf_counter() - start
+        return {
+            'rows': len(rows),
+            'seconds': elapsed,
+            'rows_per_sec': len(rows) / elapsed if elapsed else 0.0
+        }
+
+    def _index_rows(self, view, rows):
+        # The new rows stay invisible to readers until every built index has them
+        keys = {}
+        for name in INDEX_NAMES:
+            index = getattr(view, name)
+            if index is not None:
+                self._add_rows(view, name, index, rows, keys)
+        self.view = view._replace(rows=rows.stop)
+
+    @staticmethod
+    def _row_keys(store, rows, field, keys):
+        # Normalized keys of rows for one field, computed once per batch
+        # and shared by every index over that field
+        found = keys.get(field)
+        if found is None:
+            if field == 'author':
+                found = [store.author_key(row) for row in rows]
+            else:
+                column = store.title if field == 'title' else store.isbn
+                found = [normalize_key(column(row)) for row in rows]
+            keys[field] = found
+        return found
+
+    @classmethod
+    def _add_rows(cls, view, name, index, rows, keys=None):
+        store = view.books
+        keys = {} if keys is None else keys
+        field = 'isbn' if name.startswith('isbn') else 'author' if name.startswith('author') else 'title'
+        # Batches that are large next to the index are rebuilt in one pass
+        bulk = len(rows) > len(index) // 16
+        if name in ('title_hash', 'isbn_hash'):
+            index.reserve(len(index) + len(rows))
+            for row, key in zip(rows, cls._row_keys(store, rows, field, keys)):
+                index.insert(row, key)
+        elif name == 'author_hash':
+            for row, key in zip(rows, cls._row_keys(store, rows, field, keys)):
+                index[key].append(row)
+        elif name in ('title_trie', 'author_trie'):
+            items = zip(cls._row_keys(store, rows, field, keys), rows)
+            if bulk:
+                index.insert_many(items)
+            else:
+                for key, row in items:
+                    index.insert(key, row)
+        elif name in ('title_bst', 'isbn_bst'):
+            row_keys = cls._row_keys(store, rows, field, keys)
+            if bulk:
+                index.build(rows, row_keys)
+            else:
+                for row, key in zip(rows, row_keys):
+                    index.insert(row, key)
+        else:
+            titles = cls._row_keys(store, rows, 'title', keys)
+            authors = cls._row_keys(store, rows, 'author', keys)
+            for row, title, author in zip(rows, titles, authors):
+                index.insert(title, row)
+                index.insert(author, row)
+
+    def index_pdfs(self, books=None):
+        # Full-text indexes the PDFs of books (default: the whole catalog)
+        # that are new or changed; returns how many were read
+        if self.fulltext is None:
+            return 0
+        count = self.fulltext.update(self.view.iter_books() if books is None else books)
+        if count:
+            self.cache.invalidate({('fulltext',)})
+        return count
+
+    def queue_pdfs(self, books=None):
+        # index_pdfs on a background thread, which keeps draining the queue
+        if self.fulltext is None:
+            return
+        with self._pdf_lock:
+            self._pdf_pending.append(self.view.iter_books() if books is None else books)
+            if self._pdf_indexer is None:
+                self._pdf_indexer = threading.Thread(target=self._drain_pdfs, daemon=True)
+                self._pdf_indexer.start()
+
+    def _drain_pdfs(self):
+        while True:
+            with self._pdf_lock:
+                pending, self._pdf_pending = self._pdf_pending, []
+                if not pending:
+                    self._pdf_indexer = None
+                    return
+            self.index_pdfs(itertools.chain.from_iterable(pending))
+
+    def full_text_search(self, query, limit=10):
+        if self.fulltext is None:
+            return []
+        return self.fulltext.books(query, lambda isbn: self.find('isbn', isbn), limit)
+
+    def log_search(self, entry):
+        # Numbered and counted together, so the stats saved at compaction
+        # cover exactly the searches up to their last_seq
+        with self._log_lock:
+            seq = self.wal.append(dict(entry, op='search')) if self.wal is not None else 0
+            self.search_log.append(entry, seq)
+            self.stats.record(entry, seq)
+
+    def _keep_in_log(self, last_seq):
+        # After compaction the log only needs unsnapshotted books and the
+        # searches still held by the bounded search log; _rewrite_log puts
+        # the current search aggregates in front in place of older ones
+        oldest_search = self.search_log.oldest_seq()
+        return lambda r: (r['op'] != 'search_stats'
+                          and (r['seq'] > last_seq or (r['op'] == 'search' and r['seq'] >= oldest_search)))
+
+    def _rewrite_log(self, last_seq):
+        with self._log_lock:
+            stats = self.stats.to_record()
+        self.wal.rewrite(self._keep_in_log(last_seq), [stats])
+
+    def total_books(self):
+        view = self.view
+        return view.rows + (len(view.snapshot) if view.snapshot else 0) - view.removed
+
+    @staticmethod
+    def instrument(enabled=True):
+        # The counters are per process, shared by every library in it
+        METRICS.enabled = enabled
+
+    def metrics(self):
+        # METRICS' histograms plus the current shape of every built index
+        view = self.view
+        gauges = [('books', {}, self.total_books())]
+        for name in INDEX_NAMES:
+            index = getattr(view, name)
+            if index is None:
+                continue
+            labels = {'index': name}
+            gauges.append(('index_entries', labels, len(index)))
+            if name in ('title_bst', 'isbn_bst'):
+                gauges.append(('bst_height', labels, index.height()))
+            elif name in ('title_hash', 'isbn_hash'):
+                gauges.append(('hash_load_factor', labels, round(index.load_factor(), 4)))
+                gauges.append(('hash_tombstones', labels, index.tombstones))
+            elif name == 'author_hash':
+                sizes = [len(rows) for rows in list(index.values())]
+                gauges.append(('author_lists', {}, len(sizes)))
+                gauges.append(('author_list_rows_max', {}, max(sizes, default=0)))
+                gauges.append(('author_list_rows_mean', {}, round(sum(sizes) / len(sizes), 2) if sizes else 0))
+        return METRICS.report(gauges)
+
+    def save_snapshot(self, path=None):
+        path = path or self.snapshot_path
+        if not path:
+            return
+        with self._compact_lock, self._write_lock:
+            view = self.view
+            if (view.snapshot is not None and path == view.snapshot.path
+                    and not view.rows and not view.removed):
+                return
+            last_seq = self.wal.seq if self.wal is not None else 0
+            CatalogSnapshot.write(path, view.iter_books(), last_seq)
+            # Everything now lives in the snapshot; start a fresh in-memory
+            # layer. The old snapshot stays open for searches still holding
+            # the previous view and is closed once they drop it.
+            self.snapshot_path = path
+            self.view = self._empty_view(CatalogSnapshot(path))
+            self._mutations = 0
+            if self.wal is not None:
+                self._rewrite_log(last_seq)
+
+    def _maybe_compact(self):
+        if (self.wal is None or not self.snapshot_path or self._mutations < self.compact_after
+                or (self._compactor is not None and self._compactor.is_alive())):
+            return
+        self._compactor = threading.Thread(target=self.compact, daemon=True)
+        self._compactor.start()
+
+    def compact(self):
+        # Folds logged books into a new snapshot file and drops them from the
+        # log; the in-memory layer keeps serving them until the next start
+        with self._compact_lock:
+            with self._write_lock:
+                last_seq = self.wal.seq
+                view = self.view
+                self._mutations = 0
+            CatalogSnapshot.write(self.snapshot_path, view.iter_books(), last_seq)
+            self._rewrite_log(last_seq)
+
+    def find(self, kind, key, method='hash'):
+        # Exact title or ISBN lookup through the hash table or the tree
+        name = f"{kind}_{method}"
+        view = self.index(name)
+        return getattr(view, name).search(key, view.visible) or view.find(kind, key)
+
+    def snapshot_find(self, kind, query):
+        return self.view.find(kind, query)
+
+    def fuzzy_search(self, query, limit=20):
+        view = self.index('fuzzy_index')
+        return view.fuzzy_index.search(normalize_key(query.strip()), limit, view.visible)
+
+    def author_search(self, author):
+        view = self.index('author_hash')
+        rows = view.author_hash.get(normalize_key(author), ())
+        if METRICS.enabled:
+            METRICS.observe('author_rows', len(rows))
+        return [view.books.book(row) for row in rows if view.visible(row)] + view.find('author', author)
+
+    def linear_author_search(self, author, cancel=None):
+        # Compares every book's author, but normalizes each distinct author
+        # once: the store keeps their keys and snapshot ones are memoized
+        key = normalize_key(author)
+        view = self.view
+        found = []
+        if view.snapshot is not None:
+            snapshot_keys = {}
+            for row in range(len(view.snapshot)):
+                if cancel is not None and not row % 4096 and cancel.is_set():
+                    raise SearchCancelled(author)
+                if view.removed and not view.snapshot_visible(row):
+                    continue
+                book = view.snapshot.book(row)
+                book_key = snapshot_keys.get(book.author)
+                if book_key is None:
+                    book_key = snapshot_keys[book.author] = normalize_key(book.author)
+                if book_key == key:
+                    found.append(book)
+        store = view.books
+        for row in range(view.rows):
+            if cancel is not None and not row % 4096 and cancel.is_set():
+                raise SearchCancelled(author)
+            if store.author_key(row) == key and (not view.removed or view.visible(row)):
+                found.append(store.book(row))
+        return found
+
+    def isbn_range(self, low, high, limit=None):
+        view = self.index('isbn_bst')
+        books = view.isbn_bst.iter_range(low, high, view.visible)
+        if view.snapshot is not None:
+            books = heapq.merge(books, view.snapshot.scan('isbn', low, high, view.snapshot_visible),
+                                key=lambda b: normalize_key(b.isbn))
+        return itertools.islice(books, limit)
+
+    def title_prefix(self, prefix, limit=None):
+        view = self.index('title_bst')
+        books = view.title_bst.prefix(prefix, accept=view.visible)
+        if view.snapshot is not None:
+            books = heapq.merge(books, view.snapshot.prefix('title', prefix, accept=view.snapshot_visible),
+                                key=lambda b: normalize_key(b.title))
+        return itertools.islice(books, limit)
+
+    def suggest(self, prefix, search_by, k=8):
+        prefix = normalize_key(prefix.strip())
+        if not prefix:
+            return []
+        if search_by == "title":
+            view = self.index('title_trie')
+            found = view.title_trie.complete(prefix, k, view.visible)
+        elif search_by == "author":
+            view = self.index('author_trie')
+            found = view.author_trie.complete(prefix, k, view.visible)
+        elif search_by == "isbn":
+            view = self.index('isbn_bst')
+            found = [book.isbn for book in view.isbn_bst.prefix(prefix, k, view.visible)]
+        else:
+            return []
+        if view.snapshot is not None and len(found) < k:
+            for book in view.snapshot.prefix(search_by, prefix, k * 10, view.snapshot_visible):
+                value = getattr(book, search_by)
+                if value not in found:
+                    found.append(value)
+                    if len(found) >= k:
+                        break
+        return found
+
+def shard_worker(conn):
+    # One shard of a ShardedLibrary: runs (op, args) requests from the pipe
+    # against its own LibrarySystem until it receives None
+    library = LibrarySystem(samples=False)
+
+    def load(rows):
+        library.load_books(Book(*row) for row in rows)
+        library.build_indexes()
+        return len(rows)
+
+    def update(isbn, fields):
+        old = library.find('isbn', isbn)
+        return old, library.update_book(isbn, **fields)
+
+    def fuzzy(query, limit):
+        view = library.index('fuzzy_index')
+        return view.fuzzy_index.search(normalize_key(query.strip()), limit, view.visible, scored=True)
+
+    ops = {
+        'load': load,
+        'add_book': library.add_book,
+        'remove_book': library.remove_book,
+        'update_book': update,
+        'build_indexes': library.build_indexes,
+        'total_books': library.total_books,
+        'find': library.find,
+        'author_search': library.author_search,
+        'linear_author_search': library.linear_author_search,
+        'fuzzy_search': fuzzy,
+        'isbn_range': lambda low, high, limit: list(library.isbn_range(low, high, limit)),
+        'title_prefix': lambda prefix, limit: list(library.title_prefix(prefix, limit)),
+        'suggest': library.suggest,
+        'instrument': library.instrument,
+        'metrics': library.metrics,
+    }
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        op, args = request
+        try:
+            conn.send(('ok', ops[op](*args)))
+        except Exception as e:
+            conn.send(('error', e))
+    conn.close()
+
+def round_robin(lists):
+    # Merges ranked lists by rank: every list's first item, then every second...
+    return [item for items in itertools.zip_longest(*lists) for item in items if item is not None]
+
+# The catalog split across worker processes, each with its own indexes, so
+# loads and searches are not bound by one interpreter's GIL or heap. Books
+# are placed by a hash of their ISBN, so ISBN lookups go to one shard; a
+# term directory maps every title and author to a bitmask of the shards
+# holding it, so those lookups only ask the shards that can answer. Other
+# searches go to every shard and the results are merged. Offers the query
+# side of LibrarySystem (enough for SearchService); it keeps no log of its
+# own, so callers load it from a LibrarySystem's books.
+class ShardedLibrary:
+    def __init__(self, shards=None, search_log_size=SEARCH_LOG_SIZE, fulltext_path=None):
+        import multiprocessing
+        self.shards = shards or os.cpu_count() or 1
+        # PDFs are indexed by the coordinator, which knows every book
+        self.fulltext = FullTextIndex(fulltext_path) if fulltext_path else None
+        self.search_log = SearchLog(search_log_size)
+        self.stats = SearchStats()
+        self.cache = QueryCache()
+        self.directory = {'title': {}, 'author': {}}
+        self._write_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(self.shards)]
+        self._conns = []
+        self._workers = []
+        for _ in range(self.shards):
+            conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=shard_worker, args=(child_conn,), daemon=True)
+            worker.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._workers.append(worker)
+        if METRICS.enabled:
+            self.instrument()
+
+    def close(self):
+        for conn, worker in zip(self._conns, self._workers):
+            conn.send(None)
+            worker.join()
+            conn.close()
+        self._conns = []
+
+    def shard_of(self, isbn):
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32(normalize_key(isbn.strip()).encode('utf-8')) % self.shards
+
+    def _scatter(self, requests):
+        # requests maps shard -> (op, args). Every shard gets its request
+        # before any reply is read, so they work in parallel; replies come
+        # back in shard order.
+        shards = sorted(requests)
+        for shard in shards:
+            self._locks[shard].acquire()
+        try:
+            for shard in shards:
+                self._conns[shard].send(requests[shard])
+            replies = [self._conns[shard].recv() for shard in shards]
+        finally:
+            for shard in shards:
+                self._locks[shard].release()
+        for status, result in replies:
+            if status == 'error':
+                raise result
+        return [result for _, result in replies]
+
+    def _ask(self, shards, op, *args):
+        return self._scatter({shard: (op, args) for shard in shards})
+
+    def _all(self):
+        return range(self.shards)
+
+    def _shards_with(self, kind, key):
+        mask = self.directory[kind].get(normalize_key(key.strip()), 0)
+        return [shard for shard in self._all() if mask >> shard & 1]
+
+    def _note_terms(self, book, shard):
+        # Entries are never cleared on removal; a stale bit only costs one
+        # shard an empty lookup
+        bit = 1 << shard
+        for kind, key in (('title', book.title), ('author', book.author)):
+            terms = self.directory[kind]
+            key = normalize_key(key)
+            terms[key] = terms.get(key, 0) | bit
+
+    def load_books(self, books):
+        start = time.perf_counter()
+        batches = [[] for _ in self._all()]
+        with self._write_lock:
+            for book in books:
+                shard = self.shard_of(book.isbn)
+                batches[shard].append((book.title, book.author, book.isbn, book.pdf_path))
+                self._note_terms(book, shard)
+            # Each shard loads and indexes its part in its own process
+            rows = sum(self._scatter({shard: ('load', (batch,)) for shard, batch in enumerate(batches)}))
+        self.cache.clear()
+        elapsed = time.perf_counter() - start
+        return {
+            'rows': rows,
+            'seconds': elapsed,
+            'rows_per_sec': rows / elapsed if elapsed else 0.0
+        }
+
+    def bulk_load(self, path):
+        return self.load_books(read_catalog(path))
+
+    def build_indexes(self, names=INDEX_NAMES):
+        self._ask(self._all(), 'build_indexes', names)
+
+    def add_book(self, book):
+        shard = self.shard_of(book.isbn)
+        with self._write_lock:
+            self._ask([shard], 'add_book', book)
+            self._note_terms(book, shard)
+        self.cache.invalidate(book_tags(book))
+        self.index_pdfs([book])
+
+    def remove_book(self, isbn):
+        with self._write_lock:
+            book, = self._ask([self.shard_of(isbn)], 'remove_book', isbn)
+        if book is not None:
+            self.cache.invalidate(book_tags(book) | CHANGED_BOOK_TAGS)
+        return book
+
+    def update_book(self, isbn, /, **fields):
+        unknown = set(fields) - set(BOOK_FIELDS)
+        if unknown:
+            raise TypeError(f"update_book() got unexpected fields: {', '.join(sorted(unknown))}")
+        if not all(isinstance(value, str) for value in fields.values()):
+            raise TypeError("update_book() fields must be strings")
+        shard = self.shard_of(isbn)
+        target = self.shard_of(fields.get('isbn', isbn))
+        with self._write_lock:
+            if shard == target:
+                # The shard rejects an ISBN that another of its books has
+                (old, new), = self._ask([shard], 'update_book', isbn, fields)
+            else:
+                # A new ISBN can move the book to another shard
+                if self._ask([target], 'find', 'isbn', fields['isbn'])[0] is not None:
+                    raise ValueError(f"ISBN {fields['isbn']} is already taken")
+                old, = self._ask([shard], 'remove_book', isbn)
+                new = None if old is None else Book(**dict(book_dict(old), **fields))
+                if new is not None:
+                    try:
+                        self._ask([target], 'add_book', new)
+                    except BaseException:
+                        # Put the book back rather than lose it
+                        self._ask([shard], 'add_book', old)
+                        raise
+            if new is not None:
+                self._note_terms(new, target)
+        if new is not None:
+            self.cache.invalidate(book_tags(old) | book_tags(new) | CHANGED_BOOK_TAGS)
+            self.index_pdfs([new])
+        return new
+
+    def log_search(self, entry):
+        self.search_log.append(entry, 0)
+        self.stats.record(entry)
+
+    def total_books(self):
+        return sum(self._ask(self._all(), 'total_books'))
+
+    def instrument(self, enabled=True):
+        METRICS.enabled = enabled
+        self._ask(self._all(), 'instrument', enabled)
+
+    def metrics(self):
+        # Search latency is measured here; index metrics come from each
+        # shard, labelled with its number
+        report = METRICS.report()
+        for shard, part in enumerate(self._ask(self._all(), 'metrics')):
+            for kind in ('histograms', 'gauges'):
+                report[kind].extend(dict(entry, labels=dict(entry['labels'], shard=str(shard)))
+                                    for entry in part[kind] if entry['name'] != 'metrics_enabled')
+        return report
+
+    def find(self, kind, key, method='hash'):
+        shards = [self.shard_of(key)] if kind == 'isbn' else self._shards_with(kind, key)
+        return next((book for book in self._ask(shards, 'find', kind, key, method) if book), None)
+
+    def author_search(self, author):
+        return [book for books in self._ask(self._shards_with('author', author), 'author_search', author)
+                for book in books]
+
+    def linear_author_search(self, author, cancel=None):
+        # Shards cannot see the cancel event, so it is checked either side
+        if cancel is not None and cancel.is_set():
+            raise SearchCancelled(author)
+        found = [book for books in self._ask(self._all(), 'linear_author_search', author) for book in books]
+        if cancel is not None and cancel.is_set():
+            raise SearchCancelled(author)
+        return found
+
+    def fuzzy_search(self, query, limit=20):
+        # Shards return (edit distance, book) pairs, best first
+        parts = self._ask(self._all(), 'fuzzy_search', query, limit)
+        return [book for _, book in itertools.islice(heapq.merge(*parts, key=itemgetter(0)), limit)]
+
+    def isbn_range(self, low, high, limit=None):
+        parts = self._ask(self._all(), 'isbn_range', low, high, limit)
+        return itertools.islice(heapq.merge(*parts, key=lambda b: normalize_key(b.isbn)), limit)
+
+    def title_prefix(self, prefix, limit=None):
+        parts = self._ask(self._all(), 'title_prefix', prefix, limit)
+        return itertools.islice(heapq.merge(*parts, key=lambda b: normalize_key(b.title)), limit)
+
+    def index_pdfs(self, books):
+        if self.fulltext is None:
+            return 0
+        count = self.fulltext.update(books)
+        if count:
+            self.cache.invalidate({('fulltext',)})
+        return count
+
+    def full_text_search(self, query, limit=10):
+        if self.fulltext is None:
+            return []
+        return self.fulltext.books(query, lambda isbn: self.find('isbn', isbn), limit)
+
+    def suggest(self, prefix, search_by, k=8):
+        found = round_robin(self._ask(self._all(), 'suggest', prefix, search_by, k))
+        return list(dict.fromkeys(found))[:k]
+
+SEARCH_TYPES = ("title", "author", "isbn", "fuzzy", "fulltext")
+
+# Raised inside a search whose cancel event was set by a newer query
+class SearchCancelled(Exception):
+    pass
+
+ANONYMOUS_USER = {'id': 'anonymous', 'name': 'anonymous'}
+
+# GUI-independent search API over a LibrarySystem. Searches read the
+# library's published view, so any number of threads can run them while a
+# writer imports books; logging goes through the locked search log.
+class SearchService:
+    def __init__(self, library):
+        self.library = library
+
+    @staticmethod
+    def normalize(search_type, query):
+        if not isinstance(search_type, str) or not isinstance(query, str):
+            raise ValueError("search type and query must be strings")
+        search_type = search_type.strip().lower()
+        if search_type not in SEARCH_TYPES:
+            raise ValueError(f"unknown search type: {search_type}")
+        return search_type, normalize_key(query.strip())
+
+    def _lookup(self, search_type, key):
+        library = self.library
+        if search_type in ("title", "isbn"):
+            book = library.find(search_type, key)
+            return [book] if book else []
+        if search_type == "author":
+            return library.author_search(key)
+        if search_type == "fulltext":
+            return library.full_text_search(key)
+        return library.fuzzy_search(key)
+
+    def _log(self, search_type, query, user):
+        self.library.log_search({
+            'user': user or ANONYMOUS_USER,
+            'query': query,
+            'type': search_type,
+            'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
+        })
+
+    def search(self, search_type, query, user=None):
+        return self.search_many([(search_type, query)], user)[0]
+
+    def search_many(self, requests, user=None):
+        # Each distinct (type, normalized query) pair is looked up once
+        normalized = [self.normalize(search_type, query) for search_type, query in requests]
+        cache = self.library.cache
+        found = {}
+        for pair in normalized:
+            if pair in found:
+                continue
+            start = time.perf_counter()
+            books = cache.get(('search',) + pair)
+            if books is None:
+                generation = cache.generation
+                books = self._lookup(*pair)
+                cache.put(('search',) + pair, books, query_tags(*pair), generation)
+            found[pair] = books
+            if METRICS.enabled:
+                METRICS.observe('search_seconds', time.perf_counter() - start, type=pair[0])
+        for search_type, query in requests:
+            self._log(search_type.strip().lower(), query, user)
+        return [found[pair] for pair in normalized]
+
+    def compare(self, query, search_by, user=None, cancel=None):
+        # Times every index that can answer the query, for the results window.
+        # cancel is an optional threading.Event checked between (and inside
+        # the slow) lookups. Repeated queries are answered from the cache,
+        # with the timings of the run that filled it.
+        library = self.library
+        began = time.perf_counter()
+        # key is the normalized query; the log keeps what the user typed
+        search_by, key = self.normalize(search_by, query)
+        cached = library.cache.get(('compare', search_by, key))
+        if cached is not None:
+            if METRICS.enabled:
+                METRICS.observe('search_seconds', time.perf_counter() - began, type=search_by)
+            self._log(search_by, query, user)
+            return dict(cached, cached=True)
+        generation = library.cache.generation
+        results = {
+            'cached': False,
+            'bst_time': None,
+            'hash_time': None,
+            'linear_time': None,
+            'fuzzy_time': None,
+            'fulltext_time': None,
+            'bst_result': None,
+            'hash_result': None,
+            'linear_result': None,
+            'fuzzy_result': None,
+            'fulltext_result': None
+        }
+        
+        if search_by == "title":
+            start_time = time.perf_counter()
+            results['bst_result'] = library.find('title', key, 'bst')
+            results['bst_time'] = time.perf_counter() - start_time
+            
+            start_time = time.perf_counter()
+            results['hash_result'] = library.find('title', key, 'hash')
+            results['hash_time'] = time.perf_counter() - start_time
+            
+        elif search_by == "isbn":
+            start_time = time.perf_counter()
+            results['bst_result'] = library.find('isbn', key, 'bst')
+            results['bst_time'] = time.perf_counter() - start_time
+            
+            start_time = time.perf_counter()
+            results['hash_result'] = library.find('isbn', key, 'hash')
+            results['hash_time'] = time.perf_counter() - start_time
+            
+        elif search_by == "fuzzy":
+            start_time = time.perf_counter()
+            results['fuzzy_result'] = library.fuzzy_search(key)
+            results['fuzzy_time'] = time.perf_counter() - start_time
+            
+        elif search_by == "fulltext":
+            start_time = time.perf_counter()
+            results['fulltext_result'] = library.full_text_search(key)
+            results['fulltext_time'] = time.perf_counter() - start_time
+            
+        else:
+            start_time = time.perf_counter()
+            results['hash_result'] = library.author_search(key)
+            results['hash_time'] = time.perf_counter() - start_time
+            
+            start_time = time.perf_counter()
+            results['linear_result'] = library.linear_author_search(key, cancel)
+            results['linear_time'] = time.perf_counter() - start_time
+        
+        if cancel is not None and cancel.is_set():
+            raise SearchCancelled(query)
+        library.cache.put(('compare', search_by, key), results, query_tags(search_by, key), generation)
+        if METRICS.enabled:
+            METRICS.observe('search_seconds', time.perf_counter() - began, type=search_by)
+        self._log(search_by, query, user)
+        return results
+
+# Minimal asyncio HTTP/1.1 front end (keep-alive, JSON responses):
+#   GET  /search?type=title&q=...&user=...
+#   POST /search_many   body: [["title", "..."], ["isbn", "..."], ...]
+#   GET  /metrics       Prometheus text; /metrics?format=json for JSON
+class SearchServer:
+    def __init__(self, service, host='127.0.0.1', port=8080):
+        self.service = service
+        self.host = host
+        self.port = port
+
+    async def start(self):
+        import asyncio
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        return server
+
+    async def serve_forever(self):
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        import asyncio
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                # Searches run on worker threads; a slow one (fuzzy, full
+                # text, a first query building its index) must not hold up
+                # every other connection on this loop
+                status, payload = await asyncio.get_running_loop().run_in_executor(
+                    None, self.route, method, target, body)
+                if isinstance(payload, str):
+                    content_type = "text/plain; version=0.0.4"
+                    data = payload.encode('utf-8')
+                else:
+                    content_type = "application/json"
+                    data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}; charset=utf-8\r\n"
+                             f"Content-Length: {len(data)}\r\n\r\n".encode('latin-1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def route(self, method, target, body):
+        import urllib.parse
+        url = urllib.parse.urlsplit(target)
+        params = urllib.parse.parse_qs(url.query)
+        user_id = params.get('user', [None])[0]
+        user = {'id': user_id, 'name': user_id} if user_id else None
+        try:
+            if method == 'GET' and url.path == '/search':
+                books = self.service.search(params.get('type', ['title'])[0], params.get('q', [''])[0], user)
+                return '200 OK', [book_dict(book) for book in books]
+            if method == 'POST' and url.path == '/search_many':
+                requests = json.loads(body)
+                if not isinstance(requests, list) or not all(
+                        isinstance(r, list) and len(r) == 2 and all(isinstance(v, str) for v in r)
+                        for r in requests):
+                    raise ValueError("expected a list of [type, query] string pairs")
+                requests = [tuple(r) for r in requests]
+                return '200 OK', [[book_dict(book) for book in books]
+                                  for books in self.service.search_many(requests, user)]
+            if method == 'GET' and url.path == '/metrics':
+                report = self.service.library.metrics()
+                if params.get('format', [''])[0] == 'json':
+                    return '200 OK', report
+                return '200 OK', prometheus_text(report)
+        except (ValueError, TypeError) as e:
+            return '400 Bad Request', {'error': str(e)}
+        except Exception as e:
+            return '500 Internal Server Error', {'error': f"{type(e).__name__}: {e}"}
+        return '404 Not Found', {'error': f"no route for {method} {url.path}"}
+
+# Sequence view of an iterator that pulls items only once they are indexed.
+# Until the iterator runs out its length is what has been pulled plus one
+# more page, so a scrollbar always has somewhere further to go.
+class LazyRows:
+    def __init__(self, iterable, page=100):
+        self._iterator = iter(iterable)
+        self._items = []
+        self._page = page
+        self._done = False
+
+    def __len__(self):
+        return len(self._items) + (0 if self._done else self._page)
+
+    def __getitem__(self, i):
+        while i >= len(self._items) and not self._done:
+            try:
+                self._items.append(next(self._iterator))
+            except StopIteration:
+                self._done = True
+        return self._items[i]
 
-    def linear_author_search(self, author):
-        return [book for book in self.books if book.author.lower() == author.lower()]
+# Scrollable list that only renders the rows in view. rows is a sequence or
+# any iterable (wrapped in LazyRows); format turns a row into its line.
+# Opening it costs one screenful, however many rows there are.
+class VirtualList(ttk.Frame):
+    def __init__(self, parent, rows, format=str, height=15, **listbox_options):
+        super().__init__(parent)
+        self.rows = rows if hasattr(rows, '__getitem__') else LazyRows(rows)
+        self.format = format
+        self.top = 0
+        self.page = height
+        self.scrollbar = ttk.Scrollbar(self, command=self.yview)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(self, height=height, activestyle='none', **listbox_options)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.linespace = tkfont.Font(font=self.listbox.cget('font')).metrics('linespace') + 1
+        self.listbox.bind('<Configure>', self.on_resize)
+        self.listbox.bind('<MouseWheel>', self.on_wheel)
+        self.listbox.bind('<Button-4>', lambda e: self.scroll_to(self.top - 3))
+        self.listbox.bind('<Button-5>', lambda e: self.scroll_to(self.top + 3))
+        self.listbox.bind('<Prior>', lambda e: self.scroll_to(self.top - self.page))
+        self.listbox.bind('<Next>', lambda e: self.scroll_to(self.top + self.page))
+        self.refresh()
+
+    def on_resize(self, event):
+        page = max(1, event.height // self.linespace)
+        if page != self.page:
+            self.page = page
+            self.refresh()
+
+    def on_wheel(self, event):
+        # Windows sends 120 per notch, scrolled 3 lines like X11's
+        # Button-4/5; macOS sends a few units per event, scrolled 1 line
+        if not event.delta:
+            return 'break'
+        lines = max(1, abs(event.delta) // 120 * 3)
+        return self.scroll_to(self.top - lines if event.delta > 0 else self.top + lines)
+
+    def yview(self, *args):
+        # Scrollbar protocol: ('moveto', fraction) or ('scroll', n, 'units'|'pages')
+        if args[0] == 'moveto':
+            self.scroll_to(int(float(args[1]) * len(self.rows)))
+        elif args[0] == 'scroll':
+            step = self.page if args[2] == 'pages' else 1
+            self.scroll_to(self.top + int(args[1]) * step)
+
+    def scroll_to(self, top):
+        self.top = top
+        self.refresh()
+        return 'break'
+
+    def refresh(self):
+        self.top = max(0, min(self.top, len(self.rows) - self.page))
+        lines = []
+        for i in range(self.top, self.top + self.page):
+            try:
+                lines.append(self.format(self.rows[i]))
+            except IndexError:
+                break
+        self.listbox.delete(0, tk.END)
+        self.listbox.insert(tk.END, *lines)
+        total = len(self.rows)
+        if total:
+            self.scrollbar.set(self.top / total, (self.top + len(lines)) / total)
+        else:
+            self.scrollbar.set(0, 1)
 
 class LibraryApp(tk.Tk):
     def __init__(self):
@@ -127,11 +3283,34 @@ class LibraryApp(tk.Tk):
         self.geometry("1200x800")
         self.configure(bg=BG_COLOR)
         
-        self.library = LibrarySystem()
+        started = time.perf_counter()
+        self.library = LibrarySystem(snapshot_path=CATALOG_SNAPSHOT, log_path=CATALOG_LOG,
+                                     fulltext_path=FULLTEXT_INDEX)
+        self.startup_times = {
+            'imports_ms': (IMPORTS_DONE - STARTUP_BEGAN) * 1e3,
+            'catalog_ms': (time.perf_counter() - started) * 1e3,
+        }
+        self.search_service = SearchService(self.library)
+        self.protocol("WM_DELETE_WINDOW", self.exit_app)
         self.current_user = None
+        self._suggest_job = None
+        self._benchmark = None
+        # Searches run on worker threads; _search is (future, cancel event,
+        # search type) of the one whose results the UI is waiting for
+        self.search_pool = None
+        self._search = None
         self.style = ttk.Style()
         self.configure_styles()
         self.show_home_page()
+        self.after(0, self.first_paint)
+
+    def first_paint(self):
+        # The window is on screen: record the time and build the indexes
+        # (and pick up new or changed PDFs) behind it rather than before it
+        self.update_idletasks()
+        self.startup_times['first_paint_ms'] = (time.perf_counter() - STARTUP_BEGAN) * 1e3
+        threading.Thread(target=self.library.build_indexes, daemon=True).start()
+        self.library.queue_pdfs()
 
     def configure_styles(self):
         self.style.theme_use('clam')
@@ -168,7 +3347,19 @@ class LibraryApp(tk.Tk):
                      fieldbackground=[('readonly', ENTRY_COLOR)],
                      selectbackground=[('readonly', PRIMARY_COLOR)])
 
+    def exit_app(self):
+        self.cancel_search()
+        if self.search_pool is not None:
+            self.search_pool.shutdown(wait=False, cancel_futures=True)
+        try:
+            self.library.save_snapshot()
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not save catalog: {e}", parent=self)
+        self.library.close()
+        self.destroy()
+
     def clear_window(self):
+        self.cancel_search()
         for widget in self.winfo_children():
             widget.destroy()
 
@@ -188,7 +3379,7 @@ class LibraryApp(tk.Tk):
         buttons = [
             ("📚 Manager Login", self.show_manager_login),
             ("👤 User Login", self.show_user_login),
-            ("🚪 Exit", self.destroy)
+            ("🚪 Exit", self.exit_app)
         ]
         
         for text, cmd in buttons:
@@ -235,6 +3426,7 @@ class LibraryApp(tk.Tk):
         
         cards = [
             ("📥 Add Book", self.show_add_book),
+            ("📦 Import Catalog", self.import_catalog),
             ("📊 View Logs", self.show_logs),
             ("📈 Statistics", self.show_stats)
         ]
@@ -247,10 +3439,11 @@ class LibraryApp(tk.Tk):
         stats_frame = ttk.Frame(self, style='Stats.TFrame')
         stats_frame.pack(pady=30)
         
+        today = time.strftime("%Y-%m-%d")
         stats = [
-            ("📚 Total Books", len(self.library.books)),
-            ("👥 Active Users", "1,234"),
-            ("🔍 Searches Today", "89")
+            ("📚 Total Books", f"{self.library.total_books():,}"),
+            ("👥 Active Users", f"{self.library.stats.active_users_on(today):,}"),
+            ("🔍 Searches Today", f"{self.library.stats.searches_on(today):,}")
         ]
         
         for i, (label, value) in enumerate(stats):
@@ -304,30 +3497,33 @@ class LibraryApp(tk.Tk):
         messagebox.showinfo("Success", "Book added successfully", parent=self)
         self.show_manager_dashboard()
 
+    def import_catalog(self):
+        path = filedialog.askopenfilename(
+            parent=self, title="Import Catalog",
+            filetypes=[("Catalog files", "*.csv *.jsonl"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            report = self.library.bulk_load(path)
+        except (OSError, KeyError, ValueError) as e:
+            messagebox.showerror("Error", f"Import failed: {e}", parent=self)
+            return
+        messagebox.showinfo("Success",
+            f"Imported {report['rows']:,} books in {report['seconds']:.2f} s "
+            f"({report['rows_per_sec']:,.0f} rows/s)", parent=self)
+        self.show_manager_dashboard()
+
     def show_logs(self):
         self.clear_window()
         self.create_nav_button("← Dashboard", self.show_manager_dashboard).pack(anchor='nw', padx=10, pady=10)
         ttk.Label(self, text="Search Logs", style='SubHeader.TLabel').pack(pady=30)
         
-        log_frame = ttk.Frame(self)
-        log_frame.pack(pady=20, fill=tk.BOTH, expand=True)
-        
-        scrollbar = ttk.Scrollbar(log_frame)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        log_text = tk.Text(log_frame, height=15, width=80, yscrollcommand=scrollbar.set,
-                          bg=BG_COLOR, fg=TEXT_COLOR, insertbackground=TEXT_COLOR,
-                          font=('Helvetica', 10))
-        log_text.pack(fill=tk.BOTH, expand=True)
-        scrollbar.config(command=log_text.yview)
-        
-        for log in self.library.search_log:
-            log_text.insert(tk.END, 
-                f"User: {log['user']['name']} (ID: {log['user']['id']})\n"
-                f"Query: {log['query']} ({log['type']})\n"
-                f"Time: {log['timestamp']}\n"
-                "──────────────────────────────\n"
-            )
+        ttk.Label(self, text=f"{len(self.library.search_log):,} searches").pack()
+        log_list = VirtualList(self, self.library.search_log, format=lambda log: (
+            f"{log['timestamp']}   {log['user']['name']} (ID: {log['user']['id']})   "
+            f"{log['query']} ({log['type']})"),
+            width=80, bg=BG_COLOR, fg=TEXT_COLOR, font=('Helvetica', 10))
+        log_list.pack(pady=20, fill=tk.BOTH, expand=True)
         
         ttk.Button(self, text="Back", command=self.show_manager_dashboard).pack(pady=20)
 
@@ -339,14 +3535,14 @@ class LibraryApp(tk.Tk):
         stats_frame = ttk.Frame(self, style='Stats.TFrame')
         stats_frame.pack(pady=20, fill=tk.BOTH, expand=True)
         
-        # Add charts or additional statistics here
+        stats = self.library.stats
+        today = time.strftime("%Y-%m-%d")
         ttk.Label(stats_frame, text="📊 Search Distribution", style='StatLabel.TLabel').pack()
         
-        # Sample chart data
+        # Share of all searches by type, in percent
         chart_data = {
-            'Title Searches': 45,
-            'Author Searches': 30,
-            'ISBN Searches': 25
+            f"{search_type.title()} Searches": stats.by_type.get(search_type, 0) * 100 / max(stats.total, 1)
+            for search_type in SEARCH_TYPES
         }
         
         chart_frame = ttk.Frame(stats_frame)
@@ -355,6 +3551,120 @@ class LibraryApp(tk.Tk):
         for i, (label, value) in enumerate(chart_data.items()):
             ttk.Label(chart_frame, text=label).grid(row=i, column=0, padx=10, pady=5, sticky='w')
             ttk.Progressbar(chart_frame, length=200, value=value).grid(row=i, column=1, padx=10)
+            ttk.Label(chart_frame, text=f"{value:.0f}%").grid(row=i, column=2, padx=10, sticky='w')
+        
+        summary = (f"Total searches: {stats.total:,}   •   Today: {stats.searches_on(today):,}   •   "
+                   f"Distinct users: ~{stats.users.count():,}   •   Active today: ~{stats.active_users_on(today):,}")
+        ttk.Label(stats_frame, text=summary).pack(pady=5)
+        
+        # Today's searches per hour
+        ttk.Label(stats_frame, text="🕒 Searches by Hour (today)", style='StatLabel.TLabel').pack(pady=(15, 0))
+        hours = stats.hours_of(today)
+        hour_frame = ttk.Frame(stats_frame)
+        hour_frame.pack(pady=10)
+        peak = max(hours) or 1
+        for h, count in enumerate(hours):
+            ttk.Progressbar(hour_frame, orient='vertical', length=60,
+                            value=count * 100 / peak).grid(row=0, column=h, padx=1)
+            ttk.Label(hour_frame, text=f"{h:02d}", font=('Helvetica', 7)).grid(row=1, column=h)
+        
+        ttk.Label(stats_frame, text="🔥 Top Queries", style='StatLabel.TLabel').pack(pady=(15, 0))
+        top_frame = ttk.Frame(stats_frame)
+        top_frame.pack(pady=10)
+        for i, ((search_type, query), count) in enumerate(stats.top_queries.top(5)):
+            ttk.Label(top_frame, text=f"{query} ({search_type})").grid(row=i, column=0, padx=10, sticky='w')
+            ttk.Label(top_frame, text=f"{count:,}").grid(row=i, column=1, padx=10, sticky='e')
+        
+        cache = self.library.cache.stats()
+        ttk.Label(stats_frame, text="⚡ Query Cache", style='StatLabel.TLabel').pack(pady=(15, 0))
+        ttk.Label(stats_frame, text=(
+            f"Hit rate: {cache['hit_rate']:.0%} ({cache['hits']:,} hits, {cache['misses']:,} misses)   •   "
+            f"Entries: {cache['entries']:,} / {cache['capacity']:,}   •   "
+            f"Evictions: {cache['evictions']:,}   •   Invalidations: {cache['invalidations']:,}")).pack(pady=5)
+        
+        if self.library.fulltext is not None:
+            fulltext = self.library.fulltext.stats()
+            ttk.Label(stats_frame, text="📄 PDF Full-Text Index", style='StatLabel.TLabel').pack(pady=(15, 0))
+            ttk.Label(stats_frame, text=(
+                f"PDFs indexed: {fulltext['documents']:,}   •   Terms: {fulltext['terms']:,}   •   "
+                f"Segments: {fulltext['segments']}   •   Size: {fulltext['bytes'] / 1e6:.1f} MB")).pack(pady=5)
+        
+        ttk.Label(stats_frame, text="🔬 Index Instrumentation", style='StatLabel.TLabel').pack(pady=(15, 0))
+        metrics_frame = ttk.Frame(stats_frame)
+        metrics_frame.pack(pady=5)
+        self.metrics_on = tk.BooleanVar(value=METRICS.enabled)
+        ttk.Checkbutton(metrics_frame, text="Collect hot-path counters", variable=self.metrics_on,
+                        command=self.toggle_metrics).pack(side=tk.LEFT, padx=10)
+        ttk.Button(metrics_frame, text="Export JSON",
+                   command=lambda: self.export_metrics("json")).pack(side=tk.LEFT, padx=5)
+        ttk.Button(metrics_frame, text="Export Prometheus",
+                   command=lambda: self.export_metrics("prometheus")).pack(side=tk.LEFT, padx=5)
+        for line in self.metrics_lines(self.library.metrics()):
+            ttk.Label(stats_frame, text=line).pack()
+
+    @staticmethod
+    def metrics_lines(report):
+        gauges = defaultdict(dict)
+        for gauge in report['gauges']:
+            gauges[gauge['labels'].get('index', '')][gauge['name']] = gauge['value']
+        lines = []
+        for name in INDEX_NAMES:
+            shape = gauges.get(name)
+            if shape is None:
+                continue
+            if 'bst_height' in shape:
+                lines.append(f"{name}: height {shape['bst_height']} for {shape['index_entries']:,} books")
+            elif 'hash_load_factor' in shape:
+                lines.append(f"{name}: load factor {shape['hash_load_factor']:.2f}, "
+                             f"{shape['hash_tombstones']:,} tombstones")
+            elif name == 'author_hash':
+                authors = gauges['']
+                lines.append(f"author_hash: {authors['author_lists']:,} authors, "
+                             f"{authors['author_list_rows_mean']:.1f} books each on average, "
+                             f"at most {authors['author_list_rows_max']:,}")
+        for histogram in report['histograms']:
+            if not histogram['count']:
+                continue
+            name, labels = histogram['name'], histogram['labels']
+            scale = 1e3 if name == 'search_seconds' else 1
+            mean = histogram['sum'] / histogram['count'] * scale
+            # Quantiles are known to the bucket: "≤ bound", or past the last one
+            p50, p95 = (f"≤ {bound * scale:g}" if bound is not None
+                        else f"> {histogram['buckets'][-1][0] * scale:g}"
+                        for bound in (histogram_quantile(histogram, q) for q in (0.5, 0.95)))
+            if name == 'search_seconds':
+                lines.append(f"{labels['type'].title()} searches: {histogram['count']:,}, "
+                             f"mean {mean:.2f} ms, p50 {p50} ms, p95 {p95} ms")
+            else:
+                what = {'bst_nodes_visited': "BST nodes visited", 'hash_probes': "Hash probes",
+                        'author_rows': "Author list rows"}[name]
+                where = f" ({labels['index']})" if 'index' in labels else ""
+                lines.append(f"{what}{where}: mean {mean:.1f}, p50 {p50}, p95 {p95} "
+                             f"over {histogram['count']:,} lookups")
+        if not report['enabled'] and not report['histograms']:
+            lines.append("Counters are off; switch them on to see per-search work")
+        return lines
+
+    def toggle_metrics(self):
+        self.library.instrument(self.metrics_on.get())
+        self.show_stats()
+
+    def export_metrics(self, fmt):
+        json_format = fmt == "json"
+        path = filedialog.asksaveasfilename(
+            parent=self, title="Export Metrics", defaultextension=".json" if json_format else ".prom",
+            filetypes=[("JSON", "*.json")] if json_format else [("Prometheus text", "*.prom *.txt")])
+        if not path:
+            return
+        report = self.library.metrics()
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                if json_format:
+                    json.dump(report, f, ensure_ascii=False, indent=2)
+                else:
+                    f.write(prometheus_text(report))
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not export metrics: {e}", parent=self)
 
     def show_user_login(self):
         self.clear_window()
@@ -397,74 +3707,108 @@ class LibraryApp(tk.Tk):
         search_frame.pack(pady=20)
         
         ttk.Label(search_frame, text="Search By:").grid(row=0, column=0, padx=10)
-        self.search_type = ttk.Combobox(search_frame, values=["Title", "Author", "ISBN"], state="readonly")
+        self.search_type = ttk.Combobox(search_frame, values=["Title", "Author", "ISBN", "Fuzzy", "Full Text"],
+                                        state="readonly")
         self.search_type.current(0)
         self.search_type.grid(row=0, column=1, padx=10)
         
         ttk.Label(search_frame, text="Search Query:").grid(row=1, column=0, padx=10)
         self.search_entry = ttk.Entry(search_frame, width=30)
         self.search_entry.grid(row=1, column=1, padx=10)
+        self.search_entry.bind("<KeyRelease>", self.schedule_suggestions)
+        self.search_entry.bind("<Return>", lambda e: self.search_book())
+        self.search_type.bind("<<ComboboxSelected>>", self.schedule_suggestions)
+        
+        self.suggestion_list = tk.Listbox(search_frame, height=6, width=30,
+                                          bg=ENTRY_COLOR, fg=TEXT_COLOR)
+        self.suggestion_list.grid(row=2, column=1, padx=10, sticky='ew')
+        self.suggestion_list.bind("<<ListboxSelect>>", self.use_suggestion)
         
         btn_frame = ttk.Frame(self)
         btn_frame.pack(pady=20)
         ttk.Button(btn_frame, text="Search", command=self.search_book, style='Accent.TButton').pack(side=tk.LEFT, padx=10)
         ttk.Button(btn_frame, text="History", command=self.show_search_history).pack(side=tk.LEFT, padx=10)
+        self.search_progress = ttk.Progressbar(btn_frame, mode='indeterminate', length=120)
+
+    def schedule_suggestions(self, event=None):
+        if event is not None and event.keysym in ("Return", "Up", "Down"):
+            return
+        if self._suggest_job:
+            self.after_cancel(self._suggest_job)
+        self._suggest_job = self.after(SUGGEST_DELAY_MS, self.update_suggestions)
+
+    def update_suggestions(self):
+        self._suggest_job = None
+        if not self.suggestion_list.winfo_exists():
+            return
+        suggestions = self.library.suggest(self.search_entry.get(),
+                                           self.search_type.get().lower())
+        self.suggestion_list.delete(0, tk.END)
+        for suggestion in suggestions:
+            self.suggestion_list.insert(tk.END, suggestion)
+
+    def use_suggestion(self, event):
+        selection = self.suggestion_list.curselection()
+        if not selection:
+            return
+        self.search_entry.delete(0, tk.END)
+        self.search_entry.insert(0, self.suggestion_list.get(selection[0]))
 
     def search_book(self):
         query = self.search_entry.get()
-        search_by = self.search_type.get().lower()
+        search_by = self.search_type.get().lower().replace(" ", "")
         
         if not query:
             messagebox.showerror("Error", "Please enter a search query", parent=self)
             return
         
-        results = self.perform_search(query, search_by)
-        self.display_results(results, search_by)
+        # A newer query replaces whatever is still running
+        self.cancel_search()
+        if self.search_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.search_pool = ThreadPoolExecutor(SEARCH_WORKERS, thread_name_prefix='search')
+        cancel = threading.Event()
+        future = self.search_pool.submit(self.perform_search, query, search_by, cancel)
+        self._search = (future, cancel, search_by)
+        self.search_progress.pack(side=tk.LEFT, padx=10)
+        self.search_progress.start(15)
+        self.after(SEARCH_POLL_MS, self.poll_search, future)
 
-    def perform_search(self, query, search_by):
-        start_time = time.perf_counter()
-        results = {
-            'bst_time': None,
-            'hash_time': None,
-            'linear_time': None,
-            'bst_result': None,
-            'hash_result': None,
-            'linear_result': None
-        }
-        
-        if search_by == "title":
-            results['bst_result'] = self.library.title_bst.search(query)
-            results['bst_time'] = time.perf_counter() - start_time
-            
-            start_time = time.perf_counter()
-            results['hash_result'] = self.library.title_hash.search(query)
-            results['hash_time'] = time.perf_counter() - start_time
-            
-        elif search_by == "isbn":
-            results['bst_result'] = self.library.isbn_bst.search(query)
-            results['bst_time'] = time.perf_counter() - start_time
-            
-            start_time = time.perf_counter()
-            results['hash_result'] = self.library.isbn_hash.search(query)
-            results['hash_time'] = time.perf_counter() - start_time
-            
-        else:
-            start_time = time.perf_counter()
-            results['hash_result'] = self.library.author_hash.get(query.lower(), [])
-            results['hash_time'] = time.perf_counter() - start_time
-            
-            start_time = time.perf_counter()
-            results['linear_result'] = self.library.linear_author_search(query)
-            results['linear_time'] = time.perf_counter() - start_time
-        
-        self.library.search_log.append({
-            'user': self.current_user,
-            'query': query,
-            'type': search_by,
-            'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")
-        })
-        
-        return results
+    def perform_search(self, query, search_by, cancel=None):
+        return self.search_service.compare(query, search_by, self.current_user, cancel)
+
+    def cancel_search(self):
+        if self._search is None:
+            return
+        future, cancel, _ = self._search
+        future.cancel()
+        cancel.set()
+        self._search = None
+        self.stop_progress()
+
+    def stop_progress(self):
+        if self.search_progress.winfo_exists():
+            self.search_progress.stop()
+            self.search_progress.pack_forget()
+
+    def poll_search(self, future):
+        if self._search is None or self._search[0] is not future:
+            return
+        if not future.done():
+            self.after(SEARCH_POLL_MS, self.poll_search, future)
+            return
+        search_by = self._search[2]
+        self._search = None
+        self.stop_progress()
+        try:
+            results = future.result()
+        except SearchCancelled:
+            return
+        except Exception as e:
+            messagebox.showerror("Error", f"Search failed: {e}", parent=self)
+            return
+        if self.search_progress.winfo_exists():
+            self.display_results(results, search_by)
 
     def display_results(self, results, search_type):
         result_window = tk.Toplevel(self)
@@ -473,39 +3817,69 @@ class LibraryApp(tk.Tk):
         result_window.configure(bg=BG_COLOR)
         
         self.create_nav_button("← Close", result_window.destroy).pack(anchor='nw', padx=10, pady=10)
+        if results.get('cached'):
+            ttk.Label(result_window, text="Answered from the query cache (timings are from the first run)").pack()
         result_frame = ttk.Frame(result_window)
         result_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=20)
         
         if search_type in ["title", "isbn"]:
-            self.display_bst_hash_results(result_frame, results)
+            self.display_bst_hash_results(result_frame, results, search_type)
+        elif search_type == "fuzzy":
+            self.display_ranked_results(result_frame, 'N-gram Fuzzy Index', results['fuzzy_time'],
+                                        results['fuzzy_result'], self.benchmark_text('fuzzy', 'ngram'))
+        elif search_type == "fulltext":
+            self.display_ranked_results(result_frame, 'PDF Full-Text Index', results['fulltext_time'],
+                                        results['fulltext_result'], "not benchmarked")
         else:
             self.display_author_results(result_frame, results)
 
-    def display_bst_hash_results(self, frame, results):
+    def benchmark_text(self, search_type, method):
+        # p50 / p95 hit latency from the headless benchmark, at the measured
+        # catalog size closest to ours
+        if self._benchmark is None:
+            try:
+                with open(BENCHMARK_RESULTS, encoding='utf-8') as f:
+                    self._benchmark = json.load(f)
+            except (OSError, ValueError):
+                self._benchmark = {}
+        entries = [r for r in self._benchmark.get('results', ())
+                   if r['search_type'] == search_type and r['method'] == method
+                   and r['case'] == 'hit' and r['distribution'] == 'random']
+        if not entries:
+            return "not benchmarked"
+        size = max(self.library.total_books(), 1)
+        best = min(entries, key=lambda r: abs(math.log(r['size'] / size)))
+        return f"{best['p50_us'] / 1000:.3f} / {best['p95_us'] / 1000:.3f} (n={best['size']:,})"
+
+    def display_bst_hash_results(self, frame, results, search_type):
         content_frame = ttk.Frame(frame)
         content_frame.pack(fill=tk.BOTH, expand=True)
         
         # Comparison Table
-        columns = ('Method', 'Time (ms)', 'Result')
+        columns = ('Method', 'Time (ms)', 'Result', 'Benchmark')
         tree = ttk.Treeview(content_frame, columns=columns, show='headings')
         tree.heading('Method', text='Search Method')
         tree.heading('Time (ms)', text='Time Taken (ms)')
         tree.heading('Result', text='Search Result')
+        tree.heading('Benchmark', text='Benchmark p50 / p95 (ms)')
         
         tree.column('Method', width=150)
         tree.column('Time (ms)', width=100)
         tree.column('Result', width=200)
+        tree.column('Benchmark', width=220)
         
         tree.insert('', 'end', values=(
             'Binary Search Tree',
             f"{results['bst_time']*1000:.2f}",
-            'Found' if results['bst_result'] else 'Not Found'
+            'Found' if results['bst_result'] else 'Not Found',
+            self.benchmark_text(search_type, 'bst')
         ))
         
         tree.insert('', 'end', values=(
             'Hash Table',
             f"{results['hash_time']*1000:.2f}",
-            'Found' if results['hash_result'] else 'Not Found'
+            'Found' if results['hash_result'] else 'Not Found',
+            self.benchmark_text(search_type, 'hash')
         ))
         
         tree.pack(pady=20, fill=tk.X)
@@ -529,26 +3903,30 @@ class LibraryApp(tk.Tk):
         content_frame.pack(fill=tk.BOTH, expand=True)
         
         # Comparison Table
-        columns = ('Method', 'Time (ms)', 'Books Found')
+        columns = ('Method', 'Time (ms)', 'Books Found', 'Benchmark')
         tree = ttk.Treeview(content_frame, columns=columns, show='headings')
         tree.heading('Method', text='Search Method')
         tree.heading('Time (ms)', text='Time Taken (ms)')
         tree.heading('Books Found', text='Number of Books')
+        tree.heading('Benchmark', text='Benchmark p50 / p95 (ms)')
         
         tree.column('Method', width=150)
         tree.column('Time (ms)', width=100)
         tree.column('Books Found', width=150)
+        tree.column('Benchmark', width=220)
         
         tree.insert('', 'end', values=(
             'Hash Table',
             f"{results['hash_time']*1000:.2f}",
-            len(results['hash_result'])
+            len(results['hash_result']),
+            self.benchmark_text('author', 'hash')
         ))
         
         tree.insert('', 'end', values=(
             'Linear Search',
             f"{results['linear_time']*1000:.2f}",
-            len(results['linear_result'])
+            len(results['linear_result']),
+            self.benchmark_text('author', 'linear')
         ))
         
         tree.pack(pady=20, fill=tk.X)
@@ -557,15 +3935,40 @@ class LibraryApp(tk.Tk):
         list_frame = ttk.Frame(content_frame)
         list_frame.pack(fill=tk.BOTH, expand=True)
         
-        hash_list = tk.Listbox(list_frame, bg=ENTRY_COLOR, fg=TEXT_COLOR)
+        book_line = lambda book: f"{book.title} - {book.author}"
+        hash_list = VirtualList(list_frame, results['hash_result'], format=book_line,
+                                bg=ENTRY_COLOR, fg=TEXT_COLOR)
         hash_list.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=10)
-        for book in results['hash_result']:
-            hash_list.insert(tk.END, f"{book.title} - {book.author}")
         
-        linear_list = tk.Listbox(list_frame, bg=ENTRY_COLOR, fg=TEXT_COLOR)
+        linear_list = VirtualList(list_frame, results['linear_result'], format=book_line,
+                                  bg=ENTRY_COLOR, fg=TEXT_COLOR)
         linear_list.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, padx=10)
-        for book in results['linear_result']:
-            linear_list.insert(tk.END, f"{book.title} - {book.author}")
+
+    def display_ranked_results(self, frame, method, seconds, books, benchmark):
+        content_frame = ttk.Frame(frame)
+        content_frame.pack(fill=tk.BOTH, expand=True)
+        
+        columns = ('Method', 'Time (ms)', 'Books Found', 'Benchmark')
+        tree = ttk.Treeview(content_frame, columns=columns, show='headings', height=1)
+        tree.heading('Method', text='Search Method')
+        tree.heading('Time (ms)', text='Time Taken (ms)')
+        tree.heading('Books Found', text='Number of Books')
+        tree.heading('Benchmark', text='Benchmark p50 / p95 (ms)')
+        
+        tree.column('Method', width=150)
+        tree.column('Time (ms)', width=100)
+        tree.column('Books Found', width=150)
+        tree.column('Benchmark', width=220)
+        
+        tree.insert('', 'end', values=(method, f"{seconds*1000:.2f}", len(books), benchmark))
+        
+        tree.pack(pady=20, fill=tk.X)
+        
+        ttk.Label(content_frame, text="Best Matches:", style='StatLabel.TLabel').pack(anchor='w')
+        match_list = tk.Listbox(content_frame, bg=ENTRY_COLOR, fg=TEXT_COLOR)
+        match_list.pack(fill=tk.BOTH, expand=True, padx=10)
+        for book in books:
+            match_list.insert(tk.END, f"{book.title} - {book.author} ({book.isbn})")
 
     def show_search_history(self):
         history_window = tk.Toplevel(self)
@@ -574,20 +3977,57 @@ class LibraryApp(tk.Tk):
         
         ttk.Label(history_window, text="Your Search History", style='SubHeader.TLabel').pack(pady=10)
         
-        scrollbar = ttk.Scrollbar(history_window)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        
-        history_list = tk.Listbox(history_window, yscrollcommand=scrollbar.set,
-                                 bg=ENTRY_COLOR, fg=TEXT_COLOR)
+        history = self.library.search_log.for_user(self.current_user['id'])
+        history_list = VirtualList(history_window, history,
+                                   format=lambda log: f"{log['timestamp']} - {log['query']} ({log['type']})",
+                                   bg=ENTRY_COLOR, fg=TEXT_COLOR)
         history_list.pack(fill=tk.BOTH, expand=True)
-        scrollbar.config(command=history_list.yview)
-        
-        for log in self.library.search_log:
-            if log['user']['id'] == self.current_user['id']:
-                history_list.insert(tk.END, 
-                    f"{log['timestamp']} - {log['query']} ({log['type']})"
-                )
+
+def serve(host, port, shards=0):
+    import asyncio
+    library = LibrarySystem(snapshot_path=CATALOG_SNAPSHOT, log_path=CATALOG_LOG,
+                            fulltext_path=None if shards else FULLTEXT_INDEX)
+    if shards:
+        # The shards index their parts while loading; the stored catalog is
+        # only read once to fill them
+        source, library = library, ShardedLibrary(shards, fulltext_path=FULLTEXT_INDEX)
+        library.load_books(source.view.iter_books())
+        source.close()
+        threading.Thread(target=library.index_pdfs, args=(source.view.iter_books(),), daemon=True).start()
+    else:
+        threading.Thread(target=library.build_indexes, daemon=True).start()
+        library.queue_pdfs()
+    server = SearchServer(SearchService(library), host, port)
+    print(f"Serving {library.total_books():,} books on http://{host}:{port}")
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        library.close()
 
 if __name__ == "__main__":
-    app = LibraryApp()
-    app.mainloop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Ethiopian Digital Library")
+    parser.add_argument("--serve", action="store_true", help="run the HTTP search API instead of the GUI")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--shards", type=int, default=0,
+                        help="with --serve, split the catalog across this many worker processes")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="print import, catalog and first-paint times, then exit")
+    parser.add_argument("--metrics", action="store_true",
+                        help="collect hot-path index counters from the start (see /metrics)")
+    args = parser.parse_args()
+    METRICS.enabled = args.metrics
+    if args.serve:
+        serve(args.host, args.port, args.shards)
+    else:
+        app = LibraryApp()
+        if args.startup_report:
+            def report():
+                times = app.startup_times
+                print(f"Startup: imports {times['imports_ms']:.0f} ms, catalog {times['catalog_ms']:.0f} ms, "
+                      f"first paint {times['first_paint_ms']:.0f} ms ({app.library.total_books():,} books)")
+                app.exit_app()
+            app.after(0, lambda: app.after_idle(report))
+        app.mainloop()
\ No newline at end of file
@@ -0,0 +1,818 @@
+import asyncio
+import http.client
+import json
+import random
+import threading
+import zlib
+from types import SimpleNamespace
+
+import pytest
+
+from main import (BST, METRICS, Book, CatalogSnapshot, FullTextIndex, FuzzyIndex, HashTable,
+                  HeavyHitters, Histogram, HyperLogLog, LibrarySystem, QueryCache, RadixTrie,
+                  SearchLog, SearchServer, SearchService, SearchStats, ShardedLibrary, VirtualList,
+                  WriteAheadLog, decode_varints, encode_varints, histogram_quantile, normalize_key,
+                  pdf_string, pdf_terms, pdf_text, prometheus_text, read_catalog, round_robin)
+
+
+def make_book(i, title=None, author=None):
+    return Book(title or f"Title {i:04d}", author or f"Author {i % 7}", f"{i:06d}", "")
+
+def open_library(tmp_path, **kwargs):
+    return LibrarySystem(str(tmp_path / "catalog.snap"), str(tmp_path / "catalog.wal"),
+                         samples=False, **kwargs)
+
+
+def test_bst_matches_dict_model():
+    rng = random.Random(1)
+    tree = BST(lambda value: value[0])
+    model = {}
+    for step in range(2000):
+        key = rng.randrange(200)
+        if key in model and rng.random() < 0.5:
+            value = model.pop(key)
+            assert tree.delete(key, value)
+        elif key not in model:
+            value = (key, step)
+            model[key] = value
+            tree.insert(value)
+        if step % 100 == 0:
+            assert len(tree) == len(model)
+            assert [value[0] for value in tree] == sorted(model)
+    for key in range(200):
+        assert tree.search(key) == model.get(key)
+
+def test_bst_delete_keeps_old_roots_intact():
+    tree = BST(lambda value: value)
+    for value in range(100):
+        tree.insert(value)
+    root = tree.root
+    for value in range(0, 100, 2):
+        tree.delete(value, value)
+    assert list(tree) == list(range(1, 100, 2))
+    tree.root, current = root, tree.root
+    assert list(tree) == list(range(100))
+    tree.root = current
+    assert tree.height() <= 9
+
+def test_bst_search_skips_rejected_duplicates():
+    tree = BST(lambda value: value[0])
+    for i in range(20):
+        tree.insert(("same", i))
+    assert tree.search("same", lambda value: value[1] == 17) == ("same", 17)
+    assert tree.search("same", lambda value: False) is None
+
+def test_hash_table_matches_dict_model():
+    rng = random.Random(2)
+    table = HashTable(lambda value: value[0], size=8)
+    model = {}
+    for step in range(5000):
+        key = rng.randrange(300)
+        if key in model and rng.random() < 0.6:
+            assert table.delete(key, model.pop(key))
+        elif key not in model:
+            model[key] = (key, step)
+            table.insert(model[key])
+    assert len(table) == len(model)
+    assert table.compactions > 0
+    for key in range(300):
+        assert table.search(key) == model.get(key)
+
+def test_hash_table_tombstones_compact():
+    table = HashTable(lambda value: value, size=8)
+    for value in range(100):
+        table.insert(value)
+    for value in range(90):
+        assert table.delete(value, value)
+    assert not table.delete(0, 0)
+    assert table.tombstones * 4 <= table.count + table.tombstones
+    assert [table.search(value) for value in range(100)] == [None] * 90 + list(range(90, 100))
+
+def test_radix_trie_remove():
+    trie = RadixTrie(top_k=3)
+    words = ["tea", "team", "teach", "ten", "to", "tea"]
+    for row, word in enumerate(words):
+        trie.insert(word, row)
+    assert set(trie.complete("te")) <= {0, 1, 2, 3, 5}
+    assert trie.complete("tea")[0] in (0, 5)
+    assert trie.remove("tea", 0, replacement=5)
+    assert trie.complete("tea")[0] == 5
+    assert trie.remove("tea", 5)
+    assert 5 not in trie.complete("te") and 0 not in trie.complete("te")
+    assert not trie.remove("tea", 5)
+    assert trie.remove("to", 4)
+    assert trie.complete("to") == []
+    assert trie.complete("t", 10) and len(trie) == 3
+
+def test_fuzzy_index_insert_remove():
+    index = FuzzyIndex()
+    index.insert("harry potter", 1)
+    index.insert("harry potter", 2)
+    index.insert("hairy plotter", 3)
+    assert set(index.search("hary potter")) >= {1, 2}
+    assert index.remove("harry potter", 1)
+    assert not index.remove("harry potter", 1)
+    assert 1 not in index.search("harry potter")
+    assert 2 in index.search("harry potter")
+
+def test_normalize_key_is_idempotent():
+    for text in ["Straße", "ΣΊΣΥΦΟΣ", "ሀሁ ሐ ኀ", "Ǆ", "ﬃ", "é"]:
+        key = normalize_key(text)
+        assert normalize_key(key) == key
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "books.snap")
+    books = [make_book(i) for i in range(50)]
+    CatalogSnapshot.write(path, books, last_seq=42)
+    snapshot = CatalogSnapshot(path)
+    try:
+        assert len(snapshot) == 50 and snapshot.last_seq == 42
+        assert [book_fields(book) for book in snapshot] == [book_fields(book) for book in books]
+        assert snapshot.find('isbn', "000017").title == "Title 0017"
+        assert snapshot.find('title', "TITLE 0003").isbn == "000003"
+        assert len(snapshot.find('author', "author 3")) == 7
+        assert [book.isbn for book in snapshot.scan('isbn', "000010", "000012")] == \
+            ["000010", "000011", "000012"]
+        assert [book.title for book in snapshot.prefix('title', "title 004")] == \
+            [f"Title {i:04d}" for i in range(40, 50)]
+    finally:
+        snapshot.close()
+
+def book_fields(book):
+    return book.title, book.author, book.isbn, book.pdf_path
+
+
+def test_wal_replays_changes_after_restart(tmp_path):
+    library = open_library(tmp_path)
+    for i in range(10):
+        library.add_book(make_book(i))
+    library.update_book("000003", title="Renamed")
+    library.remove_book("000004")
+    library.close()
+
+    library = open_library(tmp_path)
+    try:
+        assert library.total_books() == 9
+        assert library.find('isbn', "000003").title == "Renamed"
+        assert library.find('title', "renamed").isbn == "000003"
+        assert library.find('title', "Title 0003") is None
+        assert library.find('isbn', "000004") is None
+        assert library.find('isbn', "000009").title == "Title 0009"
+    finally:
+        library.close()
+
+def test_changes_after_snapshot_replay(tmp_path):
+    library = open_library(tmp_path)
+    for i in range(10):
+        library.add_book(make_book(i))
+    library.save_snapshot()
+    library.remove_book("000001")
+    library.update_book("000002", author="Someone Else")
+    library.add_book(make_book(10))
+    library.close()
+
+    library = open_library(tmp_path)
+    try:
+        assert library.total_books() == 10
+        assert library.find('isbn', "000001") is None
+        assert [book.isbn for book in library.author_search("someone else")] == ["000002"]
+        assert "000002" not in [book.isbn for book in library.author_search("Author 2")]
+        assert [book.isbn for book in library.isbn_range("000000", "000003")] == ["000000", "000002", "000003"]
+    finally:
+        library.close()
+
+def test_library_matches_dict_model_across_restarts(tmp_path):
+    rng = random.Random(3)
+    model = {}
+    library = open_library(tmp_path)
+    try:
+        for step in range(400):
+            i = rng.randrange(60)
+            isbn = f"{i:06d}"
+            choice = rng.random()
+            if isbn not in model:
+                book = make_book(i, title=f"Book {rng.randrange(20)}")
+                library.add_book(book)
+                model[isbn] = book_fields(book)
+            elif choice < 0.4:
+                assert library.remove_book(isbn).isbn == isbn
+                del model[isbn]
+            else:
+                title = f"Book {rng.randrange(20)}"
+                library.update_book(isbn, title=title)
+                model[isbn] = (title,) + model[isbn][1:]
+            if step % 100 == 99:
+                if step % 200 == 199:
+                    library.save_snapshot()
+                library.close()
+                library = open_library(tmp_path)
+            if step % 25 == 0:
+                check_model(library, model)
+        check_model(library, model)
+    finally:
+        library.close()
+
+def check_model(library, model):
+    assert library.total_books() == len(model)
+    for i in range(60):
+        isbn = f"{i:06d}"
+        book = library.find('isbn', isbn)
+        assert (book and book_fields(book)) == model.get(isbn)
+    titles = {}
+    for fields in model.values():
+        titles.setdefault(normalize_key(fields[0]), set()).add(fields[2])
+    for key, isbns in titles.items():
+        assert library.find('title', key).isbn in isbns
+        assert library.find('title', key, method='bst').isbn in isbns
+
+
+@pytest.mark.parametrize("built", [(), ('title_trie',), ('author_trie',), ('title_trie', 'author_trie'),
+                                   ('title_hash', 'title_trie', 'author_hash', 'author_trie')])
+def test_remove_with_partial_indexes(built):
+    library = LibrarySystem(samples=False)
+    library.load_books([Book("Dune", "Frank Herbert", "1", ""), Book("Dune", "Frank Herbert", "2", ""),
+                        Book("Emma", "Jane Austen", "3", "")])
+    library.build_indexes(built)
+    assert library.remove_book("1").isbn == "1"
+    assert library.suggest("du", "title") == ["Dune"]
+    assert library.suggest("fr", "author") == ["Frank Herbert"]
+    assert library.remove_book("2").isbn == "2"
+    assert library.suggest("du", "title") == []
+    assert library.suggest("fr", "author") == []
+    assert library.suggest("em", "title") == ["Emma"]
+    assert library.find('title', "dune") is None
+
+def test_update_with_partial_indexes():
+    library = LibrarySystem(samples=False)
+    library.load_books([make_book(i) for i in range(5)])
+    library.build_indexes(('title_trie', 'isbn_bst'))
+    library.update_book("000002", title="Zebra")
+    assert library.suggest("zeb", "title") == ["Zebra"]
+    assert library.suggest("title 0002", "title") == []
+    assert library.find('title', "zebra").isbn == "000002"
+    assert [book.title for book in library.isbn_range("000002", "000002")] == ["Zebra"]
+
+
+def test_read_catalog_rejects_bad_rows(tmp_path):
+    path = tmp_path / "books.csv"
+    path.write_text("title,author,isbn,pdf_path\nA,B,1,\nShort,Row\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="line 3: missing isbn"):
+        list(read_catalog(str(path)))
+
+    path = tmp_path / "books.jsonl"
+    path.write_text(json.dumps({"title": "A", "author": "B", "isbn": 7}) + "\n"
+                    + json.dumps({"title": "A", "author": {"x": 1}, "isbn": "8"}) + "\n", encoding="utf-8")
+    books = read_catalog(str(path))
+    assert next(books).isbn == "7"
+    with pytest.raises(ValueError, match="line 2: author"):
+        next(books)
+
+def test_read_catalog_skips_byte_order_mark(tmp_path):
+    path = tmp_path / "export.csv"
+    path.write_bytes("\ufefftitle,author,isbn,pdf_path\r\nአማርኛ,B,1,\r\n".encode("utf-8"))
+    assert [(book.title, book.isbn) for book in read_catalog(str(path))] == [("አማርኛ", "1")]
+    path = tmp_path / "export.jsonl"
+    path.write_bytes("\ufeff".encode("utf-8") + json.dumps({"title": "A", "author": "B", "isbn": "2"}).encode())
+    assert [book.isbn for book in read_catalog(str(path))] == ["2"]
+
+def test_bad_catalog_leaves_log_replayable(tmp_path):
+    path = tmp_path / "books.csv"
+    path.write_text("title,author,isbn,pdf_path\nA,B,1,\nC,D,2,\nShort,Row\n", encoding="utf-8")
+    library = open_library(tmp_path)
+    with pytest.raises(ValueError):
+        library.bulk_load(str(path))
+    library.add_book(make_book(3))
+    library.close()
+
+    library = open_library(tmp_path)
+    try:
+        assert sorted(book.isbn for book in library.view.iter_books()) == ["000003", "1", "2"]
+    finally:
+        library.close()
+
+def test_load_books_publishes_rows_before_a_bad_book():
+    library = LibrarySystem(samples=False)
+    with pytest.raises(TypeError):
+        library.load_books([make_book(0), make_book(1), Book("T", None, "9", "")])
+    assert library.total_books() == 2
+    library.add_book(make_book(2))
+    assert library.find('isbn', "000002").title == "Title 0002"
+    assert library.find('isbn', "9") is None
+    assert len(library.view.books) == library.view.rows == 3
+
+def test_wal_rewrite_keeps_order(tmp_path):
+    path = str(tmp_path / "log.wal")
+    wal = WriteAheadLog(path)
+    for i in range(100):
+        wal.append({'op': 'add_book', 'i': i})
+    wal.flush()
+    wal.rewrite(lambda record: record['seq'] > 90, [{'op': 'note', 'seq': 90}])
+    wal.append({'op': 'add_book', 'i': 100})
+    wal.close()
+    records = list(WriteAheadLog.read(path))
+    assert [record['seq'] for record in records] == list(range(90, 102))
+    assert records[0]['op'] == 'note'
+
+
+def write_pdf(path, content, compress=True, indirect=False):
+    # One content stream, its /Length given directly or as a reference
+    if compress:
+        content = zlib.compress(content)
+    length = b"15 0 R" if indirect else b"%d" % len(content)
+    flate = b" /Filter /FlateDecode" if compress else b""
+    path.write_bytes(b"%PDF-1.4\n1 0 obj\n<< /Type /Catalog >>\nendobj\n"
+                     b"3 0 obj\n<< /Length " + length + flate + b" >>\nstream\n" + content
+                     + b"\nendstream\nendobj\n15 0 obj\n%d\nendobj\n%%%%EOF\n" % len(content))
+    return str(path)
+
+def test_pdf_string():
+    assert pdf_string(rb"(a\(b\)c\\)") == "a(b)c\\"
+    assert pdf_string(rb"(line\nbreak\101\7)") == "line\nbreakA\x07"
+    assert pdf_string(b"(split \\\nline)") == "split line"
+    assert pdf_string(b"<48 65 6C6C 6F>") == "Hello"
+    assert pdf_string(b"<4>") == "@"
+    assert pdf_string(b"<FEFF 0048 12A0>") == "H\u12a0"
+
+@pytest.mark.parametrize("compress", [True, False])
+@pytest.mark.parametrize("indirect", [True, False])
+def test_pdf_text_stream_lengths(tmp_path, compress, indirect):
+    path = write_pdf(tmp_path / "doc.pdf", b"BT /F1 11 Tf (Direct) Tj (and indirect) Tj ET", compress, indirect)
+    assert list(pdf_text(path)) == ["Direct and indirect"]
+
+def test_pdf_text_tj_word_gaps(tmp_path):
+    path = write_pdf(tmp_path / "doc.pdf", b"BT [(Hello) -300 (World)] TJ [(Ke) 80 (rn) -20.5 (ing)] TJ "
+                                           b"[(A)-250(B)] TJ [<4869> -1000 (there)] TJ ET")
+    assert list(pdf_text(path)) == ["Hello World Kerning A B Hi there"]
+    assert pdf_terms(path) == {"hello": 1, "world": 1, "kerning": 1, "a": 1, "b": 1, "hi": 1, "there": 1}
+
+def test_varints_round_trip():
+    values = [0, 1, 127, 128, 255, 300, 16383, 16384, 2 ** 31, 2 ** 63 - 1]
+    data = encode_varints(values)
+    assert len(encode_varints([127])) == 1 and len(encode_varints([128])) == 2
+    assert decode_varints(data) == values
+
+def test_fulltext_tiered_merges(tmp_path):
+    rng = random.Random(4)
+    model = {}
+
+    def check(index):
+        for word in ("alpha", "beta", "gamma", "delta"):
+            found = {isbn for _, isbn in index.search(word, 100)}
+            assert found == {isbn for isbn, words in model.items() if word in words}
+        assert len(index) == sum(1 for words in model.values() if words)
+
+    index = FullTextIndex(str(tmp_path / "index"), workers=1, merge_factor=3)
+    for step in range(120):
+        isbn = str(rng.randrange(40))
+        path = tmp_path / f"{isbn}.pdf"
+        if model.get(isbn) and rng.random() < 0.2:
+            path.unlink()
+            model[isbn] = set()
+        else:
+            words = set(rng.sample(["alpha", "beta", "gamma", "delta"], rng.randint(1, 3)))
+            text = b" ".join(b"(%s) Tj" % word.encode() for word in sorted(words)) + b" (%d) Tj" % step
+            write_pdf(path, b"BT " + text + b" ET")
+            model[isbn] = words
+        assert index.update([Book(isbn, "A", isbn, str(path))]) == 1
+        check(index)
+        segments = index.state[0]
+        assert all(len([s for s in segments if index._tier(len(s.docs)) == tier]) < 3
+                   for tier in range(5))
+    # A vanished PDF left in a small segment still hides the older document
+    # that a larger one holds, and all of it survives a reopen
+    assert len(index.state[0]) > 1
+    check(FullTextIndex(str(tmp_path / "index")))
+
+def test_wal_commits_groups_of_at_most_group_size(tmp_path):
+    wal = WriteAheadLog(str(tmp_path / "log.wal"), group_size=3, flush_interval=3600)
+    try:
+        for i in range(10):
+            wal.append({'op': 'search', 'i': i})
+        assert wal.durable == 0
+        wal.wait(4)
+        assert wal.durable == 6 and wal.commits == 2
+        wal.flush()
+        assert wal.durable == 10 and wal.commits == 4
+    finally:
+        wal.close()
+
+def test_catalog_changes_are_on_disk_when_they_return(tmp_path):
+    library = open_library(tmp_path)
+    try:
+        library.add_book(make_book(1))
+        library.load_books([make_book(2), make_book(3)])
+        library.update_book("000002", title="Renamed")
+        library.remove_book("000003")
+        logged = [record['op'] for record in WriteAheadLog.read(str(tmp_path / "catalog.wal"))]
+        assert logged == ['add_book'] * 3 + ['update_book', 'remove_book']
+    finally:
+        library.close()
+
+def test_update_rejects_a_taken_isbn(tmp_path):
+    library = open_library(tmp_path)
+    try:
+        library.load_books([make_book(i) for i in range(4)])
+        library.save_snapshot()
+        library.add_book(make_book(4))
+        for taken in ("000001", "000004"):
+            with pytest.raises(ValueError, match="already taken"):
+                library.update_book("000002", isbn=taken)
+        with pytest.raises(ValueError, match="already taken"):
+            library.update_book("000004", title="New", isbn="000000")
+        assert library.update_book("000002", isbn="000002", title="Same ISBN").title == "Same ISBN"
+        assert library.update_book("000003", isbn="000009").isbn == "000009"
+        assert [book.isbn for book in library.isbn_range("000000", "000009")] == \
+            ["000000", "000001", "000002", "000004", "000009"]
+    finally:
+        library.close()
+    library = open_library(tmp_path)
+    try:
+        assert library.total_books() == 5
+        assert library.find('isbn', "000004").title == "Title 0004"
+    finally:
+        library.close()
+
+def test_sharded_update_book():
+    library = ShardedLibrary(shards=2)
+    try:
+        library.load_books([make_book(i) for i in range(8)])
+        shards = {isbn: library.shard_of(isbn) for isbn in (f"{i:06d}" for i in range(20))}
+        same = next(isbn for isbn in list(shards)[1:8] if shards[isbn] == shards["000000"])
+        other = next(isbn for isbn in list(shards)[1:8] if shards[isbn] != shards["000000"])
+        with pytest.raises(TypeError):
+            library.update_book("000000", title=5)
+        for taken in (same, other):
+            with pytest.raises(ValueError, match="already taken"):
+                library.update_book("000000", isbn=taken)
+        assert library.total_books() == 8
+
+        moved = next(isbn for isbn in shards if int(isbn) >= 8 and shards[isbn] != shards["000000"])
+        ask = library._ask
+
+        def failing_add(shards, op, *args):
+            if op == 'add_book' and list(shards) == [library.shard_of(moved)]:
+                raise RuntimeError("shard unavailable")
+            return ask(shards, op, *args)
+
+        library._ask = failing_add
+        with pytest.raises(RuntimeError):
+            library.update_book("000000", isbn=moved)
+        library._ask = ask
+        assert library.find('isbn', "000000").title == "Title 0000"
+        assert library.update_book("000000", isbn=moved).isbn == moved
+        assert library.find('isbn', moved).title == "Title 0000"
+        assert library.find('isbn', "000000") is None
+        assert library.total_books() == 8
+    finally:
+        library.close()
+
+@pytest.mark.parametrize("delta, top", [(120, 7), (-120, 13), (240, 4), (-360, 19), (1, 9), (-3, 11), (0, 10)])
+def test_virtual_list_wheel_step(delta, top):
+    # Tk-free stand-in: on_wheel only needs top and scroll_to
+    class List:
+        def scroll_to(self, new_top):
+            self.top = new_top
+    widget = List()
+    widget.top = 10
+    VirtualList.on_wheel(widget, SimpleNamespace(delta=delta))
+    assert widget.top == top
+
+
+def search_entry(i, day="2024-01-01", users=50):
+    return {'user': {'id': f"u{i % users}", 'name': "reader"}, 'query': f"Query {i % 7}",
+            'type': ("title", "author")[i % 2], 'timestamp': f"{day} {i % 24:02d}:00:00"}
+
+def test_hyperloglog_estimates_and_round_trips():
+    sketch = HyperLogLog()
+    for i in range(20000):
+        sketch.add(f"user{i}")
+        sketch.add(f"user{i}")
+    assert abs(sketch.count() - 20000) < 20000 * 0.05
+    copy = HyperLogLog(registers=bytes(sketch.registers))
+    assert copy.count() == sketch.count()
+    small = HyperLogLog(p=10)
+    for i in range(30):
+        small.add(i)
+    assert small.count() == 30
+
+def test_heavy_hitters_keep_frequent_items():
+    rng = random.Random(5)
+    hitters = HeavyHitters(capacity=10)
+    stream = ["hot"] * 300 + ["warm"] * 150 + [f"cold{rng.randrange(500)}" for _ in range(550)]
+    rng.shuffle(stream)
+    for item in stream:
+        hitters.add(item)
+    assert len(hitters.counts) == 10
+    assert [item for item, _ in hitters.top(2)] == ["hot", "warm"]
+    assert hitters.top(1)[0][1] >= 300
+
+def test_search_stats_record_and_restore():
+    stats = SearchStats(keep_days=2)
+    for day in ("2024-01-01", "2024-01-02", "2024-01-03"):
+        for i in range(100):
+            stats.record(search_entry(i, day), seq=i)
+    assert stats.total == 300 and stats.last_seq == 99
+    assert stats.searches_on("2024-01-01") == 0 and stats.searches_on("2024-01-03") == 100
+    assert abs(stats.active_users_on("2024-01-03") - 50) <= 2
+    assert sum(stats.hours_of("2024-01-02")) == 100
+    assert stats.by_type == {'title': 150, 'author': 150}
+
+    copy = SearchStats(keep_days=2)
+    copy.restore(json.loads(json.dumps(stats.to_record())))
+    assert copy.to_record() == stats.to_record()
+    assert copy.active_users_on("2024-01-02") == stats.active_users_on("2024-01-02")
+    assert copy.top_queries.top(1) == stats.top_queries.top(1)
+
+def test_search_stats_survive_compaction_and_restarts(tmp_path):
+    library = open_library(tmp_path, search_log_size=10)
+    try:
+        for i in range(200):
+            library.log_search(search_entry(i))
+        library.save_snapshot()
+        for i in range(200, 250):
+            library.log_search(search_entry(i))
+    finally:
+        library.close()
+    for _ in range(2):
+        library = open_library(tmp_path, search_log_size=10)
+        try:
+            assert library.stats.total == 250
+            assert library.stats.searches_on("2024-01-01") == 250
+            assert abs(library.stats.active_users_on("2024-01-01") - 50) <= 2
+            assert len(library.search_log) == 10
+            library.compact()
+        finally:
+            library.close()
+
+def test_search_log_wraps_around_and_indexes_users():
+    log = SearchLog(capacity=5)
+    assert list(log) == [] and log.oldest_seq() == 0
+    model = []
+    for i in range(13):
+        entry = search_entry(i, users=3)
+        log.append(entry, seq=100 + i)
+        model = (model + [entry])[-5:]
+        assert len(log) == len(model)
+        assert list(log) == model
+        assert [log[j] for j in range(len(log))] == model
+        for user in ("u0", "u1", "u2", "nobody"):
+            assert list(log.for_user(user)) == [e for e in model if e['user']['id'] == user]
+    assert log.oldest_seq() == 108
+    with pytest.raises(IndexError):
+        log[5]
+    assert set(log._by_user) == {"u0", "u1", "u2"}
+
+
+def test_search_service_looks_up_each_pair_once():
+    library = LibrarySystem(samples=False)
+    library.load_books([make_book(i) for i in range(10)])
+    service = SearchService(library)
+    lookups = []
+    lookup = service._lookup
+    service._lookup = lambda search_type, key: lookups.append((search_type, key)) or lookup(search_type, key)
+    found = service.search_many([("title", "Title 0003"), (" TITLE ", "title 0003  "), ("isbn", "000004"),
+                                 ("author", "AUTHOR 1"), ("fuzzy", "titel 0005")], {'id': "u1", 'name': "Ann"})
+    assert lookups == [("title", "title 0003"), ("isbn", "000004"), ("author", "author 1"), ("fuzzy", "titel 0005")]
+    assert [book.isbn for book in found[0]] == [book.isbn for book in found[1]] == ["000003"]
+    assert [book.isbn for book in found[2]] == ["000004"]
+    assert sorted(book.isbn for book in found[3]) == ["000001", "000008"]
+    assert "000005" in [book.isbn for book in found[4]]
+    assert [(entry['type'], entry['query']) for entry in library.search_log.for_user("u1")] == \
+        [("title", "Title 0003"), ("title", "title 0003  "), ("isbn", "000004"), ("author", "AUTHOR 1"),
+         ("fuzzy", "titel 0005")]
+    # A repeat is answered from the cache
+    assert service.search("title", "TITLE 0003")[0].isbn == "000003"
+    assert len(lookups) == 4
+    for search_type, query in (("shelf", "x"), ("title", 5), (None, "x")):
+        with pytest.raises(ValueError):
+            service.search(search_type, query)
+
+@pytest.fixture
+def server():
+    library = LibrarySystem(samples=False)
+    library.load_books([make_book(i) for i in range(10)])
+    server = SearchServer(SearchService(library), port=0)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        started.set()
+        loop.run_forever()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    started.wait()
+    yield server
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+def test_http_routes_and_errors(server):
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=10)
+
+    def request(method, target, body=None):
+        conn.request(method, target, body)
+        response = conn.getresponse()
+        data = response.read()
+        if response.getheader("Content-Type").startswith("application/json"):
+            data = json.loads(data)
+        return response.status, data
+
+    # One keep-alive connection serves every request, errors included
+    status, books = request("GET", "/search?type=title&q=Title%200002&user=u7")
+    assert status == 200 and [book['isbn'] for book in books] == ["000002"]
+    status, results = request("POST", "/search_many", json.dumps([["isbn", "000001"], ["title", "nothing"]]))
+    assert status == 200 and [len(books) for books in results] == [1, 0]
+    for body in ('[["title", 5]]', '[["title"]]', '{"title": "x"}', 'not json', '[["shelf", "x"]]'):
+        status, error = request("POST", "/search_many", body)
+        assert status == 400 and error['error']
+    assert request("GET", "/search?type=shelf&q=x")[0] == 400
+    assert request("GET", "/nowhere")[0] == 404
+    assert request("DELETE", "/search")[0] == 404
+    status, text = request("GET", "/metrics")
+    assert status == 200 and b"library_books" in text
+    assert request("GET", "/metrics?format=json")[1]['enabled'] in (True, False)
+    conn.close()
+
+
+def test_query_cache_lru_and_tags():
+    cache = QueryCache(capacity=3)
+    for i in range(3):
+        cache.put(('search', 'title', str(i)), [i], {('title', str(i))}, cache.generation)
+    assert cache.get(('search', 'title', '0')) == [0]
+    cache.put(('search', 'title', '3'), [3], {('title', '3'), ('title', 'shared')}, cache.generation)
+    assert cache.get(('search', 'title', '1')) is None
+    assert len(cache) == 3 and cache.evictions == 1
+    cache.invalidate({('title', 'shared'), ('title', 'missing')})
+    assert cache.get(('search', 'title', '3')) is None
+    assert cache.get(('search', 'title', '0')) == [0] and cache.get(('search', 'title', '2')) == [2]
+    assert cache._by_tag.keys() == {('title', '0'), ('title', '2')}
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['invalidations']) == (3, 2, 1)
+    cache.clear()
+    assert len(cache) == 0 and not cache._by_tag
+
+def test_query_cache_drops_answers_computed_before_a_change():
+    cache = QueryCache()
+    generation = cache.generation
+    cache.invalidate({('title', 'unrelated')})
+    cache.put(('search', 'title', 'dune'), [], {('title', 'dune')}, generation)
+    assert cache.get(('search', 'title', 'dune')) is None
+    cache.put(('search', 'title', 'dune'), [], {('title', 'dune')}, cache.generation)
+    assert cache.get(('search', 'title', 'dune')) == []
+
+def test_cached_searches_follow_catalog_changes(tmp_path):
+    library = LibrarySystem(samples=False, fulltext_path=str(tmp_path / "fulltext"))
+    path = write_pdf(tmp_path / "dune.pdf", b"BT (spice melange) Tj ET")
+    library.load_books([Book("Dune", "Frank Herbert", "1", path), make_book(2)])
+    library.index_pdfs()
+    service = SearchService(library)
+    assert [b.isbn for b in service.search("author", "frank herbert")] == ["1"]
+    assert service.search("fuzzy", "dunes") and service.search("title", "Emma") == []
+    assert [b.title for b in service.search("fulltext", "melange")] == ["Dune"]
+
+    library.add_book(Book("Emma", "Frank Herbert", "3", ""))
+    assert [b.isbn for b in service.search("title", "emma")] == ["3"]
+    assert sorted(b.isbn for b in service.search("author", "frank herbert")) == ["1", "3"]
+    library.update_book("1", title="Dune Messiah")
+    assert [b.title for b in service.search("fulltext", "melange")] == ["Dune Messiah"]
+    assert "1" in [b.isbn for b in service.search("fuzzy", "dune mesiah")]
+    library.remove_book("1")
+    assert service.search("fulltext", "melange") == []
+    assert [b.isbn for b in service.search("author", "frank herbert")] == ["3"]
+    assert library.cache.stats()['hits'] == 0
+    assert service.search("author", "frank herbert") and library.cache.stats()['hits'] == 1
+    library.close()
+
+
+def test_round_robin_merges_by_rank():
+    assert round_robin([[1, 4], [2], [3, 5, 6]]) == [1, 2, 3, 4, 5, 6]
+    assert round_robin([]) == [] and round_robin([[], [7]]) == [7]
+
+def test_sharded_library_matches_one_library():
+    rng = random.Random(6)
+    books = [Book(f"{rng.choice(['Red', 'Blue', 'Green'])} {word} {i}", f"Author {i % 9}", f"{i * 7919 % 100000:05d}", "")
+             for i, word in enumerate(rng.choices(["river", "stone", "crown", "ember"], k=120))]
+    single = LibrarySystem(samples=False)
+    single.load_books(books)
+    sharded = ShardedLibrary(shards=3)
+    try:
+        sharded.load_books(books)
+        assert sharded.total_books() == single.total_books() == 120
+        assert len({sharded.shard_of(book.isbn) for book in books}) == 3
+        for book in rng.sample(books, 20):
+            assert sharded.find('isbn', book.isbn).title == book.title
+            assert sharded.find('title', book.title.upper()).isbn == book.isbn
+            assert sharded.find('title', book.title, 'bst').isbn == book.isbn
+        assert sharded.find('isbn', "nope") is None and sharded.find('title', "nope") is None
+
+        def isbns(found):
+            return sorted(book.isbn for book in found)
+        for author in ("Author 3", "author 8", "Nobody"):
+            assert isbns(sharded.author_search(author)) == isbns(single.author_search(author))
+            assert isbns(sharded.linear_author_search(author)) == isbns(single.linear_author_search(author))
+        assert [b.isbn for b in sharded.isbn_range("10000", "40000")] == \
+            [b.isbn for b in single.isbn_range("10000", "40000")]
+        assert [b.isbn for b in sharded.isbn_range(None, None, 5)] == [b.isbn for b in single.isbn_range(None, None, 5)]
+        assert [b.title for b in sharded.title_prefix("blue", 7)] == [b.title for b in single.title_prefix("blue", 7)]
+        greens = {book.title for book in books if book.title.startswith("Green")}
+        # Each shard's trie keeps its own top ten, so three shards offer more
+        assert len(single.suggest("gre", "title", 50)) == 10
+        suggested = sharded.suggest("gre", "title", 50)
+        assert len(suggested) == len(set(suggested)) == 30 and set(suggested) <= greens
+        assert len(sharded.suggest("gre", "title", 4)) == 4
+        target = books[7].title
+        best = sharded.fuzzy_search(target[:2] + target[3:], 5)
+        assert len(best) == 5 and best[0].title == target
+
+        sharded.add_book(Book("Lone Title", "Solo Writer", "99999", ""))
+        sharded.remove_book(books[0].isbn)
+        assert sharded.find('title', "lone title").isbn == "99999"
+        assert sharded.find('isbn', books[0].isbn) is None
+        assert sharded.total_books() == 120
+        report = sharded.metrics()
+        assert {entry['labels'].get('shard') for entry in report['gauges']} >= {'0', '1', '2'}
+    finally:
+        sharded.close()
+
+
+@pytest.fixture
+def metrics():
+    enabled = METRICS.enabled
+    METRICS.reset()
+    METRICS.enabled = True
+    yield METRICS
+    METRICS.enabled = enabled
+    METRICS.reset()
+
+def test_histogram_buckets_and_quantiles():
+    histogram = Histogram((1, 2, 4, 8))
+    for value in (1, 1, 2, 3, 5, 9, 100):
+        histogram.observe(value)
+    report = histogram.report()
+    assert report == {'buckets': [[1, 2], [2, 3], [4, 4], [8, 5]], 'count': 7, 'sum': 121}
+    assert [histogram_quantile(report, q) for q in (0.25, 0.5, 0.7)] == [1, 4, 8]
+    assert histogram_quantile(report, 0.99) is None
+    assert histogram_quantile(Histogram((1,)).report(), 0.5) is None
+    total = Histogram((1, 2, 4, 8))
+    total.merge(histogram)
+    total.merge(histogram)
+    assert total.report()['buckets'][-1] == [8, 10] and total.report()['count'] == 14
+
+def test_metrics_merge_threads_and_count_real_visits(metrics):
+    def observe():
+        for _ in range(1000):
+            metrics.observe('hash_probes', 2, index='t')
+    threads = [threading.Thread(target=observe) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    observe()
+    tree = BST(lambda value: value, name='tree')
+    for value in range(7):
+        tree.insert(value)
+    assert tree.root.value == 3
+    tree.search(3)
+    tree.search(0)
+    tree.search(10)
+    table = HashTable(lambda value: value, name='table')
+    table.insert(5)
+    table.search(5)
+    histograms = {(h['name'], h['labels']['index']): h for h in metrics.report()['histograms']}
+    assert histograms['hash_probes', 't']['count'] == 5000
+    assert histograms['bst_nodes_visited', 'tree']['sum'] == 1 + 3 + 3
+    assert histograms['hash_probes', 'table'] == dict(histograms['hash_probes', 'table'], count=1, sum=1)
+    metrics.reset()
+    assert metrics.report()['histograms'] == []
+    metrics.enabled = False
+    tree.search(3)
+    assert metrics.report()['histograms'] == []
+
+def test_prometheus_text_format(metrics):
+    library = LibrarySystem(samples=False)
+    library.load_books([make_book(i) for i in range(20)])
+    library.build_indexes()
+    SearchService(library).search_many([("title", "Title 0001"), ("isbn", "000002"), ("author", "Author 3")])
+    metrics.observe('search_seconds', 0.002, type='we"ird\\type')
+    text = prometheus_text(library.metrics())
+    lines = text.splitlines()
+    assert text.endswith("\n")
+    samples = [line for line in lines if not line.startswith("#")]
+    names = [line.split("{")[0].split(" ")[0] for line in samples]
+    families = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+    assert len(families) == len(set(families))
+    for family in families:
+        # Every sample of a family follows its TYPE line, all together
+        members = [i for i, name in enumerate(names) if name == family or name.rsplit("_", 1)[0] == family]
+        assert members == list(range(members[0], members[-1] + 1))
+    assert "# TYPE library_hash_probes histogram" in lines
+    assert 'library_search_seconds_bucket{type="we\\"ird\\\\type",le="0.005"} 1' in lines
+    assert 'library_books 20' in lines and 'library_metrics_enabled 1' in lines
+    assert 'library_hash_tombstones{index="isbn_hash"} 0' in lines
+    probes = next(entry for entry in library.metrics()['histograms'] if entry['name'] == 'hash_probes')
+    index = probes['labels']['index']
+    assert f'library_hash_probes_bucket{{index="{index}",le="+Inf"}} {probes["count"]}' in lines
+    assert f'library_hash_probes_count{{index="{index}"}} {probes["count"]}' in lines